@@ -0,0 +1,408 @@
+"""
+Асинхронный streaming-прокси для /api/chat/stream (ASGI).
+
+Каждый открытый поток - это корутина на общем event loop, а не занятый sync-воркер,
+поэтому один процесс держит сотни одновременных SSE потоков к OpenRouter.
+Формат событий (token/done/cost) совпадает с Flask-версией в routes.py.
+"""
+import os
+import json
+import asyncio
+import logging
+import time
+
+import httpx
+
+from app.api import metrics
+from app.api.compression import (
+    API_COMPRESSION, API_COMPRESS_SSE, StreamCompressor, choose_encoding, record_stream_compression
+)
+from app.api.tracing import Trace, REQUEST_ID_HEADER
+from app.api.conversation_store import TurnRecorder
+from app.api.cost_calculator import cost_trace_fields
+from app.api.model_router import record_stream, record_upstream_failure
+from app.api.prompt_cache import with_prompt_caching
+from app.api.request_schema import prepare_request
+from app.api.routes import conversation_headers, history_report_headers
+from app.api.response_cache import RESPONSE_CACHE_ENABLED, cache_key, get_cached_response, store_response, replay_sse
+from app.api.single_flight import SINGLE_FLIGHT_ENABLED, async_stream_single_flight
+from app.api.resilience import CIRCUIT_OPEN_MESSAGE, AsyncStreamStarter
+from app.api.streaming import KEEP_ALIVE_EVENT, StreamRelay, error_event
+from app.api.stream_supervisor import (
+    SSE_HEARTBEAT_INTERVAL, StreamSupervisor, STREAM_IDLE_TIMEOUT, record_stream_stats
+)
+from app.api.upstream import OPENROUTER_API_URL, get_async_client, build_upstream_headers, extract_upstream_error
+
+logger = logging.getLogger(__name__)
+
+# Заголовки SSE ответа (те же, что и во Flask-версии)
+SSE_RESPONSE_HEADERS = [
+    (b'content-type', b'text/event-stream; charset=utf-8'),
+    (b'cache-control', b'no-cache'),
+    (b'connection', b'keep-alive'),
+    (b'x-accel-buffering', b'no'),  # Отключаем буферизацию для nginx
+]
+
+
+async def stream_chat_events(payload: dict, model: str, headers: dict, trace: Trace, requested_model: str = None,
+                             on_complete=None):
+    """
+    Асинхронный генератор SSE событий для одного потокового запроса.
+    Отдает ответ из кэша или подключается к одинаковому выполняющемуся потоку, если они есть.
+
+    Args:
+        payload: Готовый payload для OpenRouter (с 'stream': True)
+        model: Запрошенная модель
+        headers: Заголовки запроса к OpenRouter
+        trace: Трасса запроса (фазы потока, request id для события done)
+        requested_model: Модель клиента, если запрос ушел к резервной (возвращается в событии done)
+        on_complete: Вызывается с полным ответом модели, если поток дошел до события done
+
+    Yields:
+        bytes: SSE события для клиента
+    """
+    request_key = cache_key(payload) if RESPONSE_CACHE_ENABLED or SINGLE_FLIGHT_ENABLED else None
+    response_key = request_key if RESPONSE_CACHE_ENABLED else None
+    if response_key:
+        # Дисковый уровень кэша читается с диска - не блокируем event loop
+        cached = await asyncio.to_thread(get_cached_response, response_key)
+        if cached:
+            logger.info(f"Ответ из кэша: модель {cached['model']}")
+            trace.set(cached=True)
+            yield replay_sse(cached, trace.request_id)
+            if on_complete is not None:
+                on_complete(cached['content'])
+            return
+
+    def make_events(complete=None):
+        return _upstream_events(payload, model, headers, trace, response_key, requested_model, complete)
+
+    # Одинаковые одновременные потоки читают один поток к OpenRouter
+    events = (
+        async_stream_single_flight(request_key, make_events, on_complete) if SINGLE_FLIGHT_ENABLED
+        else make_events(on_complete)
+    )
+    try:
+        async for event in events:
+            yield event
+    finally:
+        await events.aclose()
+
+
+async def _upstream_events(payload: dict, model: str, headers: dict, trace: Trace, response_key: str = None,
+                           requested_model: str = None, on_complete=None):
+    """Асинхронный генератор SSE событий одного потокового запроса к OpenRouter"""
+    client = get_async_client()
+    started = time.monotonic()
+    request_payload = with_prompt_caching(payload)
+    starter = None
+    try:
+        # До первого события data ошибки повторяются, медленный ответ может хеджироваться (см. resilience.py);
+        # пока попытки идут, клиент получает keep-alive
+        starter = AsyncStreamStarter(
+            lambda: client.send(
+                client.build_request('POST', OPENROUTER_API_URL, headers=headers, json=request_payload),
+                stream=True
+            ),
+            model
+        )
+        while True:
+            result = await starter.wait(SSE_HEARTBEAT_INTERVAL)
+            if result is not None:
+                break
+            yield KEEP_ALIVE_EVENT
+        kind, response = result
+        trace.mark('upstream_connect')
+        if starter.retries or starter.hedges:
+            trace.set(retries=starter.retries, hedges=starter.hedges)
+
+        if kind == 'circuit_open':
+            metrics.inc('aichat_requests_total', labels=(('endpoint', 'stream'), ('result', 'circuit_open')))
+            trace.fail('circuit_open')
+            yield error_event(CIRCUIT_OPEN_MESSAGE, 503)
+            return
+        if kind in ('timeout', 'network_error'):
+            # Таймаут или ошибка сети после всех повторов
+            record_upstream_failure(model)
+            raise response
+        if kind == 'response':
+            # Обработка ошибок от OpenRouter (тело ответа уже прочитано)
+            metrics.inc('aichat_requests_total', labels=(('endpoint', 'stream'), ('result', 'upstream_error')))
+            trace.fail('upstream_error')
+            record_upstream_failure(model, response.status_code)
+            error_message = extract_upstream_error(
+                response.status_code,
+                response.headers.get('content-type', ''),
+                response.content
+            )
+            yield error_event(error_message, response.status_code)
+            return
+
+        response, first_chunks, rest = response
+        try:
+            relay = StreamRelay(model, request_id=trace.request_id, requested_model=requested_model)
+            supervisor = StreamSupervisor(relay, started=started)
+
+            # Следующая порция байтов читается отдельной задачей: keep-alive, idle-таймаут
+            # и отправка объединенных токенов срабатывают по таймеру, даже если байты не приходят.
+            # aiter_bytes (а не aiter_raw) распаковывает поток, если OpenRouter сожмет его (Accept-Encoding клиента)
+            chunks = _prepend(first_chunks, rest).__aiter__()
+            next_chunk = asyncio.ensure_future(chunks.__anext__())
+            try:
+                while True:
+                    done, _ = await asyncio.wait({next_chunk}, timeout=supervisor.timeout())
+                    if not done:
+                        events = supervisor.on_tick()
+                        if events:
+                            yield events
+                        if supervisor.idle_timed_out:
+                            logger.warning(f"OpenRouter не присылает данные {STREAM_IDLE_TIMEOUT:.0f} сек - поток прерван")
+                            trace.fail('idle_timeout')
+                            yield error_event('Таймаут при запросе к OpenRouter', 504)
+                            return
+                        continue
+
+                    try:
+                        chunk = next_chunk.result()
+                    except StopAsyncIteration:
+                        # Поток закончился без [DONE] - отправляем накопленные токены
+                        tail = relay.flush()
+                        if tail:
+                            yield tail
+                        return
+                    next_chunk = asyncio.ensure_future(chunks.__anext__())
+
+                    if supervisor.ttfb is None:
+                        trace.mark('first_byte')
+
+                    # Все события из порции (с объединенными токенами) отправляем одной записью
+                    events = supervisor.on_chunk(chunk)
+                    if events:
+                        yield events
+
+                    if relay.finished:
+                        trace.mark('stream')
+                        # Финальное событие может обращаться к сети за тарифами - не блокируем event loop
+                        final_event = await asyncio.to_thread(relay.final_event)
+                        trace.mark('cost')
+                        yield final_event
+                        if response_key:
+                            await asyncio.to_thread(
+                                store_response, response_key, relay.accumulated_content,
+                                relay.used_model, relay.finish_reason, relay.cost
+                            )
+                        if on_complete is not None:
+                            on_complete(relay.accumulated_content)
+                        return
+            finally:
+                if not next_chunk.done():
+                    next_chunk.cancel()
+                # Забираем результат задачи чтения (в т.ч. StopAsyncIteration), чтобы asyncio не ругался
+                await asyncio.gather(next_chunk, return_exceptions=True)
+                record_stream_stats(supervisor)
+                record_stream(model, supervisor)
+                trace.set(model=relay.used_model, stalls=supervisor.stalls, **cost_trace_fields(relay.cost))
+        finally:
+            await response.aclose()
+
+    except httpx.TimeoutException:
+        metrics.inc('aichat_requests_total', labels=(('endpoint', 'stream'), ('result', 'timeout')))
+        trace.fail('timeout')
+        yield error_event('Таймаут при запросе к OpenRouter', 504)
+
+    except httpx.ConnectError as e:
+        metrics.inc('aichat_requests_total', labels=(('endpoint', 'stream'), ('result', 'network_error')))
+        trace.fail('network_error')
+        logger.error(f"Ошибка подключения к OpenRouter: {e}")
+        yield error_event(f'Ошибка подключения к OpenRouter: {str(e)}', 503)
+
+    except httpx.HTTPError as e:
+        metrics.inc('aichat_requests_total', labels=(('endpoint', 'stream'), ('result', 'network_error')))
+        trace.fail('network_error')
+        yield error_event(f'Ошибка сети: {str(e)}', 500)
+
+    except Exception as e:
+        yield error_event(f'Внутренняя ошибка сервера: {str(e)}', 500)
+
+    finally:
+        # Клиент ушел, пока попытки еще шли
+        if starter is not None and starter.result is None:
+            await starter.aclose()
+
+
+async def _prepend(first_chunks: list, rest):
+    """Порции, прочитанные при открытии потока, затем остальной поток"""
+    for chunk in first_chunks:
+        yield chunk
+    async for chunk in rest:
+        yield chunk
+
+
+async def _read_body(receive) -> bytes:
+    """Читает тело HTTP запроса из ASGI receive"""
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return b''
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+async def _wait_disconnect(receive):
+    """Ожидает закрытия соединения клиентом"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def _send_json(send, status_code: int, body: bytes, extra_headers: list):
+    await send({
+        'type': 'http.response.start',
+        'status': status_code,
+        'headers': [(b'content-type', b'application/json')] + extra_headers,
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def handle_chat_stream(scope, receive, send):
+    """
+    ASGI обработчик POST /api/chat/stream.
+
+    Принимает и возвращает то же, что и Flask-версия chat_stream() в routes.py.
+    Валидация и сборка payload - общий prepare_request (request_schema.py).
+    """
+    request_headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+    trace = Trace('stream', request_headers.get(REQUEST_ID_HEADER.lower()))
+    try:
+        await _serve_chat_stream(request_headers, receive, send, trace)
+    except Exception:
+        trace.fail('error')
+        raise
+    finally:
+        trace.finish()
+
+
+async def _serve_chat_stream(request_headers: dict, receive, send, trace: Trace):
+    origin = request_headers.get('origin', '')
+
+    # CORS как у flask-cors по умолчанию (preflight OPTIONS обрабатывает Flask)
+    extra_headers = [(b'access-control-allow-origin', b'*')] if origin else []
+    extra_headers.append((REQUEST_ID_HEADER.lower().encode('latin-1'), trace.request_id.encode('latin-1')))
+
+    try:
+        body = await _read_body(receive)
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            data = None
+
+        # Валидация параметров и истории (диалог на сервере может читать SQLite - не блокируем event loop)
+        prepared, error_response = await asyncio.to_thread(prepare_request, data)
+        if error_response:
+            error_json, status_code = error_response
+            trace.fail(f'http_{status_code}')
+            await _send_json(send, status_code, json.dumps(error_json, ensure_ascii=False).encode('utf-8'), extra_headers)
+            return
+        # Модель, которая не укладывается в SLO, заменяется резервной (model_router.py)
+        prepared.route()
+        message, model, conversation = prepared.message, prepared.model, prepared.conversation
+        requested_model = prepared.requested_model if prepared.routed else None
+        trace.mark('validate')
+        trace.set(model=model)
+        if requested_model:
+            trace.set(requested_model=requested_model)
+
+        # Получаем API ключ из переменных окружения
+        api_key = os.environ.get('OPENROUTER_API_KEY')
+        if not api_key:
+            trace.fail('http_500')
+            await _send_json(send, 500, json.dumps({'error': 'API ключ не настроен'}, ensure_ascii=False).encode('utf-8'), extra_headers)
+            return
+
+        # Получаем HTTP Referer (опционально)
+        http_referer = os.environ.get('HTTP_REFERER', origin)
+        headers = build_upstream_headers(api_key, http_referer, trace.request_id)
+
+        # Обрезаем историю под бюджет токенов модели (может загрузить список моделей - не блокируем event loop)
+        history_headers = history_report_headers(await asyncio.to_thread(prepared.fit))
+        history_headers.update(conversation_headers(prepared))
+        payload = prepared.payload(stream=True)
+        trace.mark('history')
+    except Exception as e:
+        trace.fail('http_500')
+        error_body = json.dumps({'error': f'Внутренняя ошибка сервера: {str(e)}'}, ensure_ascii=False).encode('utf-8')
+        await _send_json(send, 500, error_body, extra_headers)
+        return
+
+    # Сжатие потока, как у Flask-версии (compress_response)
+    compressor = None
+    if API_COMPRESSION and API_COMPRESS_SSE:
+        extra_headers.append((b'vary', b'Accept-Encoding'))
+        encoding = choose_encoding(request_headers.get('accept-encoding'))
+        if encoding:
+            compressor = StreamCompressor(encoding)
+            extra_headers.append((b'content-encoding', encoding.encode('latin-1')))
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': SSE_RESPONSE_HEADERS + extra_headers + [
+            (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in history_headers.items()
+        ],
+    })
+
+    # Ответ, который получил клиент, записываем в диалог на сервере
+    recorder = (
+        TurnRecorder(conversation.id, conversation.version, prepared.next_version, message) if conversation else None
+    )
+
+    async def pump():
+        on_complete = recorder.complete if recorder is not None else None
+        tail = b''
+        try:
+            async for event in stream_chat_events(payload, model, headers, trace, requested_model, on_complete):
+                body = compressor.compress(event) if compressor is not None else event
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+            # Записываем ход до конца ответа: после него клиент закрывает соединение и pump отменяется
+            if recorder is not None:
+                await asyncio.to_thread(recorder.commit)
+        except Exception as e:
+            # Отключение клиента сюда не попадает (pump отменяется): это ошибка сервера, клиент получает
+            # событие error, и ответ завершается как обычно
+            logger.exception(f"Ошибка потокового ответа: {e}")
+            metrics.inc('aichat_streams_aborted_total', labels=(('reason', 'error'),))
+            trace.fail('error')
+            tail = error_event(f'Внутренняя ошибка сервера: {str(e)}', 500)
+        if compressor is not None:
+            tail = compressor.compress(tail) + compressor.finish() if tail else compressor.finish()
+        await send({'type': 'http.response.body', 'body': tail, 'more_body': False})
+
+    # Поток к OpenRouter отменяется, как только клиент закрыл соединение
+    metrics.inc('aichat_streams_total')
+    metrics.gauge_add('aichat_active_streams', 1)
+    pump_task = asyncio.ensure_future(pump())
+    disconnect_task = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        done, _ = await asyncio.wait({pump_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        metrics.gauge_add('aichat_active_streams', -1)
+        if compressor is not None:
+            record_stream_compression(compressor)
+        for task in (pump_task, disconnect_task):
+            if not task.done():
+                task.cancel()
+
+    if pump_task in done:
+        exc = pump_task.exception()
+        if exc is not None:
+            # Не удалось отправить конец ответа: соединение уже закрыто
+            metrics.inc('aichat_streams_aborted_total', labels=(('reason', 'client_disconnect'),))
+            trace.fail('client_disconnect')
+            logger.info(f"Соединение закрыто клиентом: {exc}")
+    else:
+        metrics.inc('aichat_streams_aborted_total', labels=(('reason', 'client_disconnect'),))
+        trace.fail('client_disconnect')
+        logger.info("Клиент прервал запрос - соединение закрыто")
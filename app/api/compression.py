@@ -0,0 +1,141 @@
+"""
+Сжатие ответов /api/*: JSON больше порога и SSE потоки.
+
+- JSON (ответ /api/chat, оценка стоимости) сжимается целиком, если он не меньше API_COMPRESS_MIN_SIZE
+- SSE (по умолчанию выключено, API_COMPRESS_SSE=1) сжимается по событиям: после каждой порции
+  компрессор выталкивает данные (Z_SYNC_FLUSH / flush brotli), поэтому клиент получает токены
+  без задержки, а словарь сжатия общий на весь поток - повторяющиеся `data: {"token": ...}`
+  почти ничего не стоят
+- brotli используется, если установлен пакет brotli и клиент его принимает, иначе gzip
+"""
+import os
+import gzip
+import zlib
+
+from flask import request
+
+from app.api import metrics
+from app.static_assets import accepted_encodings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Сжатие ответов API (0 - выключить)
+API_COMPRESSION = os.environ.get('API_COMPRESSION', '1') == '1'
+
+# JSON меньше порога (байт) не сжимается: выигрыш меньше заголовков
+API_COMPRESS_MIN_SIZE = int(os.environ.get('API_COMPRESS_MIN_SIZE', '1024'))
+
+# Сжатие SSE потоков /api/chat/stream (по умолчанию выключено: часть прокси буферизует сжатый поток
+# до конца ответа, и токены перестают приходить по одному)
+API_COMPRESS_SSE = os.environ.get('API_COMPRESS_SSE', '0') == '1'
+
+API_GZIP_LEVEL = int(os.environ.get('API_GZIP_LEVEL', '6'))
+API_BROTLI_QUALITY = int(os.environ.get('API_BROTLI_QUALITY', '5'))
+
+
+def choose_encoding(accept_encoding: str):
+    """'br', 'gzip' или None по заголовку Accept-Encoding клиента"""
+    accepted = accepted_encodings(accept_encoding or '')
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    """Сжимает ответ целиком"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=API_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=API_GZIP_LEVEL, mtime=0)
+
+
+class StreamCompressor:
+    """Сжатие потока: каждая порция сразу выталкивается компрессором, словарь общий на весь поток"""
+
+    __slots__ = ('encoding', 'raw_bytes', 'wire_bytes', '_compressor')
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=API_BROTLI_QUALITY)
+        else:
+            # wbits 16+ - формат gzip (заголовок и CRC), а не голый deflate
+            self._compressor = zlib.compressobj(API_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk: bytes) -> bytes:
+        if self.encoding == 'br':
+            data = self._compressor.process(chunk) + self._compressor.flush()
+        else:
+            data = self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.raw_bytes += len(chunk)
+        self.wire_bytes += len(data)
+        return data
+
+    def finish(self) -> bytes:
+        data = self._compressor.finish() if self.encoding == 'br' else self._compressor.flush()
+        self.wire_bytes += len(data)
+        return data
+
+
+def record_stream_compression(compressor: StreamCompressor) -> None:
+    """Добавляет объем потока до и после сжатия в метрики (один раз на поток)"""
+    labels = (('encoding', compressor.encoding), ('kind', 'sse'))
+    metrics.inc('aichat_compression_bytes_total', compressor.raw_bytes, labels + (('stage', 'raw'),))
+    metrics.inc('aichat_compression_bytes_total', compressor.wire_bytes, labels + (('stage', 'wire'),))
+
+
+def _compress_stream(chunks, compressor: StreamCompressor):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if chunk:
+                yield compressor.compress(chunk)
+        yield compressor.finish()
+    finally:
+        # Закрываем исходный генератор (клиент мог уйти посреди потока)
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+        record_stream_compression(compressor)
+
+
+def compress_response(response):
+    """after_request: сжимает JSON ответы больше порога и SSE потоки, если клиент принимает gzip/br"""
+    if not API_COMPRESSION or response.status_code in (204, 304) or 'Content-Encoding' in response.headers:
+        return response
+
+    mimetype = response.mimetype
+    if mimetype == 'text/event-stream':
+        if not API_COMPRESS_SSE or not response.is_streamed:
+            return response
+    elif mimetype != 'application/json' or response.is_streamed:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+
+    if mimetype == 'text/event-stream':
+        response.response = _compress_stream(response.response, StreamCompressor(encoding))
+        response.headers.pop('Content-Length', None)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    body = response.get_data()
+    if len(body) < API_COMPRESS_MIN_SIZE:
+        return response
+    compressed = compress_body(body, encoding)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    labels = (('encoding', encoding), ('kind', 'json'))
+    metrics.inc('aichat_compression_bytes_total', len(body), labels + (('stage', 'raw'),))
+    metrics.inc('aichat_compression_bytes_total', len(compressed), labels + (('stage', 'wire'),))
+    return response
@@ -0,0 +1,369 @@
+"""
+Хранилище диалогов на сервере: клиент отправляет только новое сообщение, id и версию диалога.
+
+- Диалог - это проверенная история (role/content) с оценками токенов каждого сообщения,
+  поэтому на каждый ход история не загружается, не валидируется и не считается заново
+- Ходы только добавляются (append-only); при каждом изменении диалог получает новую версию -
+  случайный токен сервера, поэтому одна и та же версия в разных воркерах означает одну и ту же историю
+- id диалога выдает сервер (uuid4); id, которого сервер не знает, не принимается - создается новый диалог
+- Если версия клиента не совпадает с версией на сервере (другая вкладка, перезапуск, обрыв потока),
+  сервер отвечает 409 и клиент один раз отправляет историю целиком (пересинхронизация)
+- Память процесса: LRU на CONVERSATION_STORE_MAX диалогов
+- SQLite (CONVERSATION_STORE_PATH, по умолчанию /data/conversations.sqlite3, если есть /data):
+  диалог доступен всем воркерам и переживает перезапуск. Без общего хранилища при нескольких воркерах
+  (AICHAT_WORKERS, задает gunicorn.conf.py) режим диалога выключен: запросы отправляют историю целиком
+"""
+import os
+import time
+import uuid
+import secrets
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+from app.api.cost_calculator import count_message_tokens
+
+logger = logging.getLogger(__name__)
+
+# Сколько диалогов держать в памяти процесса
+CONVERSATION_STORE_MAX = int(os.environ.get('CONVERSATION_STORE_MAX', '1000'))
+
+# Файл SQLite для общего хранения диалогов (по умолчанию в persistenceMount /data, если он есть;
+# пусто - только память процесса)
+CONVERSATION_STORE_PATH = os.environ.get(
+    'CONVERSATION_STORE_PATH',
+    '/data/conversations.sqlite3' if os.path.isdir('/data') else ''
+)
+
+# Воркеров, обслуживающих приложение (gunicorn.conf.py передает их число воркерам)
+_WORKERS = int(os.environ.get('AICHAT_WORKERS', '1'))
+
+# Диалог в памяти одного воркера не виден остальным: без общего хранилища режим диалога - только для одного воркера
+CONVERSATIONS_ENABLED = bool(CONVERSATION_STORE_PATH) or _WORKERS <= 1
+if not CONVERSATIONS_ENABLED:
+    logger.warning(
+        f"Режим диалога выключен: {_WORKERS} воркеров без общего хранилища (задайте CONVERSATION_STORE_PATH)"
+    )
+
+# Сколько секунд хранить неактивный диалог в SQLite
+CONVERSATION_RETENTION = float(os.environ.get('CONVERSATION_RETENTION', str(30 * 24 * 3600)))
+
+# Чистка старых диалогов в SQLite раз в столько записей
+_PRUNE_EVERY = 256
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS turns (
+    conversation_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    PRIMARY KEY (conversation_id, seq)
+);
+"""
+
+
+class Conversation:
+    """Проверенная история диалога и оценки токенов ее сообщений"""
+
+    __slots__ = ('id', 'version', 'messages', 'token_counts', 'updated_at')
+
+    def __init__(self, conversation_id: str, version: str, messages: list, token_counts: list):
+        self.id = conversation_id
+        self.version = version
+        # Сообщения уже проверены: {'role': 'user'|'assistant', 'content': str}
+        self.messages = messages
+        self.token_counts = token_counts
+        self.updated_at = time.time()
+
+
+# id -> Conversation (LRU)
+_memory = OrderedDict()
+_lock = threading.Lock()
+_writes = 0
+
+_stats = {
+    'hits': 0,
+    'misses': 0,
+    'conflicts': 0,
+    'seeded': 0,
+    'turns_appended': 0,
+    'loaded_from_store': 0,
+    'evictions': 0,
+}
+
+
+def new_version() -> str:
+    """Новая версия диалога: случайный токен, одинаковый во всех воркерах только для одной и той же истории"""
+    return secrets.token_hex(8)
+
+
+def _connect() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(CONVERSATION_STORE_PATH) or '.', exist_ok=True)
+    conn = sqlite3.connect(CONVERSATION_STORE_PATH, timeout=10, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def _remember(conversation: Conversation) -> None:
+    """Кладет диалог в память и вытесняет давно не использованные (под _lock)"""
+    _memory[conversation.id] = conversation
+    _memory.move_to_end(conversation.id)
+    while len(_memory) > CONVERSATION_STORE_MAX:
+        _memory.popitem(last=False)
+        _stats['evictions'] += 1
+
+
+def _load(conversation_id: str):
+    """Читает диалог из SQLite (None, если его нет или хранилище недоступно)"""
+    try:
+        conn = _connect()
+        try:
+            conn.execute('BEGIN')
+            row = conn.execute('SELECT version FROM conversations WHERE id = ?', (conversation_id,)).fetchone()
+            turns = conn.execute(
+                'SELECT role, content, tokens FROM turns WHERE conversation_id = ? ORDER BY seq',
+                (conversation_id,)
+            ).fetchall() if row else []
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Хранилище диалогов {CONVERSATION_STORE_PATH} недоступно: {e}")
+        return None
+    if row is None:
+        return None
+    return Conversation(
+        conversation_id,
+        row[0],
+        [{'role': role, 'content': content} for role, content, _ in turns],
+        [tokens for _, _, tokens in turns]
+    )
+
+
+def _write(conversation_id: str, base_version, version: str, messages: list, token_counts: list, start: int):
+    """
+    Записывает сообщения с позиции start и новую версию диалога в SQLite.
+    base_version=None - замена диалога целиком (пересинхронизация);
+    иначе версия в хранилище должна совпасть с base_version.
+
+    Returns:
+        bool: Записано ли (False, если диалог в хранилище уже изменился)
+    """
+    global _writes
+    try:
+        conn = _connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT version FROM conversations WHERE id = ?', (conversation_id,)).fetchone()
+            if base_version is not None and (row is None or row[0] != base_version):
+                conn.execute('COMMIT')
+                return False
+            conn.execute('DELETE FROM turns WHERE conversation_id = ? AND seq >= ?', (conversation_id, start))
+            conn.executemany(
+                'INSERT INTO turns (conversation_id, seq, role, content, tokens) VALUES (?, ?, ?, ?, ?)',
+                [
+                    (conversation_id, start + i, message['role'], message['content'], tokens)
+                    for i, (message, tokens) in enumerate(zip(messages[start:], token_counts[start:]))
+                ]
+            )
+            conn.execute(
+                'INSERT OR REPLACE INTO conversations (id, version, length, updated_at) VALUES (?, ?, ?, ?)',
+                (conversation_id, version, len(messages), time.time())
+            )
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        # Диалог остается в памяти процесса
+        logger.warning(f"Не удалось сохранить диалог в {CONVERSATION_STORE_PATH}: {e}")
+        return True
+
+    with _lock:
+        _writes += 1
+        prune = _writes % _PRUNE_EVERY == 0
+    if prune:
+        _prune()
+    return True
+
+
+def _prune() -> None:
+    """Удаляет из SQLite диалоги, неактивные дольше CONVERSATION_RETENTION"""
+    cutoff = time.time() - CONVERSATION_RETENTION
+    try:
+        conn = _connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'DELETE FROM turns WHERE conversation_id IN (SELECT id FROM conversations WHERE updated_at < ?)',
+                (cutoff,)
+            )
+            conn.execute('DELETE FROM conversations WHERE updated_at < ?', (cutoff,))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Не удалось очистить хранилище диалогов: {e}")
+
+
+def _find(conversation_id: str):
+    """Диалог из памяти или из SQLite (None, если сервер его не знает)"""
+    with _lock:
+        conversation = _memory.get(conversation_id)
+    if conversation is None and CONVERSATION_STORE_PATH:
+        conversation = _load(conversation_id)
+    return conversation
+
+
+def get_conversation(conversation_id: str, version: str):
+    """
+    Возвращает диалог, если его версия совпадает с версией клиента.
+
+    Returns:
+        tuple: (Conversation или None, актуальная версия на сервере или None, если диалог не найден)
+    """
+    with _lock:
+        conversation = _memory.get(conversation_id)
+        if conversation is not None:
+            _memory.move_to_end(conversation_id)
+
+    # В памяти нет или устаревшая копия (диалог продолжился в другом воркере)
+    if CONVERSATION_STORE_PATH and (conversation is None or conversation.version != version):
+        stored = _load(conversation_id)
+        if stored is not None:
+            conversation = stored
+            with _lock:
+                _remember(conversation)
+                _stats['loaded_from_store'] += 1
+
+    with _lock:
+        if conversation is None:
+            _stats['misses'] += 1
+            return None, None
+        if conversation.version != version:
+            _stats['conflicts'] += 1
+            return None, conversation.version
+        _stats['hits'] += 1
+    return conversation, conversation.version
+
+
+def seed_conversation(conversation_id: str, history: list) -> Conversation:
+    """
+    Создает диалог (или заменяет его историю при пересинхронизации) из проверенной истории клиента.
+
+    Args:
+        conversation_id: id диалога, который выдал сервер, или None для нового диалога.
+                         Неизвестный серверу id не используется: создается диалог с новым id
+        history: Проверенные сообщения [{'role': ..., 'content': ...}]
+    """
+    if not conversation_id or _find(conversation_id) is None:
+        conversation_id = uuid.uuid4().hex
+
+    token_counts = [count_message_tokens(message['content']) for message in history]
+    conversation = Conversation(conversation_id, new_version(), list(history), token_counts)
+    if CONVERSATION_STORE_PATH:
+        _write(conversation_id, None, conversation.version, conversation.messages, token_counts, 0)
+
+    with _lock:
+        _remember(conversation)
+        _stats['seeded'] += 1
+    return conversation
+
+
+def append_turn(conversation_id: str, base_version: str, user_content: str, assistant_content: str,
+                version: str = None):
+    """
+    Добавляет в диалог завершенный ход (сообщение пользователя и ответ модели).
+
+    Args:
+        version: Новая версия, заранее выданная клиенту (X-Conversation-Next-Version), или None - выдать сейчас
+
+    Returns:
+        str: Новая версия диалога или None, если диалог изменился с base_version (ход не записан)
+    """
+    with _lock:
+        conversation = _memory.get(conversation_id)
+    if conversation is None or conversation.version != base_version:
+        if CONVERSATION_STORE_PATH:
+            conversation = _load(conversation_id)
+        if conversation is None or conversation.version != base_version:
+            with _lock:
+                _stats['conflicts'] += 1
+            return None
+
+    messages = conversation.messages + [
+        {'role': 'user', 'content': user_content},
+        {'role': 'assistant', 'content': assistant_content}
+    ]
+    token_counts = conversation.token_counts + [
+        count_message_tokens(user_content), count_message_tokens(assistant_content)
+    ]
+    updated = Conversation(conversation_id, version or new_version(), messages, token_counts)
+    if CONVERSATION_STORE_PATH and not _write(
+        conversation_id, base_version, updated.version, messages, token_counts, len(conversation.messages)
+    ):
+        with _lock:
+            _stats['conflicts'] += 1
+        return None
+
+    with _lock:
+        current = _memory.get(conversation_id)
+        if current is not None and current.version != base_version:
+            _stats['conflicts'] += 1
+            return None
+        _remember(updated)
+        _stats['turns_appended'] += 1
+    return updated.version
+
+
+class TurnRecorder:
+    """
+    Записывает ход в диалог, когда поток завершился событием done. Ответ модели передает источник
+    событий (накопленный текст StreamRelay, ответ из кэша или общего потока single-flight) через complete().
+    """
+
+    __slots__ = ('conversation_id', 'base_version', 'version', 'message', 'content')
+
+    def __init__(self, conversation_id: str, base_version: str, version: str, message: str):
+        self.conversation_id = conversation_id
+        self.base_version = base_version
+        # Версия после записи хода (уже отправлена клиенту в X-Conversation-Next-Version)
+        self.version = version
+        self.message = message
+        # Полный ответ модели; None - поток не дошел до done (ошибка, обрыв)
+        self.content = None
+
+    def complete(self, content: str) -> None:
+        """Поток дошел до события done с ответом content"""
+        self.content = content
+
+    def commit(self):
+        """Записывает ход, если поток завершился событием done. Возвращает новую версию или None"""
+        if self.content is None:
+            return None
+        return append_turn(self.conversation_id, self.base_version, self.message, self.content, self.version)
+
+
+def get_conversation_stats() -> dict:
+    """
+    Статистика хранилища диалогов текущего воркера.
+
+    Returns:
+        dict: {'conversations': int, 'hits': int, 'misses': int, 'conflicts': int, 'seeded': int,
+               'turns_appended': int, 'loaded_from_store': int, 'evictions': int, ...}
+    """
+    with _lock:
+        stats = dict(_stats)
+        stats['conversations'] = len(_memory)
+    stats['max_conversations'] = CONVERSATION_STORE_MAX
+    stats['enabled'] = CONVERSATIONS_ENABLED
+    stats['store_path'] = CONVERSATION_STORE_PATH or None
+    return stats
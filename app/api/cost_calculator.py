@@ -1,18 +1,21 @@
 """
 Утилита для расчета стоимости запросов к OpenRouter API
 """
-import requests
+import os
 import logging
+import hashlib
+import threading
+from collections import OrderedDict
+
+from app.api import metrics
+from app.config.prompt_loader import find_prompt_variant, get_prompt_snapshot
+from app.api.pricing_registry import (
+    get_pricing_stats, get_pricing_version, lookup_model, lookup_models, start_pricing_refresher
+)
 
 # Курс доллара к рублю
 USD_TO_RUB = 110.0
 
-# URL для получения списка моделей и их тарифов
-MODELS_API_URL = "https://openrouter.ai/api/v1/models"
-
-# Кэш для тарифов моделей (чтобы не запрашивать каждый раз)
-_model_pricing_cache = {}
-
 # Коэффициенты для оценки токенов
 # Примерное соотношение: для русского языка ~2-2.5 символа на токен, для английского ~3-4 символа
 # Используем консервативное значение 2.5 для смешанного контента
@@ -23,10 +26,26 @@ DEFAULT_CHARS_PER_TOKEN = 2.7  # усреднённое значение для
 # Средняя оценка выходных токенов (если max_tokens не задан)
 DEFAULT_COMPLETION_TOKENS = 400  # средний ответ ассистента
 
+# Файл токенизатора (tokenizer.json формата HuggingFace) для точного подсчета токенов (опционально)
+TOKENIZER_VOCAB_FILE = os.environ.get('TOKENIZER_VOCAB_FILE', '')
+
+# Токенизатор загружается лениво при первой оценке
+_tokenizer = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+
+# Размер кэша оценок токенов сообщений (записей)
+TOKEN_COUNT_CACHE_SIZE = int(os.environ.get('TOKEN_COUNT_CACHE_SIZE', '8192'))
+
+# Оценки токенов сообщений: хэш текста -> количество (LRU)
+_token_count_cache = OrderedDict()
+_token_count_stats = {'hits': 0, 'misses': 0}
+_token_count_lock = threading.Lock()
+
 
 def get_model_pricing(model_id: str) -> dict:
     """
-    Получает тарифы для модели из OpenRouter API
+    Получает тарифы для модели из реестра тарифов (снимок списка моделей OpenRouter)
     
     Args:
         model_id: ID модели (например, 'anthropic/claude-sonnet-4.5')
@@ -35,71 +54,30 @@ def get_model_pricing(model_id: str) -> dict:
         dict: Словарь с тарифами {'prompt': float, 'completion': float, 'request': float}
               или None если тарифы не найдены
     """
-    # Проверяем кэш
-    if model_id in _model_pricing_cache:
-        return _model_pricing_cache[model_id]
-    
-    try:
-        models_response = requests.get(MODELS_API_URL, timeout=30)
-        if models_response.status_code == 200:
-            models_data = models_response.json()
-            
-            # Ищем тарифы для используемой модели
-            model_pricing = None
-            for model in models_data.get('data', []):
-                if model.get('id') == model_id or model.get('canonical_slug') == model_id:
-                    pricing = model.get('pricing')
-                    if pricing:
-                        model_pricing = {
-                            'prompt': float(pricing.get('prompt', '0')),
-                            'completion': float(pricing.get('completion', '0')),
-                            'request': float(pricing.get('request', '0'))
-                        }
-                    break
-            
-            # Сохраняем в кэш
-            if model_pricing:
-                _model_pricing_cache[model_id] = model_pricing
-            
-            return model_pricing
-        else:
-            logging.warning(f"Не удалось получить список моделей: HTTP {models_response.status_code}")
-            return None
-    except Exception as e:
-        logging.warning(f"Ошибка при получении тарифов: {str(e)}")
-        return None
+    return lookup_model(model_id)
 
 
+def get_model_context_length(model_id: str) -> int:
+    """
+    Возвращает размер контекстного окна модели (в токенах) из списка моделей OpenRouter.
+    
+    Returns:
+        int: context_length или None если модель не найдена
+    """
+    entry = lookup_model(model_id)
+    return entry['context_length'] if entry else None
+
 
 def warm_pricing_cache() -> int:
-    global _model_pricing_cache
-    try:
-        models_response = requests.get(MODELS_API_URL, timeout=30)
-        if models_response.status_code != 200:
-            logging.warning("warm_pricing_cache: models list HTTP %s", models_response.status_code)
-            return 0
-        models_data = models_response.json()
-        loaded = 0
-        for model in models_data.get('data', []):
-            model_id = model.get('id') or model.get('canonical_slug')
-            pricing = model.get('pricing')
-            if not model_id or not pricing:
-                continue
-            entry = {
-                'prompt': float(pricing.get('prompt', '0')),
-                'completion': float(pricing.get('completion', '0')),
-                'request': float(pricing.get('request', '0')),
-            }
-            _model_pricing_cache[model_id] = entry
-            slug = model.get('canonical_slug')
-            if slug and slug != model_id:
-                _model_pricing_cache[slug] = entry
-            loaded += 1
-        logging.info("warm_pricing_cache: loaded pricing for %s models", loaded)
-        return loaded
-    except Exception as e:
-        logging.warning("warm_pricing_cache failed: %s", e)
-        return 0
+    """
+    Загружает снимок тарифов (с диска или из OpenRouter) и запускает его фоновое обновление.
+    
+    Returns:
+        int: Количество моделей в снимке
+    """
+    start_pricing_refresher()
+    return get_pricing_stats()['models']
+
 
 def calculate_cost_rub(response_data: dict, model_id: str = None) -> dict:
     """
@@ -115,11 +93,15 @@ def calculate_cost_rub(response_data: dict, model_id: str = None) -> dict:
             'prompt_tokens': int,
             'completion_tokens': int,
             'total_tokens': int,
+            'cached_tokens': int,  # входные токены, прочитанные из кэша промпта
+            'cache_write_tokens': int,  # входные токены, записанные в кэш промпта
             'cost_breakdown': {
                 'prompt_cost_rub': float,
                 'completion_cost_rub': float,
-                'request_cost_rub': float
-            }
+                'request_cost_rub': float,
+                'cache_savings_rub': float  # экономия за счет кэша промпта
+            },
+            'pricing_version': int  # версия снимка тарифов
         } или None если не удалось рассчитать
     """
     # Получаем информацию об использовании токенов
@@ -143,11 +125,29 @@ def calculate_cost_rub(response_data: dict, model_id: str = None) -> dict:
     if not pricing:
         return None
     
+    # Токены, прочитанные из кэша промпта и записанные в него, тарифицируются отдельно
+    prompt_details = usage.get('prompt_tokens_details') or {}
+    cached_tokens = prompt_details.get('cached_tokens') or 0
+    cache_write_tokens = prompt_details.get('cache_write_tokens') or 0
+    uncached_tokens = max(prompt_tokens - cached_tokens - cache_write_tokens, 0)
+    cache_read_price = pricing.get('input_cache_read')
+    cache_write_price = pricing.get('input_cache_write')
+    if cache_read_price is None:
+        cache_read_price = pricing['prompt']
+    if cache_write_price is None:
+        cache_write_price = pricing['prompt']
+    
     # Вычисляем стоимость в USD
-    prompt_cost_usd = prompt_tokens * pricing['prompt']
+    prompt_cost_usd = (
+        uncached_tokens * pricing['prompt']
+        + cached_tokens * cache_read_price
+        + cache_write_tokens * cache_write_price
+    )
     completion_cost_usd = completion_tokens * pricing['completion']
     request_cost_usd = pricing['request']
     total_cost_usd = prompt_cost_usd + completion_cost_usd + request_cost_usd
+    # Экономия относительно цены без кэша (отрицательна, если запись в кэш дороже чтения)
+    cache_savings_usd = prompt_tokens * pricing['prompt'] - prompt_cost_usd
     
     # Конвертируем в рубли
     prompt_cost_rub = prompt_cost_usd * USD_TO_RUB
@@ -161,22 +161,94 @@ def calculate_cost_rub(response_data: dict, model_id: str = None) -> dict:
     request_cost_rub = round(request_cost_rub, 2)
     total_cost_rub = round(total_cost_rub, 2)
     
+    metrics.inc('aichat_tokens_total', uncached_tokens + cache_write_tokens, (('direction', 'prompt'),))
+    metrics.inc('aichat_tokens_total', cached_tokens, (('direction', 'cached'),))
+    metrics.inc('aichat_tokens_total', completion_tokens, (('direction', 'completion'),))
+    metrics.inc('aichat_cost_rub_total', total_cost_usd * USD_TO_RUB, (('model', model_id),))
+    
     return {
         'total_cost_rub': total_cost_rub,
         'prompt_tokens': prompt_tokens,
         'completion_tokens': completion_tokens,
         'total_tokens': total_tokens,
+        'cached_tokens': cached_tokens,
+        'cache_write_tokens': cache_write_tokens,
         'cost_breakdown': {
             'prompt_cost_rub': prompt_cost_rub,
             'completion_cost_rub': completion_cost_rub,
-            'request_cost_rub': request_cost_rub
-        }
+            'request_cost_rub': request_cost_rub,
+            'cache_savings_rub': round(cache_savings_usd * USD_TO_RUB, 2)
+        },
+        'pricing_version': get_pricing_version()
     }
 
 
-def estimate_token_count(text: str) -> int:
+def cost_summary(cost_info: dict) -> dict:
     """
-    Оценивает количество токенов в тексте на основе приблизительного соотношения.
+    Краткая стоимость для клиента (поле cost в ответе /api/chat и в событии done).
+    Токены кэша промпта добавляются, только если кэш сработал.
+    """
+    summary = {
+        'total_cost_rub': cost_info['total_cost_rub'],
+        'prompt_tokens': cost_info['prompt_tokens'],
+        'completion_tokens': cost_info['completion_tokens'],
+        'total_tokens': cost_info['total_tokens']
+    }
+    if cost_info.get('cached_tokens') or cost_info.get('cache_write_tokens'):
+        summary['cached_tokens'] = cost_info['cached_tokens']
+        summary['cache_savings_rub'] = cost_info['cost_breakdown']['cache_savings_rub']
+    return summary
+
+
+def cost_trace_fields(cost: dict) -> dict:
+    """Токены и стоимость ответа для трассы запроса (поля cost_summary или calculate_cost_rub)"""
+    if not cost:
+        return {}
+    return {
+        'prompt_tokens': cost['prompt_tokens'],
+        'completion_tokens': cost['completion_tokens'],
+        'cost_rub': cost['total_cost_rub']
+    }
+
+
+def _load_tokenizer():
+    """
+    Загружает локальный токенизатор (tokenizer.json формата HuggingFace) из TOKENIZER_VOCAB_FILE.
+    Нужен пакет tokenizers; без него или без файла используется эвристическая оценка.
+    """
+    global _tokenizer, _tokenizer_loaded
+    with _tokenizer_lock:
+        if _tokenizer_loaded:
+            return _tokenizer
+        _tokenizer_loaded = True
+        if not TOKENIZER_VOCAB_FILE:
+            return None
+        try:
+            from tokenizers import Tokenizer
+            _tokenizer = Tokenizer.from_file(TOKENIZER_VOCAB_FILE)
+            logging.info(f"Загружен токенизатор для оценки токенов: {TOKENIZER_VOCAB_FILE}")
+        except ImportError:
+            logging.warning("TOKENIZER_VOCAB_FILE задан, но пакет tokenizers не установлен - используется эвристика")
+        except Exception as e:
+            logging.warning(f"Не удалось загрузить токенизатор {TOKENIZER_VOCAB_FILE}: {e} - используется эвристика")
+        return _tokenizer
+
+
+def count_cyrillic(text: str) -> int:
+    """
+    Количество символов кириллицы (U+0400-U+04FF) в тексте.
+    В UTF-8 эти символы - ровно двухбайтовые последовательности с первым байтом 0xD0-0xD3,
+    поэтому считаем байты встроенным bytes.count вместо цикла по символам.
+    """
+    if text.isascii():
+        return 0
+    data = text.encode('utf-8', 'surrogatepass')
+    return data.count(b'\xd0') + data.count(b'\xd1') + data.count(b'\xd2') + data.count(b'\xd3')
+
+
+def heuristic_token_count(text: str) -> int:
+    """
+    Эвристическая оценка количества токенов по соотношению символов к токенам.
     
     Args:
         text: Текст для оценки
@@ -189,12 +261,9 @@ def estimate_token_count(text: str) -> int:
     
     # Определяем соотношение символов к токенам на основе языка
     # Простая эвристика: если много кириллицы, используем коэффициент для русского
-    cyrillic_count = sum(1 for char in text if '\u0400' <= char <= '\u04FF')
+    cyrillic_count = count_cyrillic(text)
     total_chars = len(text)
     
-    if total_chars == 0:
-        return 0
-    
     # Если больше 30% кириллицы - используем коэффициент для русского
     if cyrillic_count / total_chars > 0.3:
         chars_per_token = CHARS_PER_TOKEN_RU
@@ -210,11 +279,90 @@ def estimate_token_count(text: str) -> int:
     return max(estimated_tokens, estimated_by_chars)
 
 
+def estimate_token_count(text: str) -> int:
+    """
+    Оценивает количество токенов в тексте: локальным токенизатором (если задан TOKENIZER_VOCAB_FILE)
+    или эвристикой по соотношению символов к токенам.
+    
+    Args:
+        text: Текст для оценки
+    
+    Returns:
+        int: Приблизительное количество токенов
+    """
+    if not text:
+        return 0
+    
+    tokenizer = _tokenizer if _tokenizer_loaded else _load_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+    
+    return heuristic_token_count(text)
+
+
+def _token_count_key(text: str) -> bytes:
+    # Ключ - хэш содержимого: кэш не держит в памяти сами (возможно длинные) тексты сообщений
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+def count_message_tokens(text: str) -> int:
+    """
+    Оценка токенов с мемоизацией по хэшу содержимого: сообщения истории и системный промпт
+    приходят в каждом запросе диалога, поэтому оценивается только новый текст.
+    """
+    if not text:
+        return 0
+    
+    # Варианты системного промпта посчитаны при загрузке реестра промптов
+    variant = find_prompt_variant(text)
+    if variant is not None:
+        with _token_count_lock:
+            _token_count_stats['hits'] += 1
+        return variant.tokens
+    
+    key = _token_count_key(text)
+    with _token_count_lock:
+        count = _token_count_cache.get(key)
+        if count is not None:
+            _token_count_cache.move_to_end(key)
+            _token_count_stats['hits'] += 1
+            return count
+        _token_count_stats['misses'] += 1
+    
+    count = estimate_token_count(text)
+    with _token_count_lock:
+        _token_count_cache[key] = count
+        if len(_token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+            _token_count_cache.popitem(last=False)
+    return count
+
+
+def get_token_count_stats() -> dict:
+    """
+    Статистика кэша оценок токенов.
+    
+    Returns:
+        dict: {'hits': int, 'misses': int, 'hit_rate': float, 'size': int, 'max_size': int, 'prompt_variants': int}
+    """
+    with _token_count_lock:
+        hits = _token_count_stats['hits']
+        misses = _token_count_stats['misses']
+        size = len(_token_count_cache)
+    lookups = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / lookups, 3) if lookups else 0.0,
+        'size': size,
+        'max_size': TOKEN_COUNT_CACHE_SIZE,
+        'prompt_variants': len(get_prompt_snapshot().by_text)
+    }
+
+
 def estimate_cost_rub(
     message: str,
     model_id: str,
-    history: list = None,
-    system_prompt: str = None,
+    prompt_tokens: int,
     max_tokens: int = None
 ) -> dict:
     """
@@ -223,8 +371,8 @@ def estimate_cost_rub(
     Args:
         message: Текст запроса пользователя
         model_id: ID модели для запроса
-        history: История сообщений (список dict с 'role' и 'content')
-        system_prompt: Системный промпт (если используется)
+        prompt_tokens: Оценка входных токенов (PreparedRequest.prompt_tokens: системный промпт,
+                       история после обрезки и сообщение)
         max_tokens: Максимальное количество токенов для ответа (если задано)
     
     Returns:
@@ -232,7 +380,8 @@ def estimate_cost_rub(
             'estimated_cost_rub': float,  # Оценка стоимости в рублях
             'estimated_prompt_tokens': int,
             'estimated_completion_tokens': int,
-            'estimated_total_tokens': int
+            'estimated_total_tokens': int,
+            'pricing_version': int  # версия снимка тарифов
         } или None если не удалось оценить
     """
     if not message or not model_id:
@@ -243,48 +392,96 @@ def estimate_cost_rub(
     if not pricing:
         return None
     
-    # Оцениваем токены входных данных
-    prompt_tokens = 0
-    
-    # Системный промпт
-    if system_prompt:
-        prompt_tokens += estimate_token_count(system_prompt)
-    
-    # История сообщений
-    if history:
-        for msg in history:
-            if isinstance(msg, dict):
-                content = msg.get('content', '')
-                if content:
-                    prompt_tokens += estimate_token_count(content)
-                    # Добавляем небольшой overhead на метаданные (role и форматирование)
-                    prompt_tokens += 4
+    completion_tokens = estimate_completion_tokens(max_tokens)
     
-    # Текущее сообщение пользователя
-    prompt_tokens += estimate_token_count(message)
-    prompt_tokens += 4  # overhead на метаданные
-    
-    # Оцениваем выходные токены
+    return {
+        'estimated_cost_rub': price_tokens_rub(pricing, prompt_tokens, completion_tokens)['total_cost_rub'],
+        'estimated_prompt_tokens': prompt_tokens,
+        'estimated_completion_tokens': completion_tokens,
+        'estimated_total_tokens': prompt_tokens + completion_tokens,
+        'pricing_version': get_pricing_version()
+    }
+
+
+def estimate_completion_tokens(max_tokens: int = None) -> int:
+    """Оценка выходных токенов: max_tokens, если задан, иначе средний ответ"""
     if max_tokens and max_tokens > 0:
-        completion_tokens = max_tokens
-    else:
-        completion_tokens = DEFAULT_COMPLETION_TOKENS
-    
-    total_tokens = prompt_tokens + completion_tokens
+        return max_tokens
+    return DEFAULT_COMPLETION_TOKENS
+
+
+def price_tokens_rub(pricing: dict, prompt_tokens: int, completion_tokens: int) -> dict:
+    """
+    Стоимость токенов по тарифам модели в рублях с округлением до копеек.
     
-    # Рассчитываем стоимость в USD
+    Returns:
+        dict: {'total_cost_rub': float, 'prompt_cost_rub': float, 'completion_cost_rub': float,
+               'request_cost_rub': float}
+    """
     prompt_cost_usd = prompt_tokens * pricing['prompt']
     completion_cost_usd = completion_tokens * pricing['completion']
     request_cost_usd = pricing['request']
     total_cost_usd = prompt_cost_usd + completion_cost_usd + request_cost_usd
+    return {
+        'total_cost_rub': round(total_cost_usd * USD_TO_RUB, 2),
+        'prompt_cost_rub': round(prompt_cost_usd * USD_TO_RUB, 2),
+        'completion_cost_rub': round(completion_cost_usd * USD_TO_RUB, 2),
+        'request_cost_rub': round(request_cost_usd * USD_TO_RUB, 2)
+    }
+
+
+def estimate_costs_rub(
+    model_ids: list,
+    prompt_tokens: int,
+    max_tokens: int = None,
+    model_prompt_tokens: dict = None
+) -> dict:
+    """
+    Оценивает стоимость одного запроса сразу для нескольких моделей.
+    Токены считаются один раз, для каждой модели применяются только ее тарифы из одного снимка.
     
-    # Конвертируем в рубли и округляем до копеек
-    estimated_cost_rub = round(total_cost_usd * USD_TO_RUB, 2)
+    Args:
+        model_ids: ID моделей
+        prompt_tokens: Оценка входных токенов без обрезки истории (PreparedRequest.prompt_tokens())
+        max_tokens: Максимальное количество токенов для ответа (если задано)
+        model_prompt_tokens: Входные токены после обрезки истории под контекст каждой модели
+                             ({model_id: int}); модель без записи считается по prompt_tokens
+    
+    Returns:
+        dict: {
+            'estimated_prompt_tokens': int,
+            'estimated_completion_tokens': int,
+            'estimated_total_tokens': int,
+            'pricing_version': int,
+            'costs': {model_id: {'estimated_cost_rub': float, 'prompt_cost_rub': float,
+                                 'completion_cost_rub': float, 'request_cost_rub': float,
+                                 'estimated_prompt_tokens': int} или None}
+        }
+    """
+    completion_tokens = estimate_completion_tokens(max_tokens)
+    model_prompt_tokens = model_prompt_tokens or {}
+    
+    pricings, pricing_version = lookup_models(model_ids)
+    costs = {}
+    for model_id, pricing in pricings.items():
+        if not pricing:
+            costs[model_id] = None
+            continue
+        tokens = model_prompt_tokens.get(model_id, prompt_tokens)
+        cost = price_tokens_rub(pricing, tokens, completion_tokens)
+        costs[model_id] = {
+            'estimated_cost_rub': cost['total_cost_rub'],
+            'prompt_cost_rub': cost['prompt_cost_rub'],
+            'completion_cost_rub': cost['completion_cost_rub'],
+            'request_cost_rub': cost['request_cost_rub'],
+            'estimated_prompt_tokens': tokens
+        }
     
     return {
-        'estimated_cost_rub': estimated_cost_rub,
         'estimated_prompt_tokens': prompt_tokens,
         'estimated_completion_tokens': completion_tokens,
-        'estimated_total_tokens': total_tokens
+        'estimated_total_tokens': prompt_tokens + completion_tokens,
+        'pricing_version': pricing_version,
+        'costs': costs
     }
 
@@ -0,0 +1,122 @@
+"""
+Обрезка истории диалога под бюджет токенов модели.
+
+Вместо фиксированных последних 50 сообщений в запрос попадает столько последних сообщений,
+сколько помещается в контекст модели (context_length из списка моделей OpenRouter) за вычетом
+системного промпта, текущего сообщения и резерва под ответ (max_tokens).
+
+Токены сообщений считаются один раз при подготовке запроса (PreparedRequest в request_schema.py),
+с мемоизацией (count_message_tokens), поэтому на каждый запрос диалога оценивается только новый текст.
+Та же обрезка применяется при оценке стоимости, поэтому оценка совпадает с тем, что уйдет в OpenRouter.
+"""
+import os
+import logging
+import threading
+
+from app.api.cost_calculator import DEFAULT_COMPLETION_TOKENS, get_model_context_length, get_token_count_stats
+
+logger = logging.getLogger(__name__)
+
+# Доля контекстного окна модели, которую можно занять запросом (остальное - запас на погрешность оценки)
+HISTORY_CONTEXT_FRACTION = float(os.environ.get('HISTORY_CONTEXT_FRACTION', '0.9'))
+
+# Дополнительный лимит токенов истории для экономии (0 - ограничивает только контекст модели)
+HISTORY_MAX_TOKENS = int(os.environ.get('HISTORY_MAX_TOKENS', '0'))
+
+# Контекст модели, если он неизвестен (модель не найдена или список моделей недоступен)
+HISTORY_DEFAULT_CONTEXT_LENGTH = int(os.environ.get('HISTORY_DEFAULT_CONTEXT_LENGTH', '16384'))
+
+# Накладные расходы на одно сообщение (role и форматирование)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_stats = {
+    'requests': 0,
+    'trimmed_requests': 0,
+    'dropped_messages': 0,
+    'dropped_tokens': 0,
+}
+_stats_lock = threading.Lock()
+
+
+def plan_history(model: str, max_tokens: int, fixed_tokens: int, costs: list, record: bool = True) -> tuple:
+    """
+    Сколько последних сообщений истории помещается в бюджет токенов модели.
+    Отбрасываются самые старые сообщения; системный промпт и текущее сообщение сохраняются всегда.
+
+    Args:
+        model: ID модели (контекстное окно из списка моделей OpenRouter)
+        max_tokens: Лимит ответа из запроса (резерв под ответ) или None
+        fixed_tokens: Токены системного промпта и текущего сообщения (с накладными расходами)
+        costs: Токены сообщений истории с накладными расходами, от старых к новым
+        record: Учитывать в статистике (False для оценки стоимости)
+
+    Returns:
+        tuple: (keep_from, report) - в запрос идет history[keep_from:], report:
+        {
+            'context_length': int,
+            'budget_tokens': int,       # сколько токенов можно отдать истории
+            'kept_messages': int,
+            'kept_tokens': int,
+            'dropped_messages': int,
+            'dropped_tokens': int
+        }
+    """
+    context_length = get_model_context_length(model) or HISTORY_DEFAULT_CONTEXT_LENGTH
+    completion_reserve = max_tokens or DEFAULT_COMPLETION_TOKENS
+
+    budget = int(context_length * HISTORY_CONTEXT_FRACTION) - completion_reserve - fixed_tokens
+    if HISTORY_MAX_TOKENS > 0:
+        budget = min(budget, HISTORY_MAX_TOKENS)
+    budget = max(budget, 0)
+
+    # Идем от новых сообщений к старым, пока помещаемся в бюджет
+    kept_tokens = 0
+    keep_from = len(costs)
+    while keep_from > 0:
+        tokens = costs[keep_from - 1]
+        if kept_tokens + tokens > budget:
+            break
+        kept_tokens += tokens
+        keep_from -= 1
+
+    dropped_tokens = sum(costs[:keep_from])
+    if record:
+        if keep_from:
+            logger.info(
+                f"История обрезана под бюджет {budget} токенов (контекст {context_length}): "
+                f"отброшено {keep_from} сообщений, ~{dropped_tokens} токенов"
+            )
+        with _stats_lock:
+            _stats['requests'] += 1
+            if keep_from:
+                _stats['trimmed_requests'] += 1
+                _stats['dropped_messages'] += keep_from
+                _stats['dropped_tokens'] += dropped_tokens
+
+    return keep_from, {
+        'context_length': context_length,
+        'budget_tokens': budget,
+        'kept_messages': len(costs) - keep_from,
+        'kept_tokens': kept_tokens,
+        'dropped_messages': keep_from,
+        'dropped_tokens': dropped_tokens
+    }
+
+
+def get_history_stats() -> dict:
+    """
+    Статистика обрезки истории текущего воркера.
+
+    Returns:
+        dict: {'requests': int, 'trimmed_requests': int, 'dropped_messages': int, 'dropped_tokens': int,
+               'token_count_cache': {...}, 'settings': {...}}
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['token_count_cache'] = get_token_count_stats()
+    stats['settings'] = {
+        'context_fraction': HISTORY_CONTEXT_FRACTION,
+        'max_tokens': HISTORY_MAX_TOKENS,
+        'default_context_length': HISTORY_DEFAULT_CONTEXT_LENGTH,
+    }
+    return stats
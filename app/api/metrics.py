@@ -0,0 +1,366 @@
+"""
+Метрики прокси в формате Prometheus (GET /api/metrics).
+
+- Счетчики и гистограммы копятся в шарде текущего потока (threading.local): запись не берет блокировок,
+  шарды складываются только при выгрузке. Шард завершившегося потока переносится в общий итог процесса
+- На каждый токен метрики не пишутся: паузы между токенами StreamSupervisor уже собирает в гистограмму
+  потока, она добавляется в метрики один раз по завершении потока
+- Несколько воркеров gunicorn: каждый воркер раз в METRICS_FLUSH_INTERVAL секунд записывает свои значения
+  в METRICS_DIR/worker-<pid>.json, /api/metrics складывает файлы всех воркеров. Счетчики завершенных
+  воркеров (перезапуск по max_requests) переносятся в retired.json, чтобы итоги не уменьшались;
+  их gauge (открытые потоки) отбрасываются
+"""
+import os
+import json
+import time
+import bisect
+import fcntl
+import logging
+import tempfile
+import threading
+import weakref
+
+from app.api.pricing_registry import get_pricing_stats
+
+logger = logging.getLogger(__name__)
+
+# Каталог для обмена метриками между воркерами
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'aichat-metrics'))
+
+# Как часто воркер записывает свои метрики в METRICS_DIR (секунды)
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+
+_LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_DURATION_BUCKETS = (1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+_FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+_PHASE_BUCKETS = (0.001, 0.005, 0.025, 0.1, 0.25, 1.0, 2.5, 10.0, 30.0, 120.0)
+# Совпадают с корзинами гистограммы пауз StreamSupervisor (GAP_BUCKETS_MS)
+INTER_TOKEN_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# name -> (тип, описание, корзины гистограммы)
+_METRICS = {
+    'aichat_upstream_connect_seconds': (
+        'histogram', 'Время до заголовков ответа OpenRouter (соединение, TLS, очередь провайдера)', _LATENCY_BUCKETS),
+    'aichat_ttft_seconds': ('histogram', 'Время до первого токена потока', _LATENCY_BUCKETS),
+    'aichat_inter_token_seconds': ('histogram', 'Паузы между токенами от OpenRouter', INTER_TOKEN_BUCKETS),
+    'aichat_stream_duration_seconds': ('histogram', 'Длительность потока к OpenRouter', _DURATION_BUCKETS),
+    'aichat_estimate_cost_seconds': ('histogram', 'Время оценки стоимости', _FAST_BUCKETS),
+    'aichat_phase_seconds': ('histogram', 'Время фаз запросов /api/chat и /api/chat/stream (см. tracing.py)', _PHASE_BUCKETS),
+    'aichat_tokens_total': ('counter', 'Токены запросов и ответов по usage OpenRouter', None),
+    'aichat_cost_rub_total': ('counter', 'Стоимость запросов в рублях по моделям', None),
+    'aichat_requests_total': ('counter', 'Запросы к OpenRouter по результату', None),
+    'aichat_streams_total': ('counter', 'SSE потоки клиентов', None),
+    'aichat_streams_aborted_total': ('counter', 'Потоки, прерванные до события done', None),
+    'aichat_stream_stalls_total': ('counter', 'Зависания потоков OpenRouter (пауза дольше STREAM_STALL_THRESHOLD)', None),
+    'aichat_compression_bytes_total': ('counter', 'Байты ответов API до (raw) и после (wire) сжатия', None),
+    'aichat_pricing_lookups_total': ('counter', 'Поиск тарифов модели в реестре (hit/miss/negative_hit)', None),
+    'aichat_upstream_retries_total': ('counter', 'Повторы запросов к OpenRouter до первого токена по причине', None),
+    'aichat_upstream_hedges_total': ('counter', 'Параллельные (хеджирующие) запросы: launched, won, lost', None),
+    'aichat_circuit_open_total': ('counter', 'Открытия выключателя модели', None),
+    'aichat_circuit_rejected_total': ('counter', 'Запросы, отклоненные открытым выключателем модели', None),
+    'aichat_model_fallback_total': ('counter', 'Запросы, отправленные к резервной модели вместо запрошенной', None),
+    'aichat_active_streams': ('gauge', 'Открытые SSE потоки клиентов', None),
+}
+
+
+class _Shard:
+    """Метрики одного потока: пишет только поток-владелец"""
+
+    __slots__ = ('counters', 'gauges', 'histograms')
+
+    def __init__(self):
+        # (name, labels) -> значение; labels - кортеж пар (label, value)
+        self.counters = {}
+        self.gauges = {}
+        # (name, labels) -> [счетчики корзин..., +Inf, sum]
+        self.histograms = {}
+
+
+class _Owner:
+    """Живет в threading.local: когда поток завершается, его шард переносится в итог процесса"""
+
+    __slots__ = ('__weakref__',)
+
+
+_local = threading.local()
+# id шарда -> (шард, weakref на _Owner потока)
+_shards = {}
+_retired = _Shard()
+_shards_lock = threading.Lock()
+_flusher_started = False
+
+
+def _retire(shard_id: int) -> None:
+    with _shards_lock:
+        entry = _shards.pop(shard_id, None)
+        if entry is not None:
+            _merge_shard(_retired, entry[0])
+
+
+def _shard() -> _Shard:
+    shard = getattr(_local, 'shard', None)
+    if shard is None:
+        shard = _Shard()
+        owner = _Owner()
+        shard_id = id(shard)
+        # weakref хранится вне потока: его callback сработает, когда поток завершится и _Owner удалится
+        ref = weakref.ref(owner, lambda _, shard_id=shard_id: _retire(shard_id))
+        with _shards_lock:
+            _shards[shard_id] = (shard, ref)
+        _local.owner = owner
+        _local.shard = shard
+    return shard
+
+
+def inc(name: str, value: float = 1.0, labels: tuple = ()) -> None:
+    """Увеличивает счетчик"""
+    counters = _shard().counters
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + value
+
+
+def gauge_add(name: str, delta: float, labels: tuple = ()) -> None:
+    """Изменяет gauge текущего воркера (например, +1 при открытии потока и -1 при закрытии)"""
+    gauges = _shard().gauges
+    key = (name, labels)
+    gauges[key] = gauges.get(key, 0) + delta
+
+
+def observe(name: str, value: float, labels: tuple = ()) -> None:
+    """Добавляет наблюдение в гистограмму"""
+    histograms = _shard().histograms
+    key = (name, labels)
+    histogram = histograms.get(key)
+    buckets = _METRICS[name][2]
+    if histogram is None:
+        histogram = histograms[key] = [0] * (len(buckets) + 2)
+    histogram[bisect.bisect_left(buckets, value)] += 1
+    histogram[-1] += value
+
+
+def observe_buckets(name: str, counts: list, total: float, labels: tuple = ()) -> None:
+    """Добавляет в гистограмму готовые счетчики корзин (корзины те же, что у метрики, плюс +Inf)"""
+    histograms = _shard().histograms
+    key = (name, labels)
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms[key] = [0] * (len(_METRICS[name][2]) + 2)
+    for index, count in enumerate(counts):
+        histogram[index] += count
+    histogram[-1] += total
+
+
+def _merge_shard(target: _Shard, shard: _Shard) -> None:
+    # dict.copy() атомарен под GIL: поток-владелец может писать в шард во время чтения
+    for key, value in shard.counters.copy().items():
+        target.counters[key] = target.counters.get(key, 0) + value
+    for key, value in shard.gauges.copy().items():
+        target.gauges[key] = target.gauges.get(key, 0) + value
+    for key, histogram in shard.histograms.copy().items():
+        current = target.histograms.get(key)
+        if current is None:
+            target.histograms[key] = list(histogram)
+        else:
+            for index, value in enumerate(histogram):
+                current[index] += value
+
+
+def _collect_external(target: _Shard) -> None:
+    """Счетчики, которые модули уже ведут сами (читаются только при выгрузке)"""
+    pricing = get_pricing_stats()
+    hits = pricing['lookups'] - pricing['misses'] - pricing['negative_hits']
+    for result, value in (('hit', hits), ('miss', pricing['misses']), ('negative_hit', pricing['negative_hits'])):
+        key = ('aichat_pricing_lookups_total', (('result', result),))
+        target.counters[key] = target.counters.get(key, 0) + value
+
+
+def collect() -> _Shard:
+    """Метрики текущего процесса (сумма шардов всех потоков)"""
+    total = _Shard()
+    with _shards_lock:
+        _merge_shard(total, _retired)
+        for shard, _ in list(_shards.values()):
+            _merge_shard(total, shard)
+    _collect_external(total)
+    return total
+
+
+def _serialize(shard: _Shard) -> dict:
+    return {
+        'counters': [[name, list(labels), value] for (name, labels), value in shard.counters.items()],
+        'gauges': [[name, list(labels), value] for (name, labels), value in shard.gauges.items()],
+        'histograms': [[name, list(labels), values] for (name, labels), values in shard.histograms.items()],
+    }
+
+
+def _deserialize_into(target: _Shard, data: dict, with_gauges: bool = True) -> None:
+    shard = _Shard()
+    shard.counters = {(name, tuple(map(tuple, labels))): value for name, labels, value in data.get('counters', [])}
+    if with_gauges:
+        shard.gauges = {(name, tuple(map(tuple, labels))): value for name, labels, value in data.get('gauges', [])}
+    shard.histograms = {
+        (name, tuple(map(tuple, labels))): values for name, labels, values in data.get('histograms', [])
+    }
+    _merge_shard(target, shard)
+
+
+def _worker_path(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f'worker-{pid}.json')
+
+
+def _write_json(path: str, data: dict) -> None:
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: str):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def flush_metrics() -> None:
+    """Записывает метрики текущего воркера в METRICS_DIR"""
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        data = _serialize(collect())
+        data['updated_at'] = time.time()
+        _write_json(_worker_path(os.getpid()), data)
+    except OSError as e:
+        logger.warning(f"Не удалось записать метрики в {METRICS_DIR}: {e}")
+
+
+def _collect_all_workers() -> _Shard:
+    """Сумма метрик всех воркеров; файлы завершенных воркеров переносятся в retired.json"""
+    total = _Shard()
+    own_pid = os.getpid()
+    _merge_shard(total, collect())
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        return total
+
+    dead = []
+    for name in names:
+        if not (name.startswith('worker-') and name.endswith('.json')):
+            continue
+        pid = int(name[len('worker-'):-len('.json')])
+        if pid == own_pid:
+            continue
+        if not _pid_alive(pid):
+            dead.append(name)
+            continue
+        data = _read_json(os.path.join(METRICS_DIR, name))
+        if data is not None:
+            _deserialize_into(total, data)
+
+    retired_path = os.path.join(METRICS_DIR, 'retired.json')
+    with open(os.path.join(METRICS_DIR, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if dead:
+                retired = _Shard()
+                _deserialize_into(retired, _read_json(retired_path) or {})
+                for name in dead:
+                    path = os.path.join(METRICS_DIR, name)
+                    data = _read_json(path)
+                    if data is not None:
+                        _deserialize_into(retired, data, with_gauges=False)
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                _write_json(retired_path, _serialize(retired))
+            data = _read_json(retired_path)
+            if data is not None:
+                _deserialize_into(total, data, with_gauges=False)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return total
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = tuple(labels) + extra
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{label}="{_escape(value)}"' for label, value in pairs) + '}'
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render_metrics() -> str:
+    """Метрики всех воркеров в текстовом формате Prometheus"""
+    flush_metrics()
+    total = _collect_all_workers()
+
+    lines = []
+    for name, (metric_type, help_text, buckets) in _METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        if metric_type == 'histogram':
+            for (metric_name, labels), values in sorted(total.histograms.items()):
+                if metric_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (None,), values[:-1]):
+                    cumulative += count
+                    le = '+Inf' if bound is None else repr(bound)
+                    lines.append(f'{name}_bucket{_format_labels(labels, (("le", le),))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(values[-1])}')
+                lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        else:
+            values = total.gauges if metric_type == 'gauge' else total.counters
+            for (metric_name, labels), value in sorted(values.items()):
+                if metric_name == name:
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def _flush_loop() -> None:
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        flush_metrics()
+
+
+def start_metrics_flusher() -> None:
+    """Запускает периодическую запись метрик воркера (один раз на процесс)"""
+    global _flusher_started
+    with _shards_lock:
+        if _flusher_started:
+            return
+        _flusher_started = True
+    threading.Thread(target=_flush_loop, name='metrics-flusher', daemon=True).start()
+
+
+def clear_metrics_dir() -> None:
+    """Удаляет метрики прошлых запусков (вызывается мастером gunicorn при старте)"""
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        return
+    for name in names:
+        if name.endswith('.json') or name.endswith('.tmp'):
+            try:
+                os.remove(os.path.join(METRICS_DIR, name))
+            except OSError:
+                pass
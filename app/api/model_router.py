@@ -0,0 +1,282 @@
+"""
+Выбор модели по живой телеметрии: резервные модели (fallback), когда основная не укладывается в SLO.
+
+Для каждой модели хранится скользящее окно результатов реальных запросов воркера
+(не дольше MODEL_HEALTH_WINDOW секунд и не больше MODEL_HEALTH_MAX_SAMPLES): успех или ошибка,
+время до первого токена (TTFT) и скорость генерации (токенов/сек) у потоков.
+Ошибка - таймаут, обрыв соединения или ответ 408/429/5xx после всех повторов (как в resilience.py);
+ответы 4xx на сам запрос (400, 402) не говорят о здоровье модели и не учитываются.
+
+Модель нарушает SLO, если в окне не меньше MODEL_HEALTH_MIN_SAMPLES запросов и:
+- доля ошибок больше MODEL_SLO_ERROR_RATE
+- медиана TTFT больше MODEL_SLO_TTFT_MS
+- медиана скорости меньше MODEL_SLO_MIN_TPS (0 - не проверяется)
+или у нее открыт выключатель (resilience.circuit_state).
+
+Цепочки резервных моделей: MODEL_FALLBACKS="основная=резерв1,резерв2;основная2=резерв3" и
+MODEL_FALLBACK_DEFAULT="резерв1,резерв2" для моделей без своей цепочки. Пока основная модель нарушает SLO,
+запрос уходит к первой здоровой модели цепочки, а остальные здоровые модели добавляются в массив models
+payload (OpenRouter сам перейдет к следующей, если провайдер модели откажет; MODEL_FALLBACK_OPENROUTER=0 -
+не добавлять). Раз в MODEL_PROBE_INTERVAL секунд один запрос все же идет к основной модели, чтобы ее
+телеметрия обновлялась. Без цепочек модуль только собирает телеметрию для /api/models/health.
+Состояние - в памяти воркера.
+"""
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+from app.api import metrics
+from app.api.resilience import RETRYABLE_STATUSES, circuit_state
+
+logger = logging.getLogger(__name__)
+
+# Окно телеметрии модели: секунды и максимум запросов
+MODEL_HEALTH_WINDOW = float(os.environ.get('MODEL_HEALTH_WINDOW', '300'))
+MODEL_HEALTH_MAX_SAMPLES = int(os.environ.get('MODEL_HEALTH_MAX_SAMPLES', '100'))
+
+# Меньше запросов в окне - SLO не проверяется (модель считается здоровой)
+MODEL_HEALTH_MIN_SAMPLES = int(os.environ.get('MODEL_HEALTH_MIN_SAMPLES', '5'))
+
+# SLO модели: медиана TTFT (мс), доля ошибок, медиана токенов/сек (0 - не проверяется)
+MODEL_SLO_TTFT_MS = float(os.environ.get('MODEL_SLO_TTFT_MS', '10000'))
+MODEL_SLO_ERROR_RATE = float(os.environ.get('MODEL_SLO_ERROR_RATE', '0.3'))
+MODEL_SLO_MIN_TPS = float(os.environ.get('MODEL_SLO_MIN_TPS', '0'))
+
+# Как часто пропускать запрос к основной модели, нарушающей SLO (секунды)
+MODEL_PROBE_INTERVAL = float(os.environ.get('MODEL_PROBE_INTERVAL', '30'))
+
+# Добавлять здоровые резервные модели в массив models запроса к OpenRouter
+MODEL_FALLBACK_OPENROUTER = os.environ.get('MODEL_FALLBACK_OPENROUTER', '1') == '1'
+
+
+def _parse_chain(value: str) -> tuple:
+    return tuple(dict.fromkeys(m.strip() for m in value.split(',') if m.strip()))
+
+
+def _parse_fallbacks(value: str) -> dict:
+    """'основная=резерв1,резерв2;...' -> {основная: (резерв1, резерв2)}"""
+    chains = {}
+    for entry in value.split(';'):
+        model, sep, chain = entry.partition('=')
+        model = model.strip()
+        if not sep or not model:
+            continue
+        chain = tuple(m for m in _parse_chain(chain) if m != model)
+        if chain:
+            chains[model] = chain
+    return chains
+
+
+MODEL_FALLBACKS = _parse_fallbacks(os.environ.get('MODEL_FALLBACKS', ''))
+MODEL_FALLBACK_DEFAULT = _parse_chain(os.environ.get('MODEL_FALLBACK_DEFAULT', ''))
+
+
+class _ModelTelemetry:
+    """Скользящее окно запросов одной модели (изменяется под _lock)"""
+
+    __slots__ = ('samples', 'probe_at', 'routed_away')
+
+    def __init__(self):
+        # (время, успех, ttft сек или None, токенов/сек или None)
+        self.samples = deque(maxlen=MODEL_HEALTH_MAX_SAMPLES)
+        # Время последнего пробного запроса к модели, нарушающей SLO
+        self.probe_at = 0.0
+        # Запросы, отправленные вместо этой модели к резервной
+        self.routed_away = 0
+
+
+_telemetry = {}
+_lock = threading.Lock()
+
+_stats = {
+    'samples': 0,
+    'routed': 0,
+    'probes': 0,
+    'no_healthy_fallback': 0,
+}
+
+
+def _median(values: list):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def _p95(values: list):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * 0.95))]
+
+
+def _health(telemetry: _ModelTelemetry, now: float) -> dict:
+    """Сводка окна модели (вызывается под _lock; устаревшие запросы удаляются)"""
+    samples = telemetry.samples
+    while samples and now - samples[0][0] > MODEL_HEALTH_WINDOW:
+        samples.popleft()
+    errors = sum(1 for sample in samples if not sample[1])
+    ttfts = [sample[2] for sample in samples if sample[2] is not None]
+    speeds = [sample[3] for sample in samples if sample[3] is not None]
+    ttft_p50 = _median(ttfts)
+    tps = _median(speeds)
+    error_rate = errors / len(samples) if samples else 0.0
+
+    breaches = []
+    if len(samples) >= MODEL_HEALTH_MIN_SAMPLES:
+        if error_rate > MODEL_SLO_ERROR_RATE:
+            breaches.append('error_rate')
+        if ttft_p50 is not None and ttft_p50 * 1000 > MODEL_SLO_TTFT_MS:
+            breaches.append('ttft')
+        if MODEL_SLO_MIN_TPS > 0 and tps is not None and tps < MODEL_SLO_MIN_TPS:
+            breaches.append('tokens_per_sec')
+    return {
+        'samples': len(samples),
+        'errors': errors,
+        'error_rate': round(error_rate, 3),
+        'ttft_p50_ms': round(ttft_p50 * 1000, 1) if ttft_p50 is not None else None,
+        'ttft_p95_ms': round(_p95(ttfts) * 1000, 1) if ttfts else None,
+        'tokens_per_sec': round(tps, 1) if tps is not None else None,
+        'breaches': breaches,
+    }
+
+
+def _model_breaches(model: str, now: float) -> list:
+    """Нарушения SLO модели (с учетом выключателя); [] - модель здорова"""
+    with _lock:
+        telemetry = _telemetry.get(model)
+        breaches = _health(telemetry, now)['breaches'] if telemetry is not None else []
+    if circuit_state(model) == 'open':
+        breaches = breaches + ['circuit_open']
+    return breaches
+
+
+def fallback_chain(model: str) -> tuple:
+    """Резервные модели для модели (своя цепочка или MODEL_FALLBACK_DEFAULT)"""
+    chain = MODEL_FALLBACKS.get(model)
+    if chain is None:
+        chain = tuple(m for m in MODEL_FALLBACK_DEFAULT if m != model)
+    return chain
+
+
+def route_model(model: str) -> tuple:
+    """
+    Выбирает модель для запроса по телеметрии.
+
+    Returns:
+        tuple: (model, fallbacks): модель, к которой отправить запрос, и резервные модели для массива
+               models (пустой кортеж, если основная модель здорова или резервных моделей нет)
+    """
+    chain = fallback_chain(model)
+    if not chain:
+        return model, ()
+    now = time.monotonic()
+    breaches = _model_breaches(model, now)
+    if not breaches:
+        return model, ()
+
+    with _lock:
+        telemetry = _telemetry.get(model)
+        # Пробный запрос к основной модели (выключатель пропускает свои пробные попытки сам)
+        if telemetry is not None and 'circuit_open' not in breaches:
+            if now - telemetry.probe_at > MODEL_HEALTH_WINDOW:
+                # Начало нарушения: первый пробный запрос - через MODEL_PROBE_INTERVAL
+                telemetry.probe_at = now
+            elif now - telemetry.probe_at >= MODEL_PROBE_INTERVAL:
+                telemetry.probe_at = now
+                _stats['probes'] += 1
+                return model, ()
+
+    healthy = [candidate for candidate in chain if not _model_breaches(candidate, now)]
+    if not healthy:
+        with _lock:
+            _stats['no_healthy_fallback'] += 1
+        return model, ()
+
+    routed = healthy[0]
+    with _lock:
+        _stats['routed'] += 1
+        if telemetry is not None:
+            telemetry.routed_away += 1
+    metrics.inc('aichat_model_fallback_total', labels=(('requested', model), ('model', routed)))
+    logger.info(f"Модель {model} не укладывается в SLO ({', '.join(breaches)}) - запрос к {routed}")
+    return routed, tuple(healthy[1:]) if MODEL_FALLBACK_OPENROUTER else ()
+
+
+def record_sample(model: str, ok: bool, ttft: float = None, tokens_per_sec: float = None) -> None:
+    """Добавляет результат запроса к модели в ее окно телеметрии"""
+    with _lock:
+        telemetry = _telemetry.get(model)
+        if telemetry is None:
+            telemetry = _telemetry[model] = _ModelTelemetry()
+        telemetry.samples.append((time.monotonic(), ok, ttft, tokens_per_sec))
+        _stats['samples'] += 1
+
+
+def record_upstream_failure(model: str, status_code: int = None) -> None:
+    """Учитывает неудачный запрос: таймаут/ошибку сети (status_code=None) или ответ 408/429/5xx"""
+    if status_code is None or status_code in RETRYABLE_STATUSES:
+        record_sample(model, False)
+
+
+def record_stream(model: str, supervisor) -> None:
+    """Учитывает завершенный поток: успех, TTFT и скорость генерации (по usage или числу delta)"""
+    relay = supervisor.relay
+    if supervisor.ttft is None:
+        # Поток оборвался до первого токена; без ответа OpenRouter (клиент ушел) - не учитываем
+        if supervisor.ttfb is not None:
+            record_sample(model, False)
+        return
+    tokens_per_sec = None
+    if supervisor.last_token is not None:
+        generation_time = supervisor.last_token - supervisor.started - supervisor.ttft
+        tokens = (relay.usage_data or {}).get('completion_tokens') or relay.deltas_received
+        if generation_time > 0 and tokens > 1:
+            tokens_per_sec = tokens / generation_time
+    ok = not supervisor.idle_timed_out and relay.finish_reason != 'error'
+    record_sample(model, ok, supervisor.ttft, tokens_per_sec)
+
+
+def get_models_health() -> dict:
+    """
+    Телеметрия моделей текущего воркера и резервные цепочки.
+
+    Returns:
+        dict: {'models': {model: {'samples', 'errors', 'error_rate', 'ttft_p50_ms', 'ttft_p95_ms',
+               'tokens_per_sec', 'breaches', 'healthy', 'circuit', 'fallbacks', 'routed_away'}},
+               'slo': {...}, 'stats': {...}}
+    """
+    now = time.monotonic()
+    with _lock:
+        models = {
+            model: dict(_health(telemetry, now), routed_away=telemetry.routed_away)
+            for model, telemetry in _telemetry.items()
+        }
+        stats = dict(_stats)
+    # Модели цепочек без трафика тоже показываем
+    for model in list(MODEL_FALLBACKS) + [m for chain in MODEL_FALLBACKS.values() for m in chain] + list(MODEL_FALLBACK_DEFAULT):
+        models.setdefault(model, {
+            'samples': 0, 'errors': 0, 'error_rate': 0.0, 'ttft_p50_ms': None, 'ttft_p95_ms': None,
+            'tokens_per_sec': None, 'breaches': [], 'routed_away': 0
+        })
+    for model, health in models.items():
+        health['circuit'] = circuit_state(model)
+        if health['circuit'] == 'open':
+            health['breaches'] = health['breaches'] + ['circuit_open']
+        health['healthy'] = not health['breaches']
+        health['fallbacks'] = list(fallback_chain(model))
+    return {
+        'models': models,
+        'slo': {
+            'ttft_ms': MODEL_SLO_TTFT_MS,
+            'error_rate': MODEL_SLO_ERROR_RATE,
+            'min_tokens_per_sec': MODEL_SLO_MIN_TPS,
+            'window_seconds': MODEL_HEALTH_WINDOW,
+            'min_samples': MODEL_HEALTH_MIN_SAMPLES,
+            'probe_interval': MODEL_PROBE_INTERVAL,
+            'openrouter_models': MODEL_FALLBACK_OPENROUTER,
+        },
+        'stats': stats,
+    }
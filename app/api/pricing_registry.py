@@ -0,0 +1,407 @@
+"""
+Реестр тарифов и метаданных моделей OpenRouter.
+
+- Снимок каталога (PricingSnapshot) неизменяемый и заменяется целиком (атомарная замена ссылки),
+  поэтому чтение идет без блокировок и никогда не видит наполовину обновленные данные
+- Индекс по id и canonical_slug: поиск модели - одно обращение к dict, без перебора каталога
+- Фоновое обновление раз в PRICING_REFRESH_INTERVAL секунд условным запросом
+  (If-None-Match / If-Modified-Since): если каталог не изменился, OpenRouter отвечает 304 без тела
+- Негативное кэширование: неизвестный id не вызывает загрузку каталога на каждый запрос
+- Поиск модели не ходит в сеть: если снимка нет (OpenRouter недоступен при старте), он загружается в фоне,
+  а после неудачной загрузки следующая попытка - не раньше чем через PRICING_RETRY_INTERVAL секунд
+- Снимок хранится в общем для воркеров SQLite (PRICING_SNAPSHOT_PATH, см. pricing_store):
+  каталог загружает один воркер, остальные подхватывают новую версию снимка из хранилища
+"""
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+from app.api import pricing_store
+from app.api.upstream import MODELS_API_URL, get_upstream_session
+
+logger = logging.getLogger(__name__)
+
+# Интервал фонового обновления каталога (секунд)
+PRICING_REFRESH_INTERVAL = float(os.environ.get('PRICING_REFRESH_INTERVAL', '3600'))
+
+# Сколько секунд помнить, что модели нет в каталоге
+PRICING_NEGATIVE_TTL = float(os.environ.get('PRICING_NEGATIVE_TTL', '600'))
+
+# Общее хранилище снимка (по умолчанию в persistenceMount /data, если он есть; пусто - снимок только в памяти)
+PRICING_SNAPSHOT_PATH = os.environ.get(
+    'PRICING_SNAPSHOT_PATH',
+    '/data/pricing.sqlite3' if os.path.isdir('/data') else ''
+)
+
+# Как часто воркер проверяет версию снимка в общем хранилище (секунд)
+PRICING_STORE_CHECK_INTERVAL = float(os.environ.get('PRICING_STORE_CHECK_INTERVAL', '5'))
+
+# Пауза перед повторной загрузкой каталога после неудачи (секунд)
+PRICING_RETRY_INTERVAL = float(os.environ.get('PRICING_RETRY_INTERVAL', '30'))
+
+# Таймаут загрузки каталога (секунд)
+PRICING_FETCH_TIMEOUT = 30
+
+
+class PricingSnapshot:
+    """Неизменяемый снимок каталога моделей с индексом по id и canonical_slug"""
+
+    __slots__ = ('models', 'index', 'fetched_at', 'etag', 'last_modified', 'version')
+
+    def __init__(self, models: dict, fetched_at: float, etag: str = None, last_modified: str = None,
+                 version: int = 0):
+        # models: id -> {'prompt': float, 'completion': float, 'request': float, 'input_cache_read': float или None,
+        #                'input_cache_write': float или None, 'context_length': int или None, 'canonical_slug': str}
+        self.models = models
+        self.index = dict(models)
+        for model_id, entry in models.items():
+            slug = entry.get('canonical_slug')
+            if slug and slug not in self.index:
+                self.index[slug] = entry
+        self.fetched_at = fetched_at
+        self.etag = etag
+        self.last_modified = last_modified
+        self.version = version
+
+    def get(self, model_id: str):
+        return self.index.get(model_id)
+
+    def touched(self, fetched_at: float) -> 'PricingSnapshot':
+        """Тот же каталог с новым временем проверки (ответ 304)"""
+        snapshot = PricingSnapshot.__new__(PricingSnapshot)
+        snapshot.models = self.models
+        snapshot.index = self.index
+        snapshot.fetched_at = fetched_at
+        snapshot.etag = self.etag
+        snapshot.last_modified = self.last_modified
+        snapshot.version = self.version
+        return snapshot
+
+
+def _optional_price(value):
+    return float(value) if value not in (None, '') else None
+
+
+def parse_models_catalog(models_data: dict) -> dict:
+    """Преобразует ответ /models в словарь id -> тарифы и метаданные"""
+    models = {}
+    for model in models_data.get('data', []):
+        model_id = model.get('id') or model.get('canonical_slug')
+        pricing = model.get('pricing')
+        if not model_id or not pricing:
+            continue
+        try:
+            models[model_id] = {
+                'prompt': float(pricing.get('prompt', '0')),
+                'completion': float(pricing.get('completion', '0')),
+                'request': float(pricing.get('request', '0')),
+                # Тарифы кэша промпта (есть не у всех моделей)
+                'input_cache_read': _optional_price(pricing.get('input_cache_read')),
+                'input_cache_write': _optional_price(pricing.get('input_cache_write')),
+                'context_length': int(model['context_length']) if model.get('context_length') else None,
+                'canonical_slug': model.get('canonical_slug'),
+            }
+        except (TypeError, ValueError):
+            logger.debug(f"Пропущена модель с некорректными тарифами: {model_id}")
+    return models
+
+
+# Текущий снимок (замена ссылки атомарна, читатели не берут блокировку)
+_snapshot = None
+# Неизвестные модели: id -> момент, до которого не искать их повторно
+_negative = {}
+_refresh_lock = threading.Lock()
+_refresher_started = False
+# Фоновая загрузка по запросу из lookup_model: не больше одной сразу и не раньше _retry_after после неудачи
+_background_lock = threading.Lock()
+_background_running = False
+_retry_after = 0.0
+
+_stats = {
+    'lookups': 0,
+    'misses': 0,
+    'negative_hits': 0,
+    'refreshes': 0,
+    'not_modified': 0,
+    'failures': 0,
+    'store_reloads': 0,
+    'store_errors': 0,
+}
+
+
+def _store_call(func, *args):
+    """Вызов pricing_store; при недоступном хранилище реестр продолжает работать только в памяти"""
+    try:
+        return func(PRICING_SNAPSHOT_PATH, *args)
+    except (sqlite3.Error, OSError) as e:
+        _stats['store_errors'] += 1
+        logger.warning(f"Хранилище тарифов {PRICING_SNAPSHOT_PATH} недоступно: {e}")
+        return None
+
+
+def _sync_from_store() -> None:
+    """Подхватывает снимок, записанный другим воркером (под _refresh_lock)"""
+    global _snapshot
+    if not PRICING_SNAPSHOT_PATH:
+        return
+    meta = _store_call(pricing_store.read_meta)
+    if meta is None:
+        return
+
+    current = _snapshot
+    if current is None or meta['version'] != current.version:
+        loaded = _store_call(pricing_store.load_snapshot)
+        if loaded is None:
+            return
+        meta, models = loaded
+        _snapshot = PricingSnapshot(models, meta['fetched_at'], meta['etag'], meta['last_modified'], meta['version'])
+        _negative.clear()
+        _stats['store_reloads'] += 1
+        logger.info(f"Тарифы загружены из общего хранилища: версия {meta['version']}, {len(models)} моделей")
+    elif meta['fetched_at'] > current.fetched_at:
+        _snapshot = current.touched(meta['fetched_at'])
+
+
+def refresh_pricing(max_age: float = 0.0, force: bool = False) -> bool:
+    """
+    Загружает каталог моделей (условным запросом, если снимок уже есть) и атомарно заменяет снимок.
+    При общем хранилище каталог загружает только воркер, взявший аренду; остальные берут снимок из хранилища.
+
+    Args:
+        max_age: Не загружать каталог, если снимок моложе max_age секунд
+        force: Загрузить полный каталог без If-None-Match / If-Modified-Since
+
+    Returns:
+        bool: True, если снимок есть после обновления
+    """
+    global _snapshot
+    with _refresh_lock:
+        _sync_from_store()
+        current = _snapshot
+        now = time.time()
+        if PRICING_SNAPSHOT_PATH:
+            leased = _store_call(pricing_store.try_acquire_refresh_lease, max_age)
+            # None - хранилище недоступно, загружаем каталог сами
+            if leased is False:
+                return current is not None
+        elif current is not None and now - current.fetched_at < max_age:
+            return True
+
+        headers = {}
+        if current is not None and not force:
+            if current.etag:
+                headers['If-None-Match'] = current.etag
+            if current.last_modified:
+                headers['If-Modified-Since'] = current.last_modified
+
+        try:
+            response = get_upstream_session().get(MODELS_API_URL, headers=headers, timeout=PRICING_FETCH_TIMEOUT)
+            if response.status_code == 304 and current is not None:
+                models = None
+            elif response.status_code != 200:
+                raise ValueError(f"HTTP {response.status_code}")
+            else:
+                models = parse_models_catalog(response.json())
+        except Exception as e:
+            _stats['failures'] += 1
+            _retry_later()
+            logger.warning(f"Не удалось получить список моделей: {str(e)}")
+            if PRICING_SNAPSHOT_PATH:
+                _store_call(pricing_store.release_refresh_lease)
+            return current is not None
+
+        now = time.time()
+        if models is None:
+            _snapshot = current.touched(now)
+            _stats['not_modified'] += 1
+            if PRICING_SNAPSHOT_PATH:
+                _store_call(pricing_store.touch_snapshot, now)
+            return True
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        version = None
+        if PRICING_SNAPSHOT_PATH:
+            version = _store_call(pricing_store.write_snapshot, models, now, etag, last_modified)
+        if version is None:
+            version = (current.version if current is not None else 0) + 1
+        _snapshot = PricingSnapshot(models, now, etag, last_modified, version)
+        # Новый каталог мог добавить модели, которые раньше не находились
+        _negative.clear()
+        _stats['refreshes'] += 1
+
+    logger.info(f"Каталог моделей обновлен: тарифы для {len(models)} моделей, версия {version}")
+    return True
+
+
+def _retry_later() -> None:
+    """Откладывает следующую загрузку каталога на PRICING_RETRY_INTERVAL секунд"""
+    global _retry_after
+    with _background_lock:
+        _retry_after = time.time() + PRICING_RETRY_INTERVAL
+
+
+def _refresh_in_background(max_age: float) -> None:
+    """Запускает refresh_pricing в фоновом потоке, если он еще не идет и пауза после неудачи прошла"""
+    global _background_running
+    with _background_lock:
+        if _background_running or time.time() < _retry_after:
+            return
+        _background_running = True
+    threading.Thread(target=_background_refresh, args=(max_age,), name='pricing-refresh', daemon=True).start()
+
+
+def _background_refresh(max_age: float) -> None:
+    global _background_running
+    try:
+        refresh_pricing(max_age=max_age)
+    finally:
+        # Снимка нет и после попытки (каталог загружает другой воркер или ошибка) - не повторяем сразу
+        if _snapshot is None:
+            _retry_later()
+        with _background_lock:
+            _background_running = False
+
+
+def load_snapshot():
+    """
+    Берет снимок из общего хранилища или из сети и ждет его (при старте процесса, не на пути запроса).
+    Если каталог загружает другой воркер, ждет его снимок в хранилище до PRICING_FETCH_TIMEOUT секунд.
+    """
+    snapshot = _snapshot
+    if snapshot is not None:
+        return snapshot
+
+    refresh_pricing(max_age=PRICING_REFRESH_INTERVAL)
+    # Каталог загружает другой воркер - ждем его снимок в хранилище
+    deadline = time.time() + PRICING_FETCH_TIMEOUT
+    while _snapshot is None and PRICING_SNAPSHOT_PATH and time.time() < deadline:
+        time.sleep(0.2)
+        with _refresh_lock:
+            _sync_from_store()
+    return _snapshot
+
+
+def ensure_snapshot():
+    """Возвращает текущий снимок; если его нет, запускает загрузку в фоне и возвращает None, не дожидаясь ее"""
+    snapshot = _snapshot
+    if snapshot is None:
+        _refresh_in_background(PRICING_REFRESH_INTERVAL)
+    return snapshot
+
+
+def lookup_model(model_id: str):
+    """
+    Ищет модель по id или canonical_slug.
+
+    Returns:
+        dict: {'prompt': float, 'completion': float, 'request': float, 'context_length': int или None, ...}
+              или None, если модели нет в каталоге (результат кэшируется на PRICING_NEGATIVE_TTL)
+    """
+    _stats['lookups'] += 1
+    # Негативный кэш сбрасывается при каждом новом снимке, поэтому проверяется первым
+    now = time.time()
+    expires_at = _negative.get(model_id)
+    if expires_at is not None and expires_at > now:
+        _stats['negative_hits'] += 1
+        return None
+
+    snapshot = ensure_snapshot()
+    if snapshot is not None:
+        entry = snapshot.get(model_id)
+        if entry is not None:
+            return entry
+
+    _stats['misses'] += 1
+    _negative[model_id] = now + PRICING_NEGATIVE_TTL
+    # Модель могла появиться в каталоге: обновляем снимок в фоне, если он старше негативного TTL
+    if snapshot is not None and now - snapshot.fetched_at > PRICING_NEGATIVE_TTL:
+        _refresh_in_background(PRICING_NEGATIVE_TTL)
+    return None
+
+
+def lookup_models(model_ids: list) -> tuple:
+    """
+    Ищет несколько моделей в одном снимке (все тарифы одной версии).
+
+    Returns:
+        tuple: ({model_id: dict или None}, версия снимка)
+    """
+    snapshot = ensure_snapshot()
+    entries = {}
+    for model_id in model_ids:
+        entry = snapshot.get(model_id) if snapshot is not None else None
+        if entry is None:
+            # Промах обрабатывается как обычно: негативный кэш и фоновое обновление
+            entry = lookup_model(model_id)
+        else:
+            _stats['lookups'] += 1
+        entries[model_id] = entry
+    return entries, snapshot.version if snapshot is not None else None
+
+
+def get_pricing_version() -> int:
+    """Версия текущего снимка тарифов (одинакова у всех воркеров с общим хранилищем)"""
+    snapshot = _snapshot
+    return snapshot.version if snapshot is not None else None
+
+
+def _refresh_loop():
+    while True:
+        snapshot = _snapshot
+        age = time.time() - snapshot.fetched_at if snapshot is not None else PRICING_REFRESH_INTERVAL
+        delay = max(PRICING_REFRESH_INTERVAL - age, 1.0)
+        if PRICING_SNAPSHOT_PATH:
+            delay = min(delay, PRICING_STORE_CHECK_INTERVAL)
+        else:
+            delay = max(delay, _retry_after - time.time())
+        time.sleep(delay)
+
+        with _refresh_lock:
+            _sync_from_store()
+        snapshot = _snapshot
+        if snapshot is not None and time.time() - snapshot.fetched_at < PRICING_REFRESH_INTERVAL:
+            continue
+        # После неудачной загрузки ждем PRICING_RETRY_INTERVAL, а не повторяем каждую секунду
+        if time.time() >= _retry_after:
+            refresh_pricing(max_age=PRICING_REFRESH_INTERVAL)
+
+
+def start_pricing_refresher() -> None:
+    """
+    Загружает снимок (из общего хранилища или из сети) и запускает фоновое обновление каталога.
+    Вызывается один раз при старте процесса.
+    """
+    global _refresher_started
+    with _refresh_lock:
+        if _refresher_started:
+            return
+        _refresher_started = True
+
+    load_snapshot()
+    threading.Thread(target=_refresh_loop, name='pricing-refresher', daemon=True).start()
+
+
+def get_pricing_stats() -> dict:
+    """
+    Статистика реестра тарифов текущего воркера.
+
+    Returns:
+        dict: {'models': int, 'version': int, 'snapshot_age': float, 'etag': str, 'lookups': int, 'misses': int,
+               'negative_hits': int, 'refreshes': int, 'not_modified': int, 'store_reloads': int, ...}
+    """
+    snapshot = _snapshot
+    stats = dict(_stats)
+    stats.update({
+        'models': len(snapshot.models) if snapshot is not None else 0,
+        'version': snapshot.version if snapshot is not None else None,
+        'snapshot_age': round(time.time() - snapshot.fetched_at, 1) if snapshot is not None else None,
+        'etag': snapshot.etag if snapshot is not None else None,
+        'negative_cached': len(_negative),
+        'snapshot_path': PRICING_SNAPSHOT_PATH or None,
+        'refresh_interval': PRICING_REFRESH_INTERVAL,
+        'retry_in': round(max(_retry_after - time.time(), 0.0), 1),
+    })
+    return stats
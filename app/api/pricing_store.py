@@ -0,0 +1,216 @@
+"""
+Общее для всех воркеров хранилище каталога моделей (SQLite, например /data/pricing.sqlite3).
+
+- Каталог загружает из OpenRouter только один воркер: он берет аренду (lease) в таблице meta,
+  остальные читают уже сохраненный снимок
+- Каждая запись каталога увеличивает version, по нему воркеры замечают новый снимок
+  и все считают стоимость по одинаковым тарифам
+- Воркеры держат снимок в памяти процесса (pricing_registry) и обращаются к SQLite только
+  при смене версии, поэтому поиск тарифов на запрос не читает диск
+"""
+import os
+import time
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд действует аренда обновления каталога (если воркер умер, ее заберет другой)
+PRICING_REFRESH_LEASE = 60.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS models (
+    id TEXT PRIMARY KEY,
+    prompt REAL NOT NULL,
+    completion REAL NOT NULL,
+    request REAL NOT NULL,
+    context_length INTEGER,
+    canonical_slug TEXT,
+    input_cache_read REAL,
+    input_cache_write REAL
+);
+"""
+
+# Колонки, добавленные после первой версии схемы (ALTER TABLE для существующих файлов)
+_ADDED_COLUMNS = (
+    ('input_cache_read', 'REAL'),
+    ('input_cache_write', 'REAL'),
+)
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(_SCHEMA)
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(models)')}
+    missing = [(name, column_type) for name, column_type in _ADDED_COLUMNS if name not in columns]
+    for name, column_type in missing:
+        try:
+            conn.execute(f'ALTER TABLE models ADD COLUMN {name} {column_type}')
+        except sqlite3.OperationalError:
+            # Колонку одновременно добавил другой воркер
+            pass
+    if missing:
+        # Новых колонок нет в сохраненном снимке - следующее обновление загрузит каталог целиком
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('fetched_at', '0'), ('etag', ''), ('last_modified', '')")
+    return conn
+
+
+def _meta(conn: sqlite3.Connection) -> dict:
+    return dict(conn.execute('SELECT key, value FROM meta').fetchall())
+
+
+def read_meta(path: str) -> dict:
+    """
+    Метаданные снимка без загрузки моделей.
+
+    Returns:
+        dict: {'version': int, 'fetched_at': float, 'etag': str, 'last_modified': str} или None, если снимка нет
+    """
+    conn = _connect(path)
+    try:
+        meta = _meta(conn)
+    finally:
+        conn.close()
+    if 'version' not in meta:
+        return None
+    return {
+        'version': int(meta['version']),
+        'fetched_at': float(meta.get('fetched_at') or 0),
+        'etag': meta.get('etag') or None,
+        'last_modified': meta.get('last_modified') or None,
+    }
+
+
+def load_snapshot(path: str):
+    """
+    Читает снимок целиком (метаданные и модели одной транзакцией).
+
+    Returns:
+        tuple: (meta, models) или None, если снимка еще нет
+    """
+    conn = _connect(path)
+    try:
+        conn.execute('BEGIN')
+        meta = _meta(conn)
+        if 'version' not in meta:
+            conn.execute('COMMIT')
+            return None
+        rows = conn.execute(
+            'SELECT id, prompt, completion, request, context_length, canonical_slug, input_cache_read, input_cache_write '
+            'FROM models'
+        ).fetchall()
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+    models = {
+        row[0]: {
+            'prompt': row[1],
+            'completion': row[2],
+            'request': row[3],
+            'input_cache_read': row[6],
+            'input_cache_write': row[7],
+            'context_length': row[4],
+            'canonical_slug': row[5],
+        }
+        for row in rows
+    }
+    return {
+        'version': int(meta['version']),
+        'fetched_at': float(meta.get('fetched_at') or 0),
+        'etag': meta.get('etag') or None,
+        'last_modified': meta.get('last_modified') or None,
+    }, models
+
+
+def write_snapshot(path: str, models: dict, fetched_at: float, etag: str = None, last_modified: str = None) -> int:
+    """
+    Заменяет каталог в хранилище и увеличивает версию снимка.
+
+    Returns:
+        int: Новая версия снимка
+    """
+    conn = _connect(path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        meta = _meta(conn)
+        version = int(meta.get('version') or 0) + 1
+        conn.execute('DELETE FROM models')
+        conn.executemany(
+            'INSERT INTO models (id, prompt, completion, request, context_length, canonical_slug, '
+            'input_cache_read, input_cache_write) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [
+                (model_id, entry['prompt'], entry['completion'], entry['request'],
+                 entry['context_length'], entry.get('canonical_slug'),
+                 entry.get('input_cache_read'), entry.get('input_cache_write'))
+                for model_id, entry in models.items()
+            ]
+        )
+        conn.executemany(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            [
+                ('version', str(version)),
+                ('fetched_at', str(fetched_at)),
+                ('etag', etag or ''),
+                ('last_modified', last_modified or ''),
+                ('lease_until', '0'),
+            ]
+        )
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    return version
+
+
+def touch_snapshot(path: str, fetched_at: float) -> None:
+    """Отмечает, что каталог проверен и не изменился (ответ 304), и освобождает аренду"""
+    conn = _connect(path)
+    try:
+        conn.executemany(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            [('fetched_at', str(fetched_at)), ('lease_until', '0')]
+        )
+    finally:
+        conn.close()
+
+
+def try_acquire_refresh_lease(path: str, max_age: float) -> bool:
+    """
+    Берет аренду на загрузку каталога, если снимок старше max_age секунд и аренду никто не держит.
+
+    Returns:
+        bool: True, если загружать каталог должен текущий воркер
+    """
+    now = time.time()
+    conn = _connect(path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        meta = _meta(conn)
+        fresh = 'version' in meta and now - float(meta.get('fetched_at') or 0) < max_age
+        leased = float(meta.get('lease_until') or 0) > now
+        if fresh or leased:
+            conn.execute('COMMIT')
+            return False
+        conn.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            ('lease_until', str(now + PRICING_REFRESH_LEASE))
+        )
+        conn.execute('COMMIT')
+        return True
+    finally:
+        conn.close()
+
+
+def release_refresh_lease(path: str) -> None:
+    """Освобождает аренду после неудачной загрузки каталога"""
+    conn = _connect(path)
+    try:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('lease_until', '0')")
+    finally:
+        conn.close()
@@ -0,0 +1,66 @@
+"""
+Кэширование префикса промпта у провайдера (prompt caching).
+
+Системный промпт (~8 КБ, с IA-стилем ~13 КБ) одинаков во всех запросах, а история диалога
+на каждом ходу только растет, поэтому начало запроса можно не обрабатывать и не оплачивать заново.
+
+- OpenAI, DeepSeek, Grok кэшируют префикс автоматически - payload не меняется
+- Anthropic и Gemini кэшируют только явно отмеченные блоки: системный промпт и последнее сообщение
+  истории помечаются cache_control (контрольные точки кэша)
+
+Отметки добавляются только в payload, который уходит в OpenRouter: ключ кэша ответов, обрезка
+истории и оценка токенов работают с обычными строковыми сообщениями.
+Сколько токенов прочитано из кэша, OpenRouter возвращает в usage.prompt_tokens_details.cached_tokens,
+это учитывает calculate_cost_rub().
+"""
+import os
+
+# Режим: off - не отмечать, system - только системный промпт, auto - системный промпт и история
+PROMPT_CACHE_MODE = os.environ.get('PROMPT_CACHE_MODE', 'auto')
+
+# Префиксы id моделей, которым нужны явные отметки cache_control (через запятую)
+PROMPT_CACHE_MODELS = tuple(
+    prefix.strip() for prefix in os.environ.get('PROMPT_CACHE_MODELS', 'anthropic/,google/gemini').split(',')
+    if prefix.strip()
+)
+
+_CACHE_CONTROL = {'type': 'ephemeral'}
+
+
+def supports_cache_control(model: str) -> bool:
+    """Нужны ли модели явные отметки cache_control (алиасы вида ~google/... тоже учитываются)"""
+    return model.lstrip('~').startswith(PROMPT_CACHE_MODELS)
+
+
+def _cacheable(message: dict) -> dict:
+    """Сообщение с контрольной точкой кэша (content в виде списка частей)"""
+    return {
+        'role': message['role'],
+        'content': [{'type': 'text', 'text': message['content'], 'cache_control': _CACHE_CONTROL}]
+    }
+
+
+def with_prompt_caching(payload: dict) -> dict:
+    """
+    Возвращает payload для OpenRouter с отметками cache_control (исходный payload не изменяется).
+    Если модели отметки не нужны или режим выключен, возвращает тот же payload.
+    """
+    if PROMPT_CACHE_MODE == 'off' or not supports_cache_control(payload['model']):
+        return payload
+
+    messages = payload['messages']
+    breakpoints = []
+    if messages and messages[0]['role'] == 'system':
+        breakpoints.append(0)
+    # Последнее сообщение истории (перед текущим): весь предыдущий диалог читается из кэша
+    if PROMPT_CACHE_MODE == 'auto' and len(messages) >= 2 and len(messages) - 2 not in breakpoints:
+        breakpoints.append(len(messages) - 2)
+
+    breakpoints = [i for i in breakpoints if isinstance(messages[i]['content'], str) and messages[i]['content']]
+    if not breakpoints:
+        return payload
+
+    marked = list(messages)
+    for i in breakpoints:
+        marked[i] = _cacheable(messages[i])
+    return dict(payload, messages=marked)
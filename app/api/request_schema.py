@@ -0,0 +1,319 @@
+"""
+Общая подготовка запросов /api/chat, /api/chat/stream и /api/estimate-cost.
+
+Запрос проверяется один раз (prepare_request) и превращается в PreparedRequest:
+- сообщение, модель и параметры генерации, проверенные по одной таблице правил
+- вариант системного промпта из реестра (текст и готовая оценка токенов)
+- история - неизменяемый кортеж проверенных сообщений (у диалога на сервере - его же сообщения, без копий)
+  и оценки токенов каждого сообщения, посчитанные один раз
+- обрезка истории под бюджет токенов модели (plan_history) считается по этим оценкам
+- модель запроса может быть заменена резервной (route, model_router.py) до обрезки истории и сборки payload
+
+Отправка и оценка стоимости строят payload и считают входные токены из одного PreparedRequest,
+поэтому оценка учитывает verbosity, стиль И.А. и обрезку истории ровно так же, как отправка.
+Ошибки возвращаются как ({'error': ...}, status): Flask отдает такой dict как JSON, ASGI путь сериализует сам.
+"""
+import re
+
+from app.api.cost_calculator import count_message_tokens, estimate_token_count
+from app.api.conversation_store import CONVERSATIONS_ENABLED, get_conversation, new_version, seed_conversation
+from app.api.history_budget import MESSAGE_OVERHEAD_TOKENS, plan_history
+from app.api.model_router import route_model
+from app.config.prompt_loader import VERBOSITY_LEVELS, get_prompt_variant
+
+# Максимум моделей в одном запросе /api/estimate-cost/batch
+MAX_ESTIMATE_BATCH_MODELS = 50
+
+# Максимум токенов ответа, который можно запросить
+MAX_COMPLETION_TOKENS = 4000
+
+# id диалога выдает сервер (uuid4 hex), версию - тоже (conversation_store.new_version)
+_CONVERSATION_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+_CONVERSATION_VERSION_RE = re.compile(r'^[0-9a-f]{16}$')
+
+# Числовые параметры генерации: (поле, минимум, максимум); max_tokens проверяется отдельно
+# (0 и '' означают "без лимита")
+_FLOAT_PARAMS = (
+    ('temperature', 0.0, 2.0),
+    ('frequency_penalty', -2.0, 2.0),
+    ('presence_penalty', -2.0, 2.0),
+    ('top_p', 0.0, 1.0),
+)
+
+
+class PreparedRequest:
+    """Проверенный запрос чата: сообщения, параметры генерации и оценки токенов (собирается один раз)"""
+
+    __slots__ = ('message', 'model', 'requested_model', 'fallbacks', 'models', 'params', 'max_tokens', 'prompt',
+                 'history', 'history_costs', 'message_tokens', 'conversation', 'next_version', 'keep_from')
+
+    def __init__(self, message: str, model: str, models: tuple, params: tuple, max_tokens: int, prompt,
+                 history: tuple, history_tokens, message_tokens: int, conversation):
+        self.message = message
+        self.model = model
+        # Модель из запроса клиента и резервные модели для массива models (см. route)
+        self.requested_model = model
+        self.fallbacks = ()
+        # Модели пакетной оценки стоимости (без повторов) или None
+        self.models = models
+        # ((поле, значение), ...) - переданные параметры генерации
+        self.params = params
+        self.max_tokens = max_tokens
+        # PromptVariant или None, если системный промпт выключен
+        self.prompt = prompt
+        # Проверенные сообщения {'role', 'content'}; не изменяются (у диалога - общие с conversation_store)
+        self.history = history
+        self.history_costs = tuple(tokens + MESSAGE_OVERHEAD_TOKENS for tokens in history_tokens)
+        self.message_tokens = message_tokens
+        self.conversation = conversation
+        # Версия диалога после записи этого хода (клиент получает ее заранее в X-Conversation-Next-Version)
+        self.next_version = new_version() if conversation is not None else None
+        # В payload идет history[keep_from:] (см. fit)
+        self.keep_from = 0
+
+    @property
+    def fixed_tokens(self) -> int:
+        """Токены системного промпта и текущего сообщения (с накладными расходами)"""
+        tokens = self.message_tokens + MESSAGE_OVERHEAD_TOKENS
+        if self.prompt is not None:
+            tokens += self.prompt.tokens + MESSAGE_OVERHEAD_TOKENS
+        return tokens
+
+    def plan(self, model: str = None, record: bool = False) -> tuple:
+        """(keep_from, report) обрезки истории под модель model (по умолчанию - модель запроса)"""
+        return plan_history(model or self.model, self.max_tokens, self.fixed_tokens, self.history_costs, record)
+
+    @property
+    def routed(self) -> bool:
+        """Запрос уходит не к модели клиента, а к резервной"""
+        return self.model != self.requested_model
+
+    def route(self) -> None:
+        """Выбирает модель по телеметрии (model_router): резервную, если модель клиента не укладывается в SLO"""
+        self.model, self.fallbacks = route_model(self.requested_model)
+
+    def fit(self) -> dict:
+        """Обрезает историю под бюджет модели запроса перед отправкой; возвращает отчет plan_history"""
+        self.keep_from, report = self.plan(record=True)
+        return report
+
+    def prompt_tokens(self, model: str = None) -> int:
+        """Входные токены запроса после обрезки истории под модель model (без модели - вся история)"""
+        model = model or self.model
+        if model is None:
+            return self.fixed_tokens + sum(self.history_costs)
+        _, report = self.plan(model)
+        return self.fixed_tokens + report['kept_tokens']
+
+    def payload(self, stream: bool = False) -> dict:
+        """Payload для OpenRouter: [system?] + история (после fit) + текущее сообщение и параметры"""
+        messages = [{'role': 'system', 'content': self.prompt.text}] if self.prompt is not None else []
+        messages.extend(self.history[self.keep_from:])
+        messages.append({'role': 'user', 'content': self.message})
+        payload = {'model': self.model, 'messages': messages}
+        if self.fallbacks:
+            # OpenRouter переходит к следующей модели массива, если провайдер модели откажет
+            payload['models'] = [self.model, *self.fallbacks]
+        if stream:
+            payload['stream'] = True
+        payload.update(self.params)
+        return payload
+
+
+def _error(message: str, status: int = 400) -> tuple:
+    return {'error': message}, status
+
+
+def _validate_history(history):
+    """
+    Валидирует историю сообщений из запроса.
+
+    Returns:
+        tuple: (validated_history, error_response)
+    """
+    validated_history = []
+    if history is None:
+        return validated_history, None
+
+    if not isinstance(history, list):
+        return None, _error('history должен быть массивом')
+
+    # Валидируем каждое сообщение в истории
+    for i, msg in enumerate(history):
+        if not isinstance(msg, dict):
+            return None, _error(f'Сообщение {i} в history должно быть объектом')
+
+        role = msg.get('role')
+        content = msg.get('content')
+
+        if role not in ('user', 'assistant'):
+            return None, _error(f'role в сообщении {i} должен быть "user" или "assistant"')
+
+        if not isinstance(content, str):
+            return None, _error(f'content в сообщении {i} должен быть строкой')
+
+        validated_history.append({'role': role, 'content': content})
+
+    return validated_history, None
+
+
+def _resolve_history(data: dict, seed: bool = True):
+    """
+    Возвращает историю запроса: из поля history или из диалога на сервере.
+
+    Режим диалога включается полем conversation_id:
+    - conversation_id: null (+ history) - создать диалог из истории клиента (id выдает сервер)
+    - conversation_id + history - заменить историю диалога (пересинхронизация);
+      если сервер не знает этот id, создается новый диалог с новым id
+    - conversation_id + conversation_version без history - взять историю с сервера;
+      если версии не совпадают, ответ 409 и клиент отправляет history целиком
+
+    Если режим диалога выключен (несколько воркеров без общего хранилища), запрос обрабатывается
+    без диалога: history используется как есть, без history - ответ 409 с conversation_id: null.
+
+    Args:
+        seed: Сохранять историю клиента в диалог (False для оценки стоимости)
+
+    Returns:
+        tuple: (history, history_tokens, conversation, error_response)
+               history_tokens - оценки токенов диалога на сервере или None
+    """
+    history = data.get('history')
+    if 'conversation_id' not in data:
+        validated_history, error_response = _validate_history(history)
+        return validated_history, None, None, error_response
+
+    conversation_id = data.get('conversation_id')
+    if conversation_id is not None and (
+        not isinstance(conversation_id, str) or not _CONVERSATION_ID_RE.match(conversation_id)
+    ):
+        return None, None, None, _error('conversation_id должен быть id диалога, который выдал сервер')
+
+    if history is not None or not conversation_id:
+        validated_history, error_response = _validate_history(history)
+        if error_response or not seed or not CONVERSATIONS_ENABLED:
+            return validated_history, None, None, error_response
+        conversation = seed_conversation(conversation_id, validated_history)
+        return conversation.messages, conversation.token_counts, conversation, None
+
+    version = data.get('conversation_version')
+    if not isinstance(version, str) or not _CONVERSATION_VERSION_RE.match(version):
+        return None, None, None, _error('conversation_version должен быть версией, которую выдал сервер')
+
+    if not CONVERSATIONS_ENABLED:
+        return None, None, None, ({
+            'error': 'Режим диалога выключен на сервере - отправьте history',
+            'conversation_id': None,
+            'conversation_version': None
+        }, 409)
+
+    conversation, current_version = get_conversation(conversation_id, version)
+    if conversation is None:
+        return None, None, None, ({
+            'error': 'История диалога на сервере не совпадает с клиентом - отправьте history',
+            'conversation_id': conversation_id,
+            'conversation_version': current_version
+        }, 409)
+    return conversation.messages, conversation.token_counts, conversation, None
+
+
+def _validate_params(data: dict):
+    """
+    Проверяет параметры генерации (переданные - в payload, отсутствующие не добавляются).
+
+    Returns:
+        tuple: (params, max_tokens, error_response)
+    """
+    params = []
+    for name, low, high in _FLOAT_PARAMS:
+        value = data.get(name)
+        if value is None:
+            continue
+        try:
+            value = float(value)
+        except (ValueError, TypeError):
+            return None, None, _error(f'{name} должен быть числом')
+        if not (low <= value <= high):
+            return None, None, _error(f'{name} должен быть от {low} до {high}')
+        params.append((name, value))
+
+    # Обрабатываем null/0 как "без лимита" - не добавляем в payload
+    max_tokens = data.get('max_tokens')
+    if max_tokens == 0 or max_tokens == '':
+        max_tokens = None
+    if max_tokens is not None:
+        try:
+            max_tokens = int(max_tokens)
+        except (ValueError, TypeError):
+            return None, None, _error('max_tokens должен быть целым числом')
+        if not (1 <= max_tokens <= MAX_COMPLETION_TOKENS):
+            return None, None, _error(f'max_tokens должен быть от 1 до {MAX_COMPLETION_TOKENS}')
+        params.append(('max_tokens', max_tokens))
+
+    return tuple(params), max_tokens, None
+
+
+def _validate_models(models):
+    """Список моделей пакетной оценки -> кортеж без повторов (порядок сохраняется)"""
+    if not isinstance(models, list) or not models or not all(isinstance(m, str) and m for m in models):
+        return None, _error('Поле "models" обязательно и должно быть непустым массивом строк')
+    if len(models) > MAX_ESTIMATE_BATCH_MODELS:
+        return None, _error(f'Не больше {MAX_ESTIMATE_BATCH_MODELS} моделей в одном запросе')
+    return tuple(dict.fromkeys(models)), None
+
+
+def prepare_request(data, estimate: bool = False, batch: bool = False):
+    """
+    Проверяет запрос чата или оценки стоимости и собирает PreparedRequest.
+
+    Args:
+        data: JSON тело запроса
+        estimate: Оценка стоимости: диалог на сервере не изменяется, текст сообщения (черновик,
+                  меняется с каждым нажатием) не попадает в кэш оценок токенов
+        batch: Пакетная оценка: вместо поля "model" - список "models"
+
+    Returns:
+        tuple: (PreparedRequest, None) или (None, error_response), где error_response - ({'error': ...}, status)
+    """
+    if not data or not isinstance(data, dict):
+        return None, _error('Отсутствуют данные в запросе')
+
+    message = data.get('message')
+    if not message or not isinstance(message, str):
+        return None, _error('Поле "message" обязательно и должно быть строкой')
+
+    model = models = None
+    if batch:
+        models, error_response = _validate_models(data.get('models'))
+        if error_response:
+            return None, error_response
+    else:
+        model = data.get('model')
+        if not model or not isinstance(model, str):
+            return None, _error('Поле "model" обязательно и должно быть строкой')
+
+    params, max_tokens, error_response = _validate_params(data)
+    if error_response:
+        return None, error_response
+
+    verbosity = data.get('verbosity')
+    if verbosity is not None and verbosity not in VERBOSITY_LEVELS:
+        return None, _error('verbosity должен быть: low, medium или high')
+
+    # История из запроса или из диалога на сервере (оценка диалог не изменяет)
+    history, history_tokens, conversation, error_response = _resolve_history(data, seed=not estimate)
+    if error_response:
+        return None, error_response
+    if history_tokens is None or len(history_tokens) != len(history):
+        history_tokens = [count_message_tokens(msg['content']) for msg in history]
+
+    # Системный промпт только если он включен в настройках
+    prompt = None
+    if data.get('use_system_prompt', True) is not False:
+        prompt = get_prompt_variant(use_ia_style=data.get('use_ia_style', False), verbosity=verbosity)
+        if not prompt.text:
+            prompt = None
+
+    message_tokens = estimate_token_count(message) if estimate else count_message_tokens(message)
+    return PreparedRequest(message, model, models, params, max_tokens, prompt, tuple(history), history_tokens,
+                           message_tokens, conversation), None
@@ -0,0 +1,572 @@
+"""
+Устойчивость запросов к OpenRouter: повторы до первого токена, выключатель по моделям и хеджирование.
+
+- Повтор: ошибка соединения, таймаут или ответ 408/429/5xx до первого события data повторяется
+  до UPSTREAM_RETRIES раз с паузой "full jitter" (случайная от 0 до UPSTREAM_RETRY_BASE_DELAY * 2^n,
+  не больше UPSTREAM_RETRY_MAX_DELAY; Retry-After ответа 429 учитывается). После первого события поток
+  не повторяется: клиент уже получил часть ответа
+- Выключатель (circuit breaker) модели: после CIRCUIT_FAILURE_THRESHOLD неудач подряд запросы к модели
+  CIRCUIT_OPEN_SECONDS секунд сразу получают 503, затем пропускается одна пробная попытка
+  (успех закрывает выключатель, неудача снова открывает). Ответы 4xx (кроме 408/429) - не неудача модели.
+  Состояние - в памяти воркера
+- Хеджирование (только потоки, UPSTREAM_HEDGE_AFTER > 0): если за столько секунд нет первого события data,
+  параллельно отправляется такой же запрос; клиенту идет поток, который ответил первым, второй закрывается.
+  Вторая попытка оплачивается, поэтому по умолчанию хеджирование выключено
+
+Пока попытки идут, генератор потока ждет результат с таймаутом и отправляет клиенту keep-alive:
+- Flask путь: StreamStarter, попытки в фоновых потоках
+- ASGI путь: AsyncStreamStarter, попытки - asyncio задачи
+"""
+import os
+import time
+import queue
+import random
+import asyncio
+import logging
+import threading
+from abc import ABC, abstractmethod
+
+import httpx
+import requests
+
+from app.api import metrics
+
+logger = logging.getLogger(__name__)
+
+# Повторов запроса до первого токена (0 - без повторов)
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', '2'))
+
+# Базовая и максимальная пауза перед повтором (секунды)
+UPSTREAM_RETRY_BASE_DELAY = float(os.environ.get('UPSTREAM_RETRY_BASE_DELAY', '0.3'))
+UPSTREAM_RETRY_MAX_DELAY = float(os.environ.get('UPSTREAM_RETRY_MAX_DELAY', '4'))
+
+# Через сколько секунд без первого события data отправлять параллельный запрос (0 - выключено)
+UPSTREAM_HEDGE_AFTER = float(os.environ.get('UPSTREAM_HEDGE_AFTER', '0'))
+
+# Максимум параллельных (хеджирующих) запросов на один поток
+UPSTREAM_MAX_HEDGES = int(os.environ.get('UPSTREAM_MAX_HEDGES', '1'))
+
+# Неудач подряд, после которых выключатель модели открывается (0 - выключатель не используется)
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+
+# Сколько секунд открытый выключатель отклоняет запросы до пробной попытки
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', '30'))
+
+# Статусы OpenRouter, при которых запрос повторяется (и которые считаются неудачей модели)
+RETRYABLE_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
+CIRCUIT_OPEN_MESSAGE = 'Модель временно недоступна (много ошибок подряд). Повторите позже или выберите другую модель'
+
+
+class CircuitBreaker:
+    """Выключатель одной модели (изменяется под _lock)"""
+
+    __slots__ = ('model', 'state', 'failures', 'opened_at', 'probe_at', 'opens', 'rejected')
+
+    def __init__(self, model: str):
+        self.model = model
+        # 'closed' | 'open' | 'half_open'
+        self.state = 'closed'
+        # Неудач подряд
+        self.failures = 0
+        self.opened_at = 0.0
+        # Время пропуска последней пробной попытки (half_open)
+        self.probe_at = 0.0
+        self.opens = 0
+        self.rejected = 0
+
+
+# model -> CircuitBreaker; модели без неудач здесь не хранятся
+_breakers = {}
+_lock = threading.Lock()
+
+_stats = {
+    'attempts': 0,
+    'retries': 0,
+    'retries_exhausted': 0,
+    'hedges': 0,
+    'hedges_won': 0,
+    'circuit_opened': 0,
+    'circuit_rejected': 0,
+}
+
+
+def circuit_allows(model: str, endpoint: str = 'stream') -> bool:
+    """Можно ли отправить запрос к модели (в half_open пропускает одну пробную попытку)"""
+    if CIRCUIT_FAILURE_THRESHOLD <= 0:
+        return True
+    now = time.monotonic()
+    with _lock:
+        breaker = _breakers.get(model)
+        if breaker is None or breaker.state == 'closed':
+            return True
+        if breaker.state == 'open' and now - breaker.opened_at >= CIRCUIT_OPEN_SECONDS:
+            breaker.state = 'half_open'
+        # Пробная попытка без ответа дольше CIRCUIT_OPEN_SECONDS не держит выключатель вечно
+        if breaker.state == 'half_open' and now - breaker.probe_at >= CIRCUIT_OPEN_SECONDS:
+            breaker.probe_at = now
+            return True
+        breaker.rejected += 1
+        _stats['circuit_rejected'] += 1
+    metrics.inc('aichat_circuit_rejected_total', labels=(('endpoint', endpoint), ('model', model)))
+    return False
+
+
+def record_result(model: str, ok: bool) -> None:
+    """Учитывает результат попытки в выключателе модели"""
+    if CIRCUIT_FAILURE_THRESHOLD <= 0:
+        return
+    opened = False
+    with _lock:
+        breaker = _breakers.get(model)
+        if ok:
+            # Открытый выключатель закрывает только пробная попытка: успех запроса, отправленного
+            # до открытия и ответившего позже, его не закрывает
+            if breaker is not None and breaker.state != 'open':
+                if breaker.state == 'half_open':
+                    logger.info(f"Выключатель модели {model} закрыт: пробный запрос успешен")
+                del _breakers[model]
+            return
+        if breaker is None:
+            breaker = _breakers[model] = CircuitBreaker(model)
+        breaker.failures += 1
+        if breaker.state == 'half_open' or (
+            breaker.state == 'closed' and breaker.failures >= CIRCUIT_FAILURE_THRESHOLD
+        ):
+            breaker.state = 'open'
+            breaker.opened_at = time.monotonic()
+            breaker.opens += 1
+            _stats['circuit_opened'] += 1
+            opened = True
+    if opened:
+        logger.warning(f"Выключатель модели {model} открыт на {CIRCUIT_OPEN_SECONDS:.0f} сек "
+                       f"({breaker.failures} неудач подряд)")
+        metrics.inc('aichat_circuit_open_total', labels=(('model', model),))
+
+
+def circuit_state(model: str) -> str:
+    """
+    Состояние выключателя модели без побочных эффектов (в отличие от circuit_allows):
+    'open' - запрос сейчас будет отклонен, 'half_open' - пройдет как пробный, 'closed' - выключатель не сработал
+    """
+    if CIRCUIT_FAILURE_THRESHOLD <= 0:
+        return 'closed'
+    now = time.monotonic()
+    with _lock:
+        breaker = _breakers.get(model)
+        if breaker is None or breaker.state == 'closed':
+            return 'closed'
+        if breaker.state == 'open' and now - breaker.opened_at < CIRCUIT_OPEN_SECONDS:
+            return 'open'
+        if now - breaker.probe_at < CIRCUIT_OPEN_SECONDS:
+            return 'open'
+        return 'half_open'
+
+
+def retry_delay(retry: int, retry_after: str = None) -> float:
+    """Пауза перед повтором номер retry (с 0): full jitter, не меньше Retry-After (в пределах максимума)"""
+    delay = random.uniform(0, min(UPSTREAM_RETRY_MAX_DELAY, UPSTREAM_RETRY_BASE_DELAY * 2 ** retry))
+    if retry_after:
+        try:
+            delay = max(delay, min(float(retry_after), UPSTREAM_RETRY_MAX_DELAY))
+        except ValueError:
+            pass
+    return delay
+
+
+def _is_failure(kind: str, value) -> bool:
+    return kind != 'ready' and (kind != 'response' or value.status_code in RETRYABLE_STATUSES)
+
+
+def _failure_reason(kind: str, value) -> str:
+    return f'http_{value.status_code}' if kind == 'response' else kind
+
+
+def _retry_after(kind: str, value):
+    return value.headers.get('Retry-After') if kind == 'response' else None
+
+
+def _note_retry(endpoint: str, reason: str) -> None:
+    with _lock:
+        _stats['retries'] += 1
+    metrics.inc('aichat_upstream_retries_total', labels=(('endpoint', endpoint), ('reason', reason)))
+
+
+def _note_exhausted() -> None:
+    with _lock:
+        _stats['retries_exhausted'] += 1
+
+
+def send_with_retries(send, model: str, endpoint: str = 'chat') -> tuple:
+    """
+    Запрос к OpenRouter без потока (/api/chat) с повторами и выключателем модели.
+
+    Args:
+        send: Функция без аргументов, отправляющая запрос (возвращает requests.Response)
+
+    Returns:
+        tuple: (kind, value, retries):
+               ('response', requests.Response) - ответ (после повторов статус может быть ошибкой),
+               ('timeout' | 'network_error', исключение requests) или ('circuit_open', None)
+    """
+    if not circuit_allows(model, endpoint):
+        return 'circuit_open', None, 0
+    retries = 0
+    while True:
+        with _lock:
+            _stats['attempts'] += 1
+        try:
+            kind, value = 'response', send()
+        except requests.exceptions.Timeout as e:
+            kind, value = 'timeout', e
+        except requests.exceptions.RequestException as e:
+            kind, value = 'network_error', e
+
+        failed = _is_failure(kind, value)
+        record_result(model, not failed)
+        if not failed:
+            return kind, value, retries
+        if retries >= UPSTREAM_RETRIES or not circuit_allows(model, endpoint):
+            if retries:
+                _note_exhausted()
+            return kind, value, retries
+
+        delay = retry_delay(retries, _retry_after(kind, value))
+        _note_retry(endpoint, _failure_reason(kind, value))
+        logger.info(f"Повтор запроса к {model} через {delay:.2f} сек ({_failure_reason(kind, value)})")
+        if kind == 'response':
+            value.close()
+        time.sleep(delay)
+        retries += 1
+
+
+class _Attempt:
+    """Одна попытка открыть поток к OpenRouter"""
+
+    __slots__ = ('index', 'hedge', 'cancelled', 'handled', 'response', 'task')
+
+    def __init__(self, index: int, hedge: bool):
+        self.index = index
+        self.hedge = hedge
+        self.cancelled = False
+        self.handled = False
+        self.response = None
+        self.task = None
+
+
+class _StreamStart(ABC):
+    """
+    Решения, общие для Flask и ASGI: когда повторять, когда хеджировать, какая попытка победила.
+    Попытка завершается одним из результатов:
+    ('ready', (response, первые порции, итератор остальных)) - пришло первое событие data (или поток кончился),
+    ('response', response) - ответ с ошибкой (тело прочитано), ('timeout' | 'network_error', исключение)
+    """
+
+    def __init__(self, model: str, endpoint: str = 'stream'):
+        self.model = model
+        self.endpoint = endpoint
+        self.retries = 0
+        self.hedges = 0
+        # (kind, value) итогового результата, ('circuit_open', None) или None, пока попытки идут
+        self.result = None
+        self.winner = None
+        self.attempts = []
+        self._in_flight = 0
+        self._retry_at = None
+        self._hedge_at = None
+
+    def _start(self) -> None:
+        if not circuit_allows(self.model, self.endpoint):
+            self.result = ('circuit_open', None)
+            return
+        self._launch(hedge=False)
+
+    def _launch(self, hedge: bool) -> None:
+        attempt = _Attempt(len(self.attempts), hedge)
+        self.attempts.append(attempt)
+        self._in_flight += 1
+        with _lock:
+            _stats['attempts'] += 1
+        if UPSTREAM_HEDGE_AFTER > 0 and self.hedges < UPSTREAM_MAX_HEDGES:
+            self._hedge_at = time.monotonic() + UPSTREAM_HEDGE_AFTER
+        self._run(attempt)
+
+    @abstractmethod
+    def _run(self, attempt: _Attempt) -> None:
+        """Запускает попытку (поток для Flask, asyncio задача для ASGI); результат - через _on_result"""
+
+    def _next_timer(self):
+        timers = [t for t in (self._retry_at, self._hedge_at) if t is not None]
+        return min(timers) if timers else None
+
+    def _fire_timers(self, now: float) -> None:
+        if self._retry_at is not None and now >= self._retry_at:
+            self._retry_at = None
+            self.retries += 1
+            self._launch(hedge=False)
+        if self._hedge_at is not None and now >= self._hedge_at:
+            self._hedge_at = None
+            if self._in_flight and self.hedges < UPSTREAM_MAX_HEDGES and circuit_allows(self.model, self.endpoint):
+                self.hedges += 1
+                with _lock:
+                    _stats['hedges'] += 1
+                metrics.inc('aichat_upstream_hedges_total', labels=(('result', 'launched'),))
+                logger.info(f"Нет первого токена от {self.model} за {UPSTREAM_HEDGE_AFTER:.1f} сек - параллельный запрос")
+                self._launch(hedge=True)
+
+    def _on_result(self, attempt: _Attempt, kind: str, value) -> None:
+        attempt.handled = True
+        self._in_flight -= 1
+        if self.result is not None or attempt.cancelled:
+            return
+
+        failed = _is_failure(kind, value)
+        record_result(self.model, not failed)
+        if not failed:
+            self.result = (kind, value)
+            self.winner = attempt
+            if self.hedges:
+                won = 'won' if attempt.hedge else 'lost'
+                if attempt.hedge:
+                    with _lock:
+                        _stats['hedges_won'] += 1
+                metrics.inc('aichat_upstream_hedges_total', labels=(('result', won),))
+            return
+
+        reason = _failure_reason(kind, value)
+        if self._in_flight:
+            # Параллельная попытка еще идет - ждем ее
+            logger.info(f"Попытка {attempt.index + 1} к {self.model} не удалась ({reason}), ждем параллельную")
+            return
+        if self.retries < UPSTREAM_RETRIES and circuit_allows(self.model, self.endpoint):
+            delay = retry_delay(self.retries, _retry_after(kind, value))
+            self._retry_at = time.monotonic() + delay
+            self._hedge_at = None
+            _note_retry(self.endpoint, reason)
+            logger.info(f"Повтор потока к {self.model} через {delay:.2f} сек ({reason})")
+            return
+        if self.retries:
+            _note_exhausted()
+        self.result = (kind, value)
+
+    def _wait_timeout(self, deadline: float, now: float) -> float:
+        timer = self._next_timer()
+        return max(0.0, min(deadline, timer) - now if timer is not None else deadline - now)
+
+    def _losers(self) -> list:
+        return [attempt for attempt in self.attempts if attempt is not self.winner]
+
+
+class StreamStarter(_StreamStart):
+    """
+    Открывает поток к OpenRouter (Flask путь). Попытки идут в фоновых потоках,
+    wait() ждет итог не дольше таймаута, чтобы генератор мог отправлять клиенту keep-alive.
+    """
+
+    def __init__(self, open_stream, model: str, endpoint: str = 'stream'):
+        """
+        Args:
+            open_stream: Функция без аргументов: requests.Response потокового запроса к OpenRouter
+        """
+        super().__init__(model, endpoint)
+        self._open = open_stream
+        self._results = queue.Queue()
+        self._start()
+
+    def _run(self, attempt: _Attempt) -> None:
+        threading.Thread(target=self._attempt, args=(attempt,), name='upstream-attempt', daemon=True).start()
+
+    def _attempt(self, attempt: _Attempt) -> None:
+        try:
+            response = self._open()
+        except requests.exceptions.Timeout as e:
+            self._results.put((attempt, 'timeout', e))
+            return
+        except requests.exceptions.RequestException as e:
+            self._results.put((attempt, 'network_error', e))
+            return
+
+        attempt.response = response
+        if attempt.cancelled:
+            response.close()
+            return
+        if response.status_code != 200:
+            # Тело ошибки читаем здесь, соединение сразу возвращаем в пул
+            response.content
+            response.close()
+            self._results.put((attempt, 'response', response))
+            return
+
+        chunks = response.iter_content(chunk_size=None)
+        first = []
+        try:
+            for chunk in chunks:
+                first.append(chunk)
+                if b'data:' in chunk:
+                    break
+        except requests.exceptions.RequestException as e:
+            response.close()
+            self._results.put((attempt, 'network_error', e))
+            return
+        if attempt.cancelled:
+            response.close()
+            return
+        self._results.put((attempt, 'ready', (response, first, chunks)))
+
+    def wait(self, timeout: float):
+        """
+        Ждет итог не дольше timeout секунд.
+
+        Returns:
+            tuple | None: (kind, value) или None, если попытки еще идут
+        """
+        deadline = time.monotonic() + timeout
+        while self.result is None:
+            now = time.monotonic()
+            self._fire_timers(now)
+            if now >= deadline:
+                return None
+            try:
+                attempt, kind, value = self._results.get(timeout=self._wait_timeout(deadline, now))
+            except queue.Empty:
+                continue
+            self._on_result(attempt, kind, value)
+        self.close()
+        return self.result
+
+    def close(self) -> None:
+        """Закрывает проигравшие и незавершенные попытки (итоговый ответ закрывает вызывающий код)"""
+        # response.close() из другого потока ждет, пока чтение в потоке попытки не вернется (до первого токена),
+        # поэтому попытка только помечается: ее поток сам закроет ответ, как только чтение завершится
+        for attempt in self._losers():
+            attempt.cancelled = True
+        # Результаты, которые уже в очереди, но не будут прочитаны
+        while True:
+            try:
+                attempt, kind, value = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'ready' and attempt is not self.winner:
+                value[0].close()
+
+
+class AsyncStreamStarter(_StreamStart):
+    """Открывает поток к OpenRouter (ASGI путь): попытки - asyncio задачи"""
+
+    def __init__(self, open_stream, model: str, endpoint: str = 'stream'):
+        """
+        Args:
+            open_stream: Корутинная функция без аргументов: httpx.Response (client.send(..., stream=True))
+        """
+        super().__init__(model, endpoint)
+        self._open = open_stream
+        self._start()
+
+    def _run(self, attempt: _Attempt) -> None:
+        attempt.task = asyncio.ensure_future(self._attempt(attempt))
+
+    async def _attempt(self, attempt: _Attempt) -> tuple:
+        try:
+            response = await self._open()
+        except httpx.TimeoutException as e:
+            return 'timeout', e
+        except httpx.HTTPError as e:
+            return 'network_error', e
+
+        attempt.response = response
+        try:
+            if response.status_code != 200:
+                await response.aread()
+                await response.aclose()
+                return 'response', response
+
+            chunks = response.aiter_bytes().__aiter__()
+            first = []
+            try:
+                async for chunk in chunks:
+                    first.append(chunk)
+                    if b'data:' in chunk:
+                        break
+            except httpx.HTTPError as e:
+                await response.aclose()
+                return 'network_error', e
+            return 'ready', (response, first, chunks)
+        except asyncio.CancelledError:
+            await response.aclose()
+            raise
+
+    async def wait(self, timeout: float):
+        """
+        Ждет итог не дольше timeout секунд.
+
+        Returns:
+            tuple | None: (kind, value) или None, если попытки еще идут
+        """
+        deadline = time.monotonic() + timeout
+        while self.result is None:
+            now = time.monotonic()
+            self._fire_timers(now)
+            if now >= deadline:
+                return None
+            pending = [attempt for attempt in self.attempts if not attempt.handled]
+            wait_timeout = self._wait_timeout(deadline, now)
+            if not pending:
+                await asyncio.sleep(wait_timeout)
+                continue
+            done, _ = await asyncio.wait([attempt.task for attempt in pending], timeout=wait_timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for attempt in pending:
+                if attempt.task in done and self.result is None:
+                    kind, value = attempt.task.result()
+                    self._on_result(attempt, kind, value)
+        await self.aclose()
+        return self.result
+
+    async def aclose(self) -> None:
+        """Отменяет проигравшие и незавершенные попытки (итоговый ответ закрывает вызывающий код)"""
+        for attempt in self._losers():
+            attempt.cancelled = True
+            task = attempt.task
+            if task is None:
+                continue
+            if not task.done():
+                task.cancel()
+            results = await asyncio.gather(task, return_exceptions=True)
+            if isinstance(results[0], tuple) and results[0][0] == 'ready':
+                await results[0][1][0].aclose()
+
+
+def get_resilience_stats() -> dict:
+    """
+    Статистика повторов, хеджирования и выключателей текущего воркера.
+
+    Returns:
+        dict: {'attempts': int, 'retries': int, 'retries_exhausted': int, 'hedges': int, 'hedges_won': int,
+               'circuit_opened': int, 'circuit_rejected': int,
+               'circuits': {model: {'state': str, 'failures': int, 'open_for': float, 'rejected': int}},
+               'settings': {...}}
+    """
+    now = time.monotonic()
+    with _lock:
+        stats = dict(_stats)
+        circuits = {
+            model: {
+                'state': breaker.state,
+                'failures': breaker.failures,
+                'open_for': round(max(0.0, CIRCUIT_OPEN_SECONDS - (now - breaker.opened_at)), 1)
+                if breaker.state == 'open' else 0.0,
+                'rejected': breaker.rejected,
+            }
+            for model, breaker in _breakers.items()
+        }
+    stats['circuits'] = circuits
+    stats['settings'] = {
+        'retries': UPSTREAM_RETRIES,
+        'retry_base_delay': UPSTREAM_RETRY_BASE_DELAY,
+        'retry_max_delay': UPSTREAM_RETRY_MAX_DELAY,
+        'hedge_after': UPSTREAM_HEDGE_AFTER,
+        'max_hedges': UPSTREAM_MAX_HEDGES,
+        'circuit_failure_threshold': CIRCUIT_FAILURE_THRESHOLD,
+        'circuit_open_seconds': CIRCUIT_OPEN_SECONDS,
+    }
+    return stats
@@ -0,0 +1,328 @@
+"""
+Кэш ответов /api/chat и /api/chat/stream по точному совпадению запроса (opt-in).
+
+Ключ - sha256 канонического JSON итогового payload для OpenRouter (модель, сообщения
+с системным промптом и историей, temperature, top_p, штрафы, max_tokens; поле stream не учитывается,
+поэтому обычный и потоковый запросы делят один кэш).
+
+Уровни:
+- память процесса: LRU с TTL и лимитом по байтам
+- диск (опционально, RESPONSE_CACHE_DIR, например /data/response_cache на Amvera):
+  файл на ключ, общий для всех воркеров и переживает перезапуск
+
+Включается переменной RESPONSE_CACHE_ENABLED=1. Ответы моделей с temperature > 0 не детерминированы,
+поэтому повторный вопрос получит тот же ответ, что и в первый раз.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from app.api.streaming import SSE_COALESCE_MAX_BYTES, sse_event, token_event
+from app.config.prompt_loader import find_prompt_variant
+
+logger = logging.getLogger(__name__)
+
+# Кэш ответов включен
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', '0') == '1'
+
+# Время жизни записи (секунд)
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '3600'))
+
+# Лимит памяти под записи в процессе (байт)
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+
+# Каталог дискового уровня (пусто - только память)
+RESPONSE_CACHE_DIR = os.environ.get('RESPONSE_CACHE_DIR', '')
+
+# Лимит дискового уровня (байт), при превышении удаляются самые старые файлы
+RESPONSE_CACHE_DISK_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_DISK_MAX_BYTES', str(256 * 1024 * 1024)))
+
+# Чистка диска (просроченные и лишние файлы) раз в столько записей
+_DISK_PRUNE_EVERY = 64
+
+# Причины завершения, с которыми ответ можно кэшировать
+_CACHEABLE_FINISH_REASONS = ('stop', 'length')
+
+# key -> (expires_at, size, entry)
+_memory = OrderedDict()
+_memory_bytes = 0
+_lock = threading.Lock()
+_disk_writes = 0
+
+_stats = {
+    'hits_memory': 0,
+    'hits_disk': 0,
+    'misses': 0,
+    'stores': 0,
+    'evictions': 0,
+    'expired': 0,
+    'saved_cost_rub': 0.0,
+    'saved_tokens': 0,
+}
+
+
+def cache_key(payload: dict) -> str:
+    """
+    Ключ кэша: sha256 канонического JSON payload без поля stream.
+    Системный промпт из реестра заменяется его готовым хэшем (не сериализуем ~13 КБ на каждый запрос).
+    """
+    canonical = {k: v for k, v in payload.items() if k != 'stream'}
+    messages = canonical.get('messages')
+    if messages and messages[0].get('role') == 'system':
+        variant = find_prompt_variant(messages[0].get('content'))
+        if variant is not None:
+            canonical['messages'] = [{'role': 'system', 'prompt_hash': variant.hash}] + messages[1:]
+    raw = json.dumps(canonical, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _disk_path(key: str) -> str:
+    return os.path.join(RESPONSE_CACHE_DIR, f'{key}.json')
+
+
+def _memory_put(key: str, expires_at: float, size: int, entry: dict) -> None:
+    """Кладет запись в память и вытесняет самые старые по использованию записи сверх лимита (под _lock)"""
+    global _memory_bytes
+    if size > RESPONSE_CACHE_MAX_BYTES:
+        return
+    old = _memory.pop(key, None)
+    if old is not None:
+        _memory_bytes -= old[1]
+    _memory[key] = (expires_at, size, entry)
+    _memory_bytes += size
+    while _memory_bytes > RESPONSE_CACHE_MAX_BYTES:
+        _, (_, evicted_size, _) = _memory.popitem(last=False)
+        _memory_bytes -= evicted_size
+        _stats['evictions'] += 1
+
+
+def _disk_get(key: str):
+    """Читает запись с диска, возвращает (expires_at, size, entry) или None"""
+    path = _disk_path(key)
+    try:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        record = json.loads(raw)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Не удалось прочитать запись кэша ответов {path}: {e}")
+        return None
+
+    if record.get('expires_at', 0) <= time.time():
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    return record['expires_at'], len(raw), record['entry']
+
+
+def _disk_put(key: str, expires_at: float, raw: bytes) -> None:
+    """Атомарно записывает запись на диск (tmp + rename, безопасно для нескольких воркеров)"""
+    global _disk_writes
+    path = _disk_path(key)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.makedirs(RESPONSE_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(raw)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Не удалось записать запись кэша ответов {path}: {e}")
+        return
+
+    with _lock:
+        _disk_writes += 1
+        prune = _disk_writes % _DISK_PRUNE_EVERY == 0
+    if prune:
+        _prune_disk()
+
+
+def _prune_disk() -> None:
+    """Удаляет просроченные файлы и самые старые файлы сверх RESPONSE_CACHE_DISK_MAX_BYTES"""
+    now = time.time()
+    files = []
+    total = 0
+    try:
+        names = os.listdir(RESPONSE_CACHE_DIR)
+    except OSError:
+        return
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(RESPONSE_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        # Файл записан в момент expires_at - TTL, поэтому просрочку можно определить по mtime
+        if stat.st_mtime + RESPONSE_CACHE_TTL <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+
+    if total <= RESPONSE_CACHE_DISK_MAX_BYTES:
+        return
+    files.sort()
+    for _, size, path in files:
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        if total <= RESPONSE_CACHE_DISK_MAX_BYTES:
+            break
+
+
+def get_cached_response(key: str):
+    """
+    Ищет ответ в кэше (сначала в памяти, затем на диске).
+
+    Returns:
+        dict: {'content': str, 'model': str, 'finish_reason': str, 'cost': dict или None} или None
+    """
+    global _memory_bytes
+    now = time.time()
+    entry = None
+    with _lock:
+        item = _memory.get(key)
+        if item is not None:
+            if item[0] > now:
+                _memory.move_to_end(key)
+                entry = item[2]
+                _stats['hits_memory'] += 1
+            else:
+                del _memory[key]
+                _memory_bytes -= item[1]
+                _stats['expired'] += 1
+
+    if entry is None and RESPONSE_CACHE_DIR:
+        item = _disk_get(key)
+        if item is not None:
+            entry = item[2]
+            with _lock:
+                _memory_put(key, *item)
+                _stats['hits_disk'] += 1
+
+    with _lock:
+        if entry is None:
+            _stats['misses'] += 1
+            return None
+        cost = entry.get('cost')
+        if cost:
+            _stats['saved_cost_rub'] += cost.get('total_cost_rub', 0.0)
+            _stats['saved_tokens'] += cost.get('total_tokens', 0)
+    return entry
+
+
+def store_response(key: str, content: str, model: str, finish_reason: str, cost: dict = None) -> None:
+    """Сохраняет успешный ответ модели в кэш (пустые и оборванные ответы не кэшируются)"""
+    if not content or finish_reason not in _CACHEABLE_FINISH_REASONS:
+        return
+
+    entry = {'content': content, 'model': model, 'finish_reason': finish_reason, 'cost': cost}
+    expires_at = time.time() + RESPONSE_CACHE_TTL
+    raw = json.dumps({'expires_at': expires_at, 'entry': entry}, ensure_ascii=False).encode('utf-8')
+
+    with _lock:
+        _memory_put(key, expires_at, len(raw), entry)
+        _stats['stores'] += 1
+
+    if RESPONSE_CACHE_DIR:
+        _disk_put(key, expires_at, raw)
+
+
+def cached_cost(entry: dict):
+    """Стоимость повторного ответа из кэша: токены исходного запроса, 0 руб."""
+    cost = entry.get('cost')
+    if not cost:
+        return None
+    return {
+        'total_cost_rub': 0.0,
+        'prompt_tokens': cost.get('prompt_tokens', 0),
+        'completion_tokens': cost.get('completion_tokens', 0),
+        'total_tokens': cost.get('total_tokens', 0),
+        'saved_cost_rub': cost.get('total_cost_rub', 0.0)
+    }
+
+
+def _utf8_chunks(text: str, max_bytes: int):
+    """Части текста не больше max_bytes байт в UTF-8 (символ не разрезается)"""
+    data = text.encode('utf-8')
+    start = 0
+    while start < len(data):
+        end = min(start + max(max_bytes, 1), len(data))
+        # Байты продолжения (10xxxxxx) - середина символа: отступаем к его началу
+        while end < len(data) and (data[end] & 0xC0) == 0x80:
+            end -= 1
+        if end == start:
+            # Символ длиннее max_bytes - отдаем его целиком
+            end += 1
+            while end < len(data) and (data[end] & 0xC0) == 0x80:
+                end += 1
+        yield data[start:end].decode('utf-8')
+        start = end
+
+
+def replay_sse(entry: dict, request_id: str = None) -> bytes:
+    """SSE события с ответом из кэша в том же формате, что и поток от OpenRouter"""
+    # SSE_COALESCE_MAX_BYTES - порог в байтах, как у объединения токенов живого потока
+    events = [token_event(chunk) for chunk in _utf8_chunks(entry['content'], SSE_COALESCE_MAX_BYTES)]
+    final_data = {
+        'token': '',
+        'done': True,
+        'model': entry['model'],
+        'finish_reason': entry['finish_reason'],
+        'cached': True
+    }
+    if request_id:
+        final_data['request_id'] = request_id
+    cost = cached_cost(entry)
+    if cost:
+        final_data['cost'] = cost
+    events.append(sse_event(final_data))
+    return b''.join(events)
+
+
+def get_cache_stats() -> dict:
+    """
+    Статистика кэша ответов текущего воркера.
+
+    Returns:
+        dict: {'enabled': bool, 'entries': int, 'bytes': int, 'hits': int, 'misses': int,
+               'hit_rate': float, 'saved_cost_rub': float, 'saved_tokens': int, ...}
+    """
+    with _lock:
+        stats = dict(_stats)
+        entries = len(_memory)
+        memory_bytes = _memory_bytes
+
+    hits = stats['hits_memory'] + stats['hits_disk']
+    lookups = hits + stats['misses']
+    return {
+        'enabled': RESPONSE_CACHE_ENABLED,
+        'entries': entries,
+        'bytes': memory_bytes,
+        'max_bytes': RESPONSE_CACHE_MAX_BYTES,
+        'ttl': RESPONSE_CACHE_TTL,
+        'disk_dir': RESPONSE_CACHE_DIR or None,
+        'hits': hits,
+        'hits_memory': stats['hits_memory'],
+        'hits_disk': stats['hits_disk'],
+        'misses': stats['misses'],
+        'hit_rate': round(hits / lookups, 3) if lookups else 0.0,
+        'stores': stats['stores'],
+        'evictions': stats['evictions'],
+        'expired': stats['expired'],
+        'saved_cost_rub': round(stats['saved_cost_rub'], 2),
+        'saved_tokens': stats['saved_tokens'],
+    }
@@ -2,13 +2,42 @@
 API endpoints для работы с OpenRouter
 """
 import os
+import hmac
 import logging
-import json
+import functools
+import itertools
 import time
 import requests
-from flask import Blueprint, request, jsonify, Response, stream_with_context
-from app.api.cost_calculator import calculate_cost_rub, estimate_cost_rub
-from app.config.prompt_loader import get_system_prompt, get_combined_system_prompt
+from flask import Blueprint, request, jsonify, Response, stream_with_context, g
+from app.api.cost_calculator import (
+    calculate_cost_rub, cost_summary, cost_trace_fields, estimate_cost_rub, estimate_costs_rub, get_token_count_stats
+)
+from app.api.streaming import KEEP_ALIVE_EVENT, StreamRelay, error_event
+from app.api.stream_supervisor import (
+    SSE_HEARTBEAT_INTERVAL, StreamSupervisor, ThreadedChunkReader, STREAM_IDLE_TIMEOUT, record_stream_stats,
+    get_stream_stats
+)
+from app.api.response_cache import (
+    RESPONSE_CACHE_ENABLED, cache_key, get_cached_response, store_response, cached_cost, replay_sse, get_cache_stats
+)
+from app.api.history_budget import get_history_stats
+from app.api.conversation_store import TurnRecorder, append_turn, get_conversation_stats
+from app.api import metrics
+from app.api.compression import compress_response
+from app.api.metrics import render_metrics
+from app.api.model_router import get_models_health, record_sample, record_stream, record_upstream_failure
+from app.api.pricing_registry import get_pricing_stats
+from app.api.prompt_cache import with_prompt_caching
+from app.api.request_schema import prepare_request
+from app.api.resilience import CIRCUIT_OPEN_MESSAGE, StreamStarter, send_with_retries, get_resilience_stats
+from app.api.tracing import Trace, traced, get_tracing_stats
+from app.api.single_flight import SINGLE_FLIGHT_ENABLED, single_flight, stream_single_flight, get_single_flight_stats
+from app.api.upstream import (
+    OPENROUTER_API_URL, UPSTREAM_CONNECT_TIMEOUT, get_upstream_session, get_pool_stats, build_upstream_headers,
+    extract_upstream_error
+)
+from app.config.prompt_loader import get_system_prompt, get_prompt_stats
+from app.static_assets import get_static_stats
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -16,9 +45,14 @@ logger = logging.getLogger(__name__)
 
 api_bp = Blueprint('api', __name__)
 
-# URL OpenRouter API
-OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+# Сжатие JSON ответов и SSE потоков (см. compression.py)
+api_bp.after_request(compress_response)
 
+# Токен служебных endpoints /api/debug/stats и /api/metrics (пусто - они выключены)
+STATS_TOKEN = os.environ.get('STATS_TOKEN', '')
+
+# Предупреждение, добавляемое к ответу, обрезанному по max_tokens
+TRUNCATED_WARNING = '\n\n⚠️ **Внимание:** Ответ был обрезан из-за достижения лимита токенов. Увеличьте значение max_tokens в настройках для получения полного ответа.'
 
 
 def _extract_message_content(message: dict) -> str:
@@ -42,27 +76,46 @@ def _extract_message_content(message: dict) -> str:
             return val
     return content or ''
 
-def _extract_delta_text(delta: dict) -> str:
-    if not isinstance(delta, dict):
-        return ''
-    parts = []
-    content = delta.get('content')
-    if isinstance(content, str) and content:
-        parts.append(content)
-    elif isinstance(content, list):
-        for part in content:
-            if isinstance(part, dict):
-                text = part.get('text') or part.get('content')
-                if isinstance(text, str) and text:
-                    parts.append(text)
-    for key in ('reasoning', 'reasoning_content'):
-        val = delta.get(key)
-        if isinstance(val, str) and val:
-            parts.append(val)
-    return ''.join(parts)
+
+def history_report_headers(report: dict) -> dict:
+    """Заголовки ответа с результатом обрезки истории (сколько сообщений и токенов отброшено)"""
+    return {
+        'X-History-Dropped-Messages': str(report['dropped_messages']),
+        'X-History-Dropped-Tokens': str(report['dropped_tokens'])
+    }
+
+
+def _cached_chat_response(cached: dict) -> dict:
+    """Формирует ответ /api/chat из записи кэша ответов"""
+    content = cached['content']
+    if cached['finish_reason'] == 'length':
+        content += TRUNCATED_WARNING
+    response_json = {
+        'content': content,
+        'model': cached['model'],
+        'finish_reason': cached['finish_reason'],
+        'cached': True
+    }
+    cost = cached_cost(cached)
+    if cost:
+        response_json['cost'] = cost
+    return response_json
+
+
+def conversation_headers(prepared) -> dict:
+    """Заголовки ответа с id диалога, версией, на которой основан запрос, и версией после записи хода"""
+    conversation = prepared.conversation
+    if conversation is None:
+        return {}
+    return {
+        'X-Conversation-Id': conversation.id,
+        'X-Conversation-Version': conversation.version,
+        'X-Conversation-Next-Version': prepared.next_version
+    }
 
 
 @api_bp.route('/chat', methods=['POST'])
+@traced('chat')
 def chat():
     """
     Проксирует запрос к OpenRouter API
@@ -70,118 +123,33 @@ def chat():
     Принимает:
     {
         "message": "текст сообщения",
-        "model": "openai/gpt-4"
+        "model": "openai/gpt-4",
+        "conversation_id": "...", "conversation_version": "..."  // опционально, история с сервера
     }
     
     Возвращает:
     {
         "content": "ответ от модели",
-        "model": "использованная модель"
+        "model": "использованная модель",
+        "requested_model": "openai/gpt-4",  // если модель не укладывалась в SLO и ответила резервная
+        "conversation_id": "...", "conversation_version": "..."  // если запрос в режиме диалога
     }
     """
+    trace = g.trace
     try:
         # Получаем данные из запроса
         data = request.get_json()
         
-        if not data:
-            return jsonify({'error': 'Отсутствуют данные в запросе'}), 400
-        
-        message = data.get('message')
-        model = data.get('model')
-        
-        # Валидация обязательных полей
-        if not message or not isinstance(message, str):
-            return jsonify({'error': 'Поле "message" обязательно и должно быть строкой'}), 400
-        
-        if not model or not isinstance(model, str):
-            return jsonify({'error': 'Поле "model" обязательно и должно быть строкой'}), 400
-        
-        # Получаем опциональные параметры генерации
-        temperature = data.get('temperature')
-        max_tokens = data.get('max_tokens')
-        verbosity = data.get('verbosity')
-        frequency_penalty = data.get('frequency_penalty')
-        presence_penalty = data.get('presence_penalty')
-        top_p = data.get('top_p')
-        history = data.get('history')
-        use_system_prompt = data.get('use_system_prompt', True)
-        use_ia_style = data.get('use_ia_style', False)
-        
-        # Валидация параметров (если переданы)
-        if temperature is not None:
-            try:
-                temperature = float(temperature)
-                if not (0.0 <= temperature <= 2.0):
-                    return jsonify({'error': 'temperature должен быть от 0.0 до 2.0'}), 400
-            except (ValueError, TypeError):
-                return jsonify({'error': 'temperature должен быть числом'}), 400
-        
-        if max_tokens is not None:
-            # Обрабатываем null/0 как "без лимита" - не добавляем в payload
-            if max_tokens == 0 or max_tokens == '':
-                max_tokens = None
-            else:
-                try:
-                    max_tokens = int(max_tokens)
-                    if not (1 <= max_tokens <= 4000):
-                        return jsonify({'error': 'max_tokens должен быть от 1 до 4000'}), 400
-                except (ValueError, TypeError):
-                    return jsonify({'error': 'max_tokens должен быть целым числом'}), 400
-        
-        if verbosity is not None:
-            if verbosity not in ['low', 'medium', 'high']:
-                return jsonify({'error': 'verbosity должен быть: low, medium или high'}), 400
-        
-        if frequency_penalty is not None:
-            try:
-                frequency_penalty = float(frequency_penalty)
-                if not (-2.0 <= frequency_penalty <= 2.0):
-                    return jsonify({'error': 'frequency_penalty должен быть от -2.0 до 2.0'}), 400
-            except (ValueError, TypeError):
-                return jsonify({'error': 'frequency_penalty должен быть числом'}), 400
-        
-        if presence_penalty is not None:
-            try:
-                presence_penalty = float(presence_penalty)
-                if not (-2.0 <= presence_penalty <= 2.0):
-                    return jsonify({'error': 'presence_penalty должен быть от -2.0 до 2.0'}), 400
-            except (ValueError, TypeError):
-                return jsonify({'error': 'presence_penalty должен быть числом'}), 400
-        
-        if top_p is not None:
-            try:
-                top_p = float(top_p)
-                if not (0.0 <= top_p <= 1.0):
-                    return jsonify({'error': 'top_p должен быть от 0.0 до 1.0'}), 400
-            except (ValueError, TypeError):
-                return jsonify({'error': 'top_p должен быть числом'}), 400
-        
-        # Валидация истории (если передана)
-        validated_history = []
-        if history is not None:
-            if not isinstance(history, list):
-                return jsonify({'error': 'history должен быть массивом'}), 400
-            
-            # Валидируем каждое сообщение в истории
-            for i, msg in enumerate(history):
-                if not isinstance(msg, dict):
-                    return jsonify({'error': f'Сообщение {i} в history должно быть объектом'}), 400
-                
-                role = msg.get('role')
-                content = msg.get('content')
-                
-                if role not in ['user', 'assistant']:
-                    return jsonify({'error': f'role в сообщении {i} должен быть "user" или "assistant"'}), 400
-                
-                if not isinstance(content, str):
-                    return jsonify({'error': f'content в сообщении {i} должен быть строкой'}), 400
-                
-                validated_history.append({'role': role, 'content': content})
-            
-            # Ограничиваем историю последними 50 сообщениями для предотвращения превышения лимитов токенов
-            if len(validated_history) > 50:
-                validated_history = validated_history[-50:]
-                logger.warning(f"История обрезана до последних 50 сообщений")
+        # Валидация параметров и истории (общая с /chat/stream и /estimate-cost)
+        prepared, error_response = prepare_request(data)
+        if error_response:
+            return error_response
+        # Модель, которая не укладывается в SLO, заменяется резервной (model_router.py)
+        prepared.route()
+        message, model, conversation = prepared.message, prepared.model, prepared.conversation
+        trace.mark('validate')
+        if prepared.routed:
+            trace.set(requested_model=prepared.requested_model)
         
         # Получаем API ключ из переменных окружения
         api_key = os.environ.get('OPENROUTER_API_KEY')
@@ -192,59 +160,99 @@ def chat():
         http_referer = os.environ.get('HTTP_REFERER', request.headers.get('Origin', ''))
         
         # Подготавливаем запрос к OpenRouter
-        headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json'
-        }
-        
-        if http_referer:
-            headers['HTTP-Referer'] = http_referer
-        
-        # Формируем массив сообщений с системным промптом и историей
-        messages = []
-        # Добавляем системный промпт только если он включен в настройках
-        if use_system_prompt is not False:
-            system_prompt = get_combined_system_prompt(use_ia_style=use_ia_style, verbosity=verbosity)
-            if system_prompt:
-                messages.append({'role': 'system', 'content': system_prompt})
-        
-        # Добавляем историю (если есть)
-        messages.extend(validated_history)
-        
-        # Добавляем текущее сообщение пользователя
-        messages.append({'role': 'user', 'content': message})
-        
-        payload = {
-            'model': model,
-            'messages': messages
-        }
-        
-        # Добавляем опциональные параметры в payload (только если переданы)
-        if temperature is not None:
-            payload['temperature'] = temperature
-        
-        if max_tokens is not None:
-            payload['max_tokens'] = max_tokens
-        
-        if frequency_penalty is not None:
-            payload['frequency_penalty'] = frequency_penalty
+        headers = build_upstream_headers(api_key, http_referer, trace.request_id)
+        
+        # Обрезаем историю под бюджет токенов модели и собираем payload
+        history_headers = history_report_headers(prepared.fit())
+        history_headers.update(conversation_headers(prepared))
+        payload = prepared.payload()
+        trace.mark('history')
+        trace.set(model=model)
+        
+        # Повторный запрос с тем же payload отдаем из кэша ответов (если он включен)
+        request_key = cache_key(payload) if RESPONSE_CACHE_ENABLED or SINGLE_FLIGHT_ENABLED else None
+        response_key = request_key if RESPONSE_CACHE_ENABLED else None
+        response_json = None
+        if response_key:
+            cached = get_cached_response(response_key)
+            if cached:
+                logger.info(f"Ответ из кэша: модель {cached['model']}")
+                response_json, status_code = _cached_chat_response(cached), 200
+                trace.set(cached=True)
+        
+        if response_json is None:
+            def request_completion():
+                return _request_chat_completion(payload, headers, model, trace, response_key)
+            
+            # Одинаковые одновременные запросы делят один запрос к OpenRouter
+            if SINGLE_FLIGHT_ENABLED:
+                response_json, status_code = single_flight(request_key, request_completion)
+            else:
+                response_json, status_code = request_completion()
         
-        if presence_penalty is not None:
-            payload['presence_penalty'] = presence_penalty
+        # Клиент видит, что ответила резервная модель (ответ общий для single-flight - не изменяем его)
+        if prepared.routed and status_code == 200:
+            response_json = dict(response_json, requested_model=prepared.requested_model)
         
-        if top_p is not None:
-            payload['top_p'] = top_p
+        # Записываем ход в диалог на сервере (ответ общий для single-flight - не изменяем его)
+        if conversation is not None and status_code == 200 and response_json.get('content'):
+            new_version = append_turn(conversation.id, conversation.version, message, response_json['content'],
+                                      prepared.next_version)
+            response_json = dict(
+                response_json,
+                conversation_id=conversation.id,
+                conversation_version=new_version if new_version is not None else conversation.version
+            )
         
-        # Отправляем запрос к OpenRouter
-        response = requests.post(
-            OPENROUTER_API_URL,
-            headers=headers,
-            json=payload,
-            timeout=60
+        return jsonify(response_json), status_code, history_headers
+    
+    except Exception as e:
+        return jsonify({'error': f'Внутренняя ошибка сервера: {str(e)}'}), 500
+
+
+def _request_chat_completion(payload: dict, headers: dict, model: str, trace: Trace, response_key: str = None) -> tuple:
+    """
+    Отправляет запрос к OpenRouter и формирует ответ /api/chat.
+    Фазы upstream (запрос целиком, без потока) и cost добавляются в трассу trace.
+    
+    Returns:
+        tuple: (response_json, status_code)
+    """
+    try:
+        # Отправляем запрос к OpenRouter (через общий пул keep-alive соединений),
+        # таймауты и ответы 408/429/5xx повторяются с паузой (см. resilience.py)
+        session = get_upstream_session()
+        request_payload = with_prompt_caching(payload)
+        kind, response, retries = send_with_retries(
+            lambda: session.post(
+                OPENROUTER_API_URL,
+                headers=headers,
+                json=request_payload,
+                timeout=(UPSTREAM_CONNECT_TIMEOUT, 60)
+            ),
+            model
         )
+        trace.mark('upstream')
+        if retries:
+            trace.set(retries=retries)
+        
+        if kind == 'circuit_open':
+            metrics.inc('aichat_requests_total', labels=(('endpoint', 'chat'), ('result', 'circuit_open')))
+            trace.fail('circuit_open')
+            return {'error': CIRCUIT_OPEN_MESSAGE}, 503
+        if kind != 'response':
+            # Таймаут или ошибка сети после всех повторов
+            record_upstream_failure(model)
+            raise response
+        
+        metrics.observe('aichat_upstream_connect_seconds', response.elapsed.total_seconds())
+        metrics.inc('aichat_requests_total', labels=(
+            ('endpoint', 'chat'), ('result', 'ok' if response.status_code == 200 else 'upstream_error')
+        ))
         
         # Обработка ответа
         if response.status_code == 200:
+            record_sample(model, True)
             response_data = response.json()
             
             # Извлекаем содержимое ответа
@@ -254,38 +262,27 @@ def chat():
                 finish_reason = choice.get('finish_reason', 'unknown')
                 used_model = response_data.get('model', model)
                 
-                # Добавляем предупреждение если ответ был обрезан
-                if finish_reason == 'length':
-                    content += '\n\n⚠️ **Внимание:** Ответ был обрезан из-за достижения лимита токенов. Увеличьте значение max_tokens в настройках для получения полного ответа.'
-                
                 # Рассчитываем стоимость запроса
                 cost_info = calculate_cost_rub(response_data, used_model)
+                trace.mark('cost')
+                
+                if response_key:
+                    store_response(response_key, content, used_model, finish_reason,
+                                   cost_summary(cost_info) if cost_info else None)
+                
+                # Добавляем предупреждение если ответ был обрезан
+                if finish_reason == 'length':
+                    content += TRUNCATED_WARNING
                 
-                # Выводим стоимость в консоль
+                # Стоимость пишется в трассу запроса (JSON лог app.trace)
+                trace.set(model=used_model, **cost_trace_fields(cost_info))
                 if cost_info:
-                    total_cost_rub = cost_info['total_cost_rub']
-                    prompt_tokens = cost_info['prompt_tokens']
-                    completion_tokens = cost_info['completion_tokens']
-                    total_tokens = cost_info['total_tokens']
-                    
-                    logger.info("=" * 60)
-                    logger.info(f"СТОИМОСТЬ ЗАПРОСА:")
-                    logger.info(f"Модель: {used_model}")
-                    logger.info(f"Токенов (prompt/completion/total): {prompt_tokens}/{completion_tokens}/{total_tokens}")
-                    logger.info(f"Общая стоимость: {total_cost_rub:.2f} руб.")
-                    logger.info("=" * 60)
-                    
                     # Формируем ответ с информацией о стоимости
                     response_json = {
                         'content': content,
                         'model': used_model,
                         'finish_reason': finish_reason,
-                        'cost': {
-                            'total_cost_rub': total_cost_rub,
-                            'prompt_tokens': prompt_tokens,
-                            'completion_tokens': completion_tokens,
-                            'total_tokens': total_tokens
-                        }
+                        'cost': cost_summary(cost_info)
                     }
                 else:
                     # Если не удалось рассчитать стоимость, возвращаем ответ без неё
@@ -296,181 +293,208 @@ def chat():
                         'finish_reason': finish_reason
                     }
                 
-                return jsonify(response_json), 200
+                return response_json, 200
             else:
-                return jsonify({'error': 'Неожиданный формат ответа от OpenRouter'}), 500
+                return {'error': 'Неожиданный формат ответа от OpenRouter'}, 500
         
         # Обработка ошибок от OpenRouter
-        try:
-            error_data = response.json() if response.headers.get('content-type', '').startswith('application/json') else {}
-            error_message = error_data.get('error', {}).get('message', 'Ошибка при запросе к OpenRouter')
-        except Exception:
-            error_message = f'Ошибка при запросе к OpenRouter (HTTP {response.status_code})'
+        error_message = extract_upstream_error(
+            response.status_code,
+            response.headers.get('content-type', ''),
+            response.content
+        )
         
-        return jsonify({
+        trace.fail('upstream_error')
+        record_upstream_failure(model, response.status_code)
+        return {
             'error': error_message,
             'status_code': response.status_code
-        }), response.status_code
+        }, response.status_code
     
     except requests.exceptions.Timeout:
-        return jsonify({'error': 'Таймаут при запросе к OpenRouter'}), 504
+        metrics.inc('aichat_requests_total', labels=(('endpoint', 'chat'), ('result', 'timeout')))
+        trace.fail('timeout')
+        return {'error': 'Таймаут при запросе к OpenRouter'}, 504
     
     except requests.exceptions.RequestException as e:
-        return jsonify({'error': f'Ошибка сети: {str(e)}'}), 500
+        metrics.inc('aichat_requests_total', labels=(('endpoint', 'chat'), ('result', 'network_error')))
+        trace.fail('network_error')
+        return {'error': f'Ошибка сети: {str(e)}'}, 500
     
     except Exception as e:
-        return jsonify({'error': f'Внутренняя ошибка сервера: {str(e)}'}), 500
+        return {'error': f'Внутренняя ошибка сервера: {str(e)}'}, 500
 
 
-def _validate_chat_params(data):
+def _stream_events(payload: dict, model: str, headers: dict, trace: Trace, response_key: str = None,
+                   requested_model: str = None, on_complete=None):
     """
-    Валидация параметров для chat запросов (используется в /chat и /chat/stream)
-    
-    Returns:
-        tuple: (message, model, payload_dict, error_response) или (None, None, None, error_response)
+    Генератор SSE событий одного потокового запроса к OpenRouter (Flask путь).
+    requested_model - модель клиента, если запрос ушел к резервной (возвращается в событии done);
+    on_complete вызывается с полным ответом модели, если поток дошел до события done
     """
-    if not data:
-        return None, None, None, (jsonify({'error': 'Отсутствуют данные в запросе'}), 400)
-    
-    message = data.get('message')
-    model = data.get('model')
-    
-    # Валидация обязательных полей
-    if not message or not isinstance(message, str):
-        return None, None, None, (jsonify({'error': 'Поле "message" обязательно и должно быть строкой'}), 400)
-    
-    if not model or not isinstance(model, str):
-        return None, None, None, (jsonify({'error': 'Поле "model" обязательно и должно быть строкой'}), 400)
-    
-    # Получаем опциональные параметры генерации
-    temperature = data.get('temperature')
-    max_tokens = data.get('max_tokens')
-    verbosity = data.get('verbosity')
-    frequency_penalty = data.get('frequency_penalty')
-    presence_penalty = data.get('presence_penalty')
-    top_p = data.get('top_p')
-    history = data.get('history')
-    use_system_prompt = data.get('use_system_prompt', True)
-    use_ia_style = data.get('use_ia_style', False)
-    
-    # Валидация параметров (если переданы)
-    if temperature is not None:
-        try:
-            temperature = float(temperature)
-            if not (0.0 <= temperature <= 2.0):
-                return None, None, None, (jsonify({'error': 'temperature должен быть от 0.0 до 2.0'}), 400)
-        except (ValueError, TypeError):
-            return None, None, None, (jsonify({'error': 'temperature должен быть числом'}), 400)
-    
-    if max_tokens is not None:
-        if max_tokens == 0 or max_tokens == '':
-            max_tokens = None
-        else:
-            try:
-                max_tokens = int(max_tokens)
-                if not (1 <= max_tokens <= 4000):
-                    return None, None, None, (jsonify({'error': 'max_tokens должен быть от 1 до 4000'}), 400)
-            except (ValueError, TypeError):
-                return None, None, None, (jsonify({'error': 'max_tokens должен быть целым числом'}), 400)
-    
-    if verbosity is not None:
-        if verbosity not in ['low', 'medium', 'high']:
-            return None, None, None, (jsonify({'error': 'verbosity должен быть: low, medium или high'}), 400)
-    
-    if frequency_penalty is not None:
-        try:
-            frequency_penalty = float(frequency_penalty)
-            if not (-2.0 <= frequency_penalty <= 2.0):
-                return None, None, None, (jsonify({'error': 'frequency_penalty должен быть от -2.0 до 2.0'}), 400)
-        except (ValueError, TypeError):
-            return None, None, None, (jsonify({'error': 'frequency_penalty должен быть числом'}), 400)
-    
-    if presence_penalty is not None:
+    try:
+        started = time.monotonic()
+        
+        # Отправляем запрос к OpenRouter с streaming (через общий пул keep-alive соединений).
+        # До первого события data ошибки повторяются, медленный ответ может хеджироваться (см. resilience.py);
+        # пока попытки идут, клиент получает keep-alive
+        session = get_upstream_session()
+        request_payload = with_prompt_caching(payload)
+        starter = StreamStarter(
+            lambda: session.post(
+                OPENROUTER_API_URL,
+                headers=headers,
+                json=request_payload,
+                stream=True,
+                timeout=(UPSTREAM_CONNECT_TIMEOUT, 120)
+            ),
+            model
+        )
         try:
-            presence_penalty = float(presence_penalty)
-            if not (-2.0 <= presence_penalty <= 2.0):
-                return None, None, None, (jsonify({'error': 'presence_penalty должен быть от -2.0 до 2.0'}), 400)
-        except (ValueError, TypeError):
-            return None, None, None, (jsonify({'error': 'presence_penalty должен быть числом'}), 400)
-    
-    if top_p is not None:
+            while True:
+                result = starter.wait(SSE_HEARTBEAT_INTERVAL)
+                if result is not None:
+                    break
+                yield KEEP_ALIVE_EVENT
+        except GeneratorExit:
+            starter.close()
+            raise
+        kind, response = result
+        trace.mark('upstream_connect')
+        if starter.retries or starter.hedges:
+            trace.set(retries=starter.retries, hedges=starter.hedges)
+        
+        if kind == 'circuit_open':
+            metrics.inc('aichat_requests_total', labels=(('endpoint', 'stream'), ('result', 'circuit_open')))
+            trace.fail('circuit_open')
+            yield error_event(CIRCUIT_OPEN_MESSAGE, 503)
+            return
+        if kind in ('timeout', 'network_error'):
+            # Таймаут или ошибка сети после всех повторов
+            record_upstream_failure(model)
+            raise response
+        
+        chunks = None
+        if kind == 'ready':
+            response, first_chunks, rest = response
+            chunks = itertools.chain(first_chunks, rest)
+        
+        supervisor = None
+        reader = None
+        completed = False
         try:
-            top_p = float(top_p)
-            if not (0.0 <= top_p <= 1.0):
-                return None, None, None, (jsonify({'error': 'top_p должен быть от 0.0 до 1.0'}), 400)
-        except (ValueError, TypeError):
-            return None, None, None, (jsonify({'error': 'top_p должен быть числом'}), 400)
-    
-    # Валидация истории (если передана)
-    if history is not None:
-        if not isinstance(history, list):
-            return None, None, None, (jsonify({'error': 'history должен быть массивом'}), 400)
-        
-        # Валидируем каждое сообщение в истории
-        validated_history = []
-        for i, msg in enumerate(history):
-            if not isinstance(msg, dict):
-                return None, None, None, (jsonify({'error': f'Сообщение {i} в history должно быть объектом'}), 400)
-            
-            role = msg.get('role')
-            content = msg.get('content')
-            
-            if role not in ['user', 'assistant']:
-                return None, None, None, (jsonify({'error': f'role в сообщении {i} должен быть "user" или "assistant"'}), 400)
+            if response.status_code != 200:
+                # Обработка ошибок от OpenRouter
+                metrics.inc('aichat_requests_total', labels=(('endpoint', 'stream'), ('result', 'upstream_error')))
+                trace.fail('upstream_error')
+                record_upstream_failure(model, response.status_code)
+                error_message = extract_upstream_error(
+                    response.status_code,
+                    response.headers.get('content-type', ''),
+                    response.content
+                )
+                yield error_event(error_message, response.status_code)
+                return
             
-            if not isinstance(content, str):
-                return None, None, None, (jsonify({'error': f'content в сообщении {i} должен быть строкой'}), 400)
+            relay = StreamRelay(model, request_id=trace.request_id, requested_model=requested_model)
+            supervisor = StreamSupervisor(relay, started=started)
             
-            validated_history.append({'role': role, 'content': content})
-        
-        # Ограничиваем историю последними 50 сообщениями для предотвращения превышения лимитов токенов
-        if len(validated_history) > 50:
-            validated_history = validated_history[-50:]
-            logger.warning(f"История обрезана до последних 50 сообщений")
-    else:
-        validated_history = []
-    
-    # Формируем массив сообщений с системным промптом и историей
-    messages = []
-    # Добавляем системный промпт только если он включен в настройках
-    if use_system_prompt is not False:
-        system_prompt = get_combined_system_prompt(use_ia_style=use_ia_style, verbosity=verbosity)
-        if system_prompt:
-            messages.append({'role': 'system', 'content': system_prompt})
-    
-    # Добавляем историю (если есть)
-    messages.extend(validated_history)
-    
-    # Добавляем текущее сообщение пользователя
-    messages.append({'role': 'user', 'content': message})
-    
-    # Формируем payload
-    payload = {
-        'model': model,
-        'messages': messages,
-        'stream': True  # Включаем streaming для OpenRouter
-    }
-    
-    # Добавляем опциональные параметры в payload (только если переданы)
-    if temperature is not None:
-        payload['temperature'] = temperature
-    
-    if max_tokens is not None:
-        payload['max_tokens'] = max_tokens
-    
-    if frequency_penalty is not None:
-        payload['frequency_penalty'] = frequency_penalty
-    
-    if presence_penalty is not None:
-        payload['presence_penalty'] = presence_penalty
+            # Читаем OpenRouter в фоновом потоке: keep-alive, idle-таймаут и отправка
+            # объединенных токенов срабатывают по таймеру, даже если байты не приходят
+            reader = ThreadedChunkReader(chunks, response)
+            try:
+                while True:
+                    kind, chunk = reader.get(supervisor.timeout())
+                    
+                    if kind == 'timeout':
+                        events = supervisor.on_tick()
+                        if events:
+                            yield events
+                        if supervisor.idle_timed_out:
+                            logger.warning(f"OpenRouter не присылает данные {STREAM_IDLE_TIMEOUT:.0f} сек - поток прерван")
+                            trace.fail('idle_timeout')
+                            yield error_event('Таймаут при запросе к OpenRouter', 504)
+                            break
+                        continue
+                    
+                    if kind == 'error':
+                        raise chunk
+                    
+                    if kind == 'end':
+                        completed = True
+                        # Поток закончился без [DONE] - отправляем накопленные токены
+                        tail = relay.flush()
+                        if tail:
+                            yield tail
+                        break
+                    
+                    if supervisor.ttfb is None:
+                        trace.mark('first_byte')
+                    
+                    # Все события из порции (с объединенными токенами) отправляем одной записью
+                    events = supervisor.on_chunk(chunk)
+                    if events:
+                        yield events
+                    
+                    if relay.finished:
+                        completed = True
+                        trace.mark('stream')
+                        # Отправляем финальное сообщение с метаданными
+                        final_event = relay.final_event()
+                        trace.mark('cost')
+                        yield final_event
+                        if response_key:
+                            store_response(response_key, relay.accumulated_content, relay.used_model,
+                                           relay.finish_reason, relay.cost)
+                        if on_complete is not None:
+                            on_complete(relay.accumulated_content)
+                        break
+            except requests.exceptions.ChunkedEncodingError as e:
+                # Ошибка при чтении chunked потока (обрыв соединения или прерывание клиентом)
+                logger.info(f"Поток данных прерван клиентом или соединение закрыто: {e}")
+                # Не отправляем ошибку клиенту, так как он уже закрыл соединение
+                return
+            except requests.exceptions.ConnectionError as e:
+                # Ошибка подключения
+                logger.error(f"Ошибка подключения к OpenRouter: {e}")
+                trace.fail('network_error')
+                yield error_event(f'Ошибка подключения к OpenRouter: {str(e)}', 503)
+        finally:
+            if reader is not None:
+                # Ответ закроет поток чтения (соединение вернется в пул, если поток дочитан);
+                # недочитанный поток обрываем, чтобы не ждать зависший read()
+                reader.close(abort=not completed)
+            else:
+                response.close()
+            if supervisor is not None:
+                record_stream_stats(supervisor)
+                record_stream(model, supervisor)
+                trace.set(model=relay.used_model, stalls=supervisor.stalls, **cost_trace_fields(relay.cost))
     
-    if top_p is not None:
-        payload['top_p'] = top_p
+    except requests.exceptions.Timeout:
+        metrics.inc('aichat_requests_total', labels=(('endpoint', 'stream'), ('result', 'timeout')))
+        trace.fail('timeout')
+        yield error_event('Таймаут при запросе к OpenRouter', 504)
     
-    return message, model, payload, None
+    except requests.exceptions.RequestException as e:
+        metrics.inc('aichat_requests_total', labels=(('endpoint', 'stream'), ('result', 'network_error')))
+        trace.fail('network_error')
+        yield error_event(f'Ошибка сети: {str(e)}', 500)
+    
+    except GeneratorExit:
+        # Клиент закрыл соединение (прервал запрос)
+        logger.info("Клиент прервал запрос - соединение закрыто")
+        raise  # Пробрасываем дальше для корректного завершения генератора
+    except Exception as e:
+        # Проверяем, не было ли соединение закрыто вообще
+        if 'Broken pipe' in str(e) or 'Connection closed' in str(e):
+            logger.info(f"Соединение закрыто клиентом: {e}")
+            return  # Не нужно отправлять ошибку если соединение уже закрыто
+        yield error_event(f'Внутренняя ошибка сервера: {str(e)}', 500)
 
 
 @api_bp.route('/chat/stream', methods=['POST'])
+@traced('stream')
 def chat_stream():
     """
     Проксирует потоковый запрос к OpenRouter API через Server-Sent Events (SSE)
@@ -478,22 +502,38 @@ def chat_stream():
     Принимает:
     {
         "message": "текст сообщения",
-        "model": "openai/gpt-4"
+        "model": "openai/gpt-4",
+        "conversation_id": "...", "conversation_version": "..."  // опционально, история с сервера
     }
     
+    В режиме диалога заголовки X-Conversation-Id и X-Conversation-Version содержат id диалога
+    и версию, на которой основан запрос; после события done диалог получает версию из X-Conversation-Next-Version.
+    
     Возвращает:
     SSE поток с событиями:
     - data: {"token": "текст", "done": false}\n\n - промежуточные токены
-    - data: {"token": "", "done": true, "model": "...", "cost": {...}}\n\n - финальное сообщение
+    - data: {"token": "", "done": true, "model": "...", "cost": {...}, "request_id": "..."}\n\n - финальное сообщение
+      (model - модель, которая ответила; requested_model - модель клиента, если ответила резервная)
+    
+    request_id в событии done - id запроса, который ушел в OpenRouter (у ответа из кэша - id этого запроса).
     """
+    trace = g.trace
     try:
         # Получаем данные из запроса
         data = request.get_json()
         
-        # Валидация параметров
-        message, model, payload, error_response = _validate_chat_params(data)
+        # Валидация параметров и истории (общая с /chat и /estimate-cost)
+        prepared, error_response = prepare_request(data)
         if error_response:
             return error_response
+        # Модель, которая не укладывается в SLO, заменяется резервной (model_router.py)
+        prepared.route()
+        message, model, conversation = prepared.message, prepared.model, prepared.conversation
+        requested_model = prepared.requested_model if prepared.routed else None
+        trace.mark('validate')
+        trace.set(model=model)
+        if requested_model:
+            trace.set(requested_model=requested_model)
         
         # Получаем API ключ из переменных окружения
         api_key = os.environ.get('OPENROUTER_API_KEY')
@@ -504,199 +544,59 @@ def chat_stream():
         http_referer = os.environ.get('HTTP_REFERER', request.headers.get('Origin', ''))
         
         # Подготавливаем запрос к OpenRouter
-        headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json'
-        }
+        headers = build_upstream_headers(api_key, http_referer, trace.request_id)
+        
+        # Обрезаем историю под бюджет токенов модели и собираем payload (streaming для OpenRouter)
+        history_headers = history_report_headers(prepared.fit())
+        history_headers.update(conversation_headers(prepared))
+        payload = prepared.payload(stream=True)
+        trace.mark('history')
+        
+        request_key = cache_key(payload) if RESPONSE_CACHE_ENABLED or SINGLE_FLIGHT_ENABLED else None
+        response_key = request_key if RESPONSE_CACHE_ENABLED else None
+        
+        def events(on_complete=None):
+            if response_key:
+                cached = get_cached_response(response_key)
+                if cached:
+                    logger.info(f"Ответ из кэша: модель {cached['model']}")
+                    trace.set(cached=True)
+                    yield replay_sse(cached, trace.request_id)
+                    if on_complete is not None:
+                        on_complete(cached['content'])
+                    return
+            
+            def make_events(complete=None):
+                return _stream_events(payload, model, headers, trace, response_key, requested_model, complete)
+            
+            # Одинаковые одновременные потоки читают один поток к OpenRouter
+            if SINGLE_FLIGHT_ENABLED:
+                yield from stream_single_flight(request_key, make_events, on_complete)
+            else:
+                yield from make_events(on_complete)
         
-        if http_referer:
-            headers['HTTP-Referer'] = http_referer
+        def client_events():
+            if conversation is None:
+                yield from events()
+                return
+            
+            # Ответ, который получил клиент, записываем в диалог на сервере
+            recorder = TurnRecorder(conversation.id, conversation.version, prepared.next_version, message)
+            yield from events(recorder.complete)
+            recorder.commit()
         
         def generate():
             """Генератор для SSE событий"""
+            metrics.inc('aichat_streams_total')
+            metrics.gauge_add('aichat_active_streams', 1)
             try:
-                # Отправляем запрос к OpenRouter с streaming
-                response = requests.post(
-                    OPENROUTER_API_URL,
-                    headers=headers,
-                    json=payload,
-                    stream=True,
-                    timeout=120
-                )
-                
-                if response.status_code != 200:
-                    # Обработка ошибок от OpenRouter
-                    try:
-                        error_data = response.json() if response.headers.get('content-type', '').startswith('application/json') else {}
-                        error_message = error_data.get('error', {}).get('message', f'Ошибка при запросе к OpenRouter (HTTP {response.status_code})')
-                    except Exception:
-                        error_message = f'Ошибка при запросе к OpenRouter (HTTP {response.status_code})'
-                    
-                    error_event = {
-                        'error': error_message,
-                        'status_code': response.status_code
-                    }
-                    yield f"data: {json.dumps(error_event, ensure_ascii=False)}\n\n"
-                    return
-                
-                # Переменные для накопления данных
-                accumulated_content = ""
-                used_model = model
-                finish_reason = None
-                usage_data = None
-                
-                # Переменные для keep-alive механизма
-                last_event_time = time.time()
-                keep_alive_interval = 8  # секунд между keep-alive комментариями
-                
-                # Парсим потоковые данные от OpenRouter
-                try:
-                    for line in response.iter_lines():
-                        # Проверяем, не закрыл ли клиент соединение
-                        # Flask автоматически прекратит генератор при закрытии соединения
-                        # Проверяем нужно ли отправить keep-alive
-                        current_time = time.time()
-                        if current_time - last_event_time > keep_alive_interval:
-                            yield ":\n\n"  # Keep-alive комментарий
-                            last_event_time = current_time
-                        
-                        # Обрабатываем пустые строки
-                        if not line:
-                            continue
-                        
-                        # Декодируем строку с обработкой ошибок
-                        try:
-                            line_str = line.decode('utf-8', errors='ignore')
-                        except UnicodeDecodeError as decode_error:
-                            logger.warning(f"Ошибка декодирования строки: {decode_error}")
-                            continue
-                        
-                        # Обрабатываем комментарии (keep-alive от OpenRouter или наши собственные)
-                        if line_str.startswith(':'):
-                            # Это комментарий, пропускаем
-                            continue
-                        
-                        # Обрабатываем data строки
-                        if line_str.startswith('data: '):
-                            data_str = line_str[6:].strip()  # Убираем "data: " и пробелы
-                            
-                            # Проверяем на завершение потока
-                            if data_str == '[DONE]':
-                                # Отправляем финальное сообщение с метаданными
-                                final_data = {
-                                    'token': '',
-                                    'done': True,
-                                    'model': used_model,
-                                    'finish_reason': finish_reason
-                                }
-                                
-                                # Добавляем информацию о стоимости, если доступна
-                                if usage_data:
-                                    cost_info = calculate_cost_rub({'usage': usage_data, 'model': used_model}, used_model)
-                                    if cost_info:
-                                        final_data['cost'] = {
-                                            'total_cost_rub': cost_info['total_cost_rub'],
-                                            'prompt_tokens': cost_info['prompt_tokens'],
-                                            'completion_tokens': cost_info['completion_tokens'],
-                                            'total_tokens': cost_info['total_tokens']
-                                        }
-                                        
-                                        # Логируем стоимость
-                                        logger.info("=" * 60)
-                                        logger.info(f"СТОИМОСТЬ STREAMING ЗАПРОСА:")
-                                        logger.info(f"Модель: {used_model}")
-                                        logger.info(f"Токенов (prompt/completion/total): {cost_info['prompt_tokens']}/{cost_info['completion_tokens']}/{cost_info['total_tokens']}")
-                                        logger.info(f"Общая стоимость: {cost_info['total_cost_rub']:.2f} руб.")
-                                        logger.info("=" * 60)
-                                
-                                yield f"data: {json.dumps(final_data, ensure_ascii=False)}\n\n"
-                                last_event_time = time.time()
-                                break
-                            
-                            # Парсим JSON данные
-                            if not data_str:
-                                # Пустая data строка, пропускаем
-                                continue
-                            
-                            try:
-                                chunk_data = json.loads(data_str)
-                                
-                                # Извлекаем модель из первого чанка
-                                if 'model' in chunk_data:
-                                    used_model = chunk_data['model']
-                                
-                                # Извлекаем usage данные (приходят в последнем чанке)
-                                if 'usage' in chunk_data:
-                                    usage_data = chunk_data['usage']
-                                
-                                # Извлекаем содержимое токена
-                                if 'choices' in chunk_data and len(chunk_data['choices']) > 0:
-                                    choice = chunk_data['choices'][0]
-                                    
-                                    # Получаем delta контент
-                                    delta = choice.get('delta', {})
-                                    token_content = _extract_delta_text(delta)
-                                    
-                                    # Получаем finish_reason (если есть)
-                                    if 'finish_reason' in choice:
-                                        finish_reason = choice['finish_reason']
-                                    
-                                    # Если есть новый токен, отправляем его клиенту
-                                    if token_content:
-                                        accumulated_content += token_content
-                                        event_data = {
-                                            'token': token_content,
-                                            'done': False
-                                        }
-                                        yield f"data: {json.dumps(event_data, ensure_ascii=False)}\n\n"
-                                        last_event_time = time.time()  # Обновляем время последнего события
-                            
-                            except json.JSONDecodeError as json_error:
-                                # Пропускаем некорректные JSON строки (не прерываем генератор)
-                                logger.debug(f"Пропущен некорректный JSON: {data_str[:50]}... Ошибка: {json_error}")
-                                continue
-                except requests.exceptions.ChunkedEncodingError as e:
-                    # Ошибка при чтении chunked потока (обрыв соединения или прерывание клиентом)
-                    logger.info(f"Поток данных прерван клиентом или соединение закрыто: {e}")
-                    # Не отправляем ошибку клиенту, так как он уже закрыл соединение
-                    return
-                except requests.exceptions.ConnectionError as e:
-                    # Ошибка подключения
-                    logger.error(f"Ошибка подключения к OpenRouter: {e}")
-                    error_event = {
-                        'error': f'Ошибка подключения к OpenRouter: {str(e)}',
-                        'status_code': 503
-                    }
-                    yield f"data: {json.dumps(error_event, ensure_ascii=False)}\n\n"
-                
-            except requests.exceptions.Timeout:
-                error_event = {
-                    'error': 'Таймаут при запросе к OpenRouter',
-                    'status_code': 504
-                }
-                yield f"data: {json.dumps(error_event, ensure_ascii=False)}\n\n"
-            
-            except requests.exceptions.RequestException as e:
-                error_event = {
-                    'error': f'Ошибка сети: {str(e)}',
-                    'status_code': 500
-                }
-                yield f"data: {json.dumps(error_event, ensure_ascii=False)}\n\n"
-            
+                yield from client_events()
             except GeneratorExit:
-                # Клиент закрыл соединение (прервал запрос)
-                logger.info("Клиент прервал запрос - соединение закрыто")
-                raise  # Пробрасываем дальше для корректного завершения генератора
-            except Exception as e:
-                # Проверяем, не было ли соединение закрыто вообще
-                if 'Broken pipe' in str(e) or 'Connection closed' in str(e):
-                    logger.info(f"Соединение закрыто клиентом: {e}")
-                    return  # Не нужно отправлять ошибку если соединение уже закрыто
-                error_event = {
-                    'error': f'Внутренняя ошибка сервера: {str(e)}',
-                    'status_code': 500
-                }
-                yield f"data: {json.dumps(error_event, ensure_ascii=False)}\n\n"
+                metrics.inc('aichat_streams_aborted_total', labels=(('reason', 'client_disconnect'),))
+                trace.fail('client_disconnect')
+                raise
+            finally:
+                metrics.gauge_add('aichat_active_streams', -1)
         
         # Возвращаем SSE ответ
         return Response(
@@ -705,7 +605,8 @@ def chat_stream():
             headers={
                 'Cache-Control': 'no-cache',
                 'Connection': 'keep-alive',
-                'X-Accel-Buffering': 'no'  # Отключаем буферизацию для nginx
+                'X-Accel-Buffering': 'no',  # Отключаем буферизацию для nginx
+                **history_headers
             }
         )
     
@@ -731,6 +632,112 @@ def get_system_prompt_endpoint():
         return jsonify({'error': f'Ошибка при получении системного промпта: {str(e)}'}), 500
 
 
+def requires_stats_token(view):
+    """
+    Декоратор служебных endpoints: доступны только с заголовком Authorization: Bearer <STATS_TOKEN>.
+    Без STATS_TOKEN endpoint выключен и отвечает 404, как несуществующий.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not STATS_TOKEN:
+            return jsonify({'error': 'Not found'}), 404
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(token.strip().encode(), STATS_TOKEN.encode()):
+            return jsonify({'error': 'Требуется заголовок Authorization: Bearer <STATS_TOKEN>'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+
+# Разделы /api/debug/stats: имя -> статистика текущего воркера
+_DEBUG_STATS = {
+    'prompts': get_prompt_stats,
+    'static': get_static_stats,
+    'tracing': get_tracing_stats,
+    'upstream_pool': get_pool_stats,
+    'resilience': get_resilience_stats,
+    'models_health': get_models_health,
+    'stream': get_stream_stats,
+    'cache': get_cache_stats,
+    'single_flight': get_single_flight_stats,
+    'history': get_history_stats,
+    'conversations': get_conversation_stats,
+    'estimate_cost': get_token_count_stats,
+    'pricing': get_pricing_stats,
+}
+
+
+@api_bp.route('/debug/stats', methods=['GET'])
+@requires_stats_token
+def debug_stats():
+    """
+    Возвращает служебную статистику текущего воркера (нужен STATS_TOKEN, см. requires_stats_token).
+    ?section=cache,stream - только указанные разделы.
+    
+    Returns:
+    {
+        "prompts": {"version": 2, "source": "file", "variants": 8, "reloads": 1, ...},
+        "static": {"files": 17, "memory_bytes": 1350000, "requests": 420, "not_modified": 130, ...},
+        "tracing": {"traces": 1200, "logged": 64, "dropped": 0, "sample_rate": 0.05, ...},
+        "upstream_pool": {"sync": {"pool_maxsize": 32, ...}, "async": {"enabled": false, ...}},
+        "resilience": {"attempts": 1250, "retries": 31, "hedges_won": 5, "circuits": {...}, ...},
+        "models_health": {"models": {...}, "slo": {...}, "stats": {...}},
+        "stream": {"streams": 10, "coalesce_ratio": 13.33, "avg_ttft_ms": 530.1, ...},
+        "cache": {"enabled": true, "entries": 12, "hit_rate": 0.714, "saved_cost_rub": 4.15, ...},
+        "single_flight": {"enabled": false, "chat": {...}, "stream": {...}},
+        "history": {"requests": 120, "trimmed_requests": 4, "dropped_tokens": 51234, ...},
+        "conversations": {"conversations": 42, "hits": 310, "conflicts": 5, "enabled": true, ...},
+        "estimate_cost": {"hits": 5400, "misses": 320, "hit_rate": 0.944, "prompt_variants": 8, ...},
+        "pricing": {"models": 342, "version": 7, "snapshot_age": 812.4, "failures": 0, ...}
+    }
+    """
+    section = request.args.get('section')
+    names = section.split(',') if section else list(_DEBUG_STATS)
+    unknown = [name for name in names if name not in _DEBUG_STATS]
+    if unknown:
+        return jsonify({'error': f"Неизвестные разделы: {', '.join(unknown)}", 'sections': list(_DEBUG_STATS)}), 400
+    return jsonify({name: _DEBUG_STATS[name]() for name in names}), 200
+
+
+@api_bp.route('/models/health', methods=['GET'])
+def models_health():
+    """
+    Возвращает телеметрию моделей по реальным запросам (для текущего воркера): TTFT, скорость, доля ошибок,
+    нарушения SLO и резервные модели, к которым уходят запросы (см. model_router.py).
+    Открыт без STATS_TOKEN: состояние моделей нужно клиентам и балансировщику; то же - раздел models_health
+    в /api/debug/stats.
+
+    Returns:
+    {
+        "models": {
+            "google/gemini-2.5-flash": {
+                "samples": 42, "errors": 15, "error_rate": 0.357, "ttft_p50_ms": 850.0, "ttft_p95_ms": 2400.0,
+                "tokens_per_sec": 95.3, "breaches": ["error_rate"], "healthy": false, "circuit": "closed",
+                "fallbacks": ["openai/gpt-4o-mini"], "routed_away": 12
+            }
+        },
+        "slo": {"ttft_ms": 10000.0, "error_rate": 0.3, "min_tokens_per_sec": 0.0, ...},
+        "stats": {"samples": 380, "routed": 12, "probes": 1, "no_healthy_fallback": 0}
+    }
+    """
+    return jsonify(get_models_health()), 200
+
+
+@api_bp.route('/metrics', methods=['GET'])
+@requires_stats_token
+def metrics_endpoint():
+    """
+    Возвращает метрики всех воркеров в текстовом формате Prometheus (нужен STATS_TOKEN:
+    в Prometheus - authorization.credentials задания).
+    
+    Returns:
+    # TYPE aichat_ttft_seconds histogram
+    aichat_ttft_seconds_bucket{le="0.5"} 120
+    ...
+    aichat_active_streams 3
+    """
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
 @api_bp.route('/estimate-cost', methods=['POST'])
 def estimate_cost():
     """
@@ -741,87 +748,42 @@ def estimate_cost():
         "message": "текст сообщения",
         "model": "openai/gpt-4",
         "history": [{"role": "user", "content": "..."}, ...],  // опционально
+        "conversation_id": "...", "conversation_version": "...",  // опционально, вместо history
         "max_tokens": 500,  // опционально
-        "use_system_prompt": true  // опционально, по умолчанию true
+        "use_system_prompt": true,  // опционально, по умолчанию true
+        "use_ia_style": false, "verbosity": "medium"  // опционально, как в /chat
     }
     
+    Проверка полей, системный промпт и обрезка истории под контекст модели - те же, что у /chat
+    (PreparedRequest), поэтому оценка считает ровно те сообщения, которые уйдут в OpenRouter.
+    
     Возвращает:
     {
         "estimated_cost_rub": 0.15,
         "estimated_prompt_tokens": 120,
         "estimated_completion_tokens": 400,
-        "estimated_total_tokens": 520
+        "estimated_total_tokens": 520,
+        "pricing_version": 7
     }
     """
     try:
         # Получаем данные из запроса
         data = request.get_json()
         
-        if not data:
-            return jsonify({'error': 'Отсутствуют данные в запросе'}), 400
-        
-        message = data.get('message')
-        model = data.get('model')
-        
-        # Валидация обязательных полей
-        if not message or not isinstance(message, str):
-            return jsonify({'error': 'Поле "message" обязательно и должно быть строкой'}), 400
-        
-        if not model or not isinstance(model, str):
-            return jsonify({'error': 'Поле "model" обязательно и должно быть строкой'}), 400
-        
-        # Получаем опциональные параметры
-        history = data.get('history')
-        max_tokens = data.get('max_tokens')
-        use_system_prompt = data.get('use_system_prompt', True)
-        use_ia_style = data.get('use_ia_style', False)
-        
-        # Валидация истории (если передана)
-        validated_history = []
-        if history is not None:
-            if not isinstance(history, list):
-                return jsonify({'error': 'history должен быть массивом'}), 400
-            
-            for i, msg in enumerate(history):
-                if not isinstance(msg, dict):
-                    return jsonify({'error': f'Сообщение {i} в history должно быть объектом'}), 400
-                
-                role = msg.get('role')
-                content = msg.get('content')
-                
-                if role not in ['user', 'assistant']:
-                    return jsonify({'error': f'role в сообщении {i} должен быть "user" или "assistant"'}), 400
-                
-                if not isinstance(content, str):
-                    return jsonify({'error': f'content в сообщении {i} должен быть строкой'}), 400
-                
-                validated_history.append({'role': role, 'content': content})
-        
-        # Валидация max_tokens
-        if max_tokens is not None:
-            if max_tokens == 0 or max_tokens == '':
-                max_tokens = None
-            else:
-                try:
-                    max_tokens = int(max_tokens)
-                    if not (1 <= max_tokens <= 4000):
-                        return jsonify({'error': 'max_tokens должен быть от 1 до 4000'}), 400
-                except (ValueError, TypeError):
-                    return jsonify({'error': 'max_tokens должен быть целым числом'}), 400
-        
-        # Получаем системный промпт (если используется)
-        system_prompt = None
-        if use_system_prompt is not False:
-            system_prompt = get_combined_system_prompt(use_ia_style=use_ia_style)
+        # Та же подготовка, что у /chat: системный промпт с verbosity и обрезка истории под модель
+        prepared, error_response = prepare_request(data, estimate=True)
+        if error_response:
+            return error_response
         
         # Оцениваем стоимость
+        started = time.perf_counter()
         estimate = estimate_cost_rub(
-            message=message,
-            model_id=model,
-            history=validated_history if validated_history else None,
-            system_prompt=system_prompt if system_prompt else None,
-            max_tokens=max_tokens
+            message=prepared.message,
+            model_id=prepared.model,
+            max_tokens=prepared.max_tokens,
+            prompt_tokens=prepared.prompt_tokens()
         )
+        metrics.observe('aichat_estimate_cost_seconds', time.perf_counter() - started, (('endpoint', 'single'),))
         
         if estimate is None:
             return jsonify({'error': 'Не удалось оценить стоимость. Проверьте корректность модели.'}), 500
@@ -831,3 +793,53 @@ def estimate_cost():
     except Exception as e:
         logger.error(f"Ошибка при оценке стоимости: {e}")
         return jsonify({'error': f'Внутренняя ошибка сервера: {str(e)}'}), 500
+
+
+@api_bp.route('/estimate-cost/batch', methods=['POST'])
+def estimate_cost_batch():
+    """
+    Оценивает стоимость одного запроса сразу для нескольких моделей (токены считаются один раз).
+    
+    Принимает те же поля, что и /estimate-cost, но вместо "model" - список моделей:
+    {
+        "message": "текст сообщения",
+        "models": ["openai/gpt-5.5", "anthropic/claude-opus-4.8", ...],
+        "history": [{"role": "user", "content": "..."}, ...],  // опционально
+        "max_tokens": 500  // опционально
+    }
+    
+    Возвращает (estimated_prompt_tokens верхнего уровня - без обрезки истории, у модели - после обрезки
+    под ее контекст):
+    {
+        "estimated_prompt_tokens": 120,
+        "estimated_completion_tokens": 400,
+        "estimated_total_tokens": 520,
+        "pricing_version": 7,
+        "costs": {
+            "openai/gpt-5.5": {"estimated_cost_rub": 0.15, "prompt_cost_rub": 0.03,
+                               "completion_cost_rub": 0.12, "request_cost_rub": 0.0,
+                               "estimated_prompt_tokens": 120},
+            "unknown/model": null
+        }
+    }
+    """
+    try:
+        data = request.get_json()
+        
+        prepared, error_response = prepare_request(data, estimate=True, batch=True)
+        if error_response:
+            return error_response
+        
+        started = time.perf_counter()
+        estimate = estimate_costs_rub(
+            model_ids=list(prepared.models),
+            max_tokens=prepared.max_tokens,
+            prompt_tokens=prepared.prompt_tokens(),
+            model_prompt_tokens={model: prepared.prompt_tokens(model) for model in prepared.models}
+        )
+        metrics.observe('aichat_estimate_cost_seconds', time.perf_counter() - started, (('endpoint', 'batch'),))
+        return jsonify(estimate), 200
+    
+    except Exception as e:
+        logger.error(f"Ошибка при пакетной оценке стоимости: {e}")
+        return jsonify({'error': f'Внутренняя ошибка сервера: {str(e)}'}), 500
@@ -0,0 +1,337 @@
+"""
+Объединение одинаковых запросов, которые выполняются одновременно (single-flight).
+
+Если несколько пользователей или вкладок отправили один и тот же payload, пока первый запрос
+еще выполняется, к OpenRouter уходит только один запрос:
+- /api/chat: остальные ждут результат первого и получают тот же ответ
+- /api/chat/stream: события потока пишутся в общий буфер (broadcast), каждый подписчик читает его
+  со своей позиции; подключившийся позже получает уже отправленные токены сразу
+
+Во Flask поток к OpenRouter читает сам подписчик, дочитавший буфер (без отдельного потока ОС),
+в ASGI - asyncio задача; отключение первого клиента не обрывает ответ остальным. Когда отключаются
+все подписчики, запрос к OpenRouter прерывается. Ошибка внутри потока доходит до подписчиков событием error.
+
+Ключ - тот же, что и у кэша ответов (response_cache.cache_key).
+Включается переменной SINGLE_FLIGHT_ENABLED=1: ответы моделей с temperature > 0 не детерминированы,
+и объединенные запросы получают один и тот же ответ вместо разных.
+"""
+import os
+import json
+import asyncio
+import logging
+import threading
+
+from app.api.streaming import error_event
+
+logger = logging.getLogger(__name__)
+
+# Объединение одинаковых одновременных запросов включено (по умолчанию выключено, как кэш ответов)
+SINGLE_FLIGHT_ENABLED = os.environ.get('SINGLE_FLIGHT_ENABLED', '0') == '1'
+
+# Выполняющиеся запросы процесса: ключ -> _Call / StreamBroadcast / AsyncStreamBroadcast
+_calls = {}
+_streams = {}
+_async_streams = {}
+_lock = threading.Lock()
+
+_stats = {
+    'chat_upstream_calls': 0,
+    'chat_deduplicated': 0,
+    'chat_bytes_saved': 0,
+    'stream_upstream_calls': 0,
+    'stream_deduplicated': 0,
+    'stream_bytes_saved': 0,
+}
+
+
+class _Call:
+    """Один выполняющийся запрос /api/chat и его результат"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def single_flight(key: str, func):
+    """
+    Выполняет func() один раз для всех одновременных вызовов с одинаковым ключом.
+
+    Args:
+        key: Ключ запроса
+        func: Функция без аргументов, возвращающая (response_json, status_code)
+
+    Returns:
+        tuple: Результат func() (общий для всех ожидавших)
+    """
+    with _lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _Call()
+            _calls[key] = call
+            _stats['chat_upstream_calls'] += 1
+
+    if leader:
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with _lock:
+                _calls.pop(key, None)
+            call.done.set()
+
+    call.done.wait()
+    if call.error is not None:
+        raise call.error
+    response_json = call.result[0]
+    with _lock:
+        _stats['chat_deduplicated'] += 1
+        _stats['chat_bytes_saved'] += len(json.dumps(response_json, ensure_ascii=False).encode('utf-8'))
+    logger.info("Одинаковый запрос уже выполнялся - ответ получен без обращения к OpenRouter")
+    return call.result
+
+
+class StreamBroadcast:
+    """
+    Буфер событий одного потока к OpenRouter (Flask путь).
+    Отдельного производителя нет: следующее событие из потока к OpenRouter читает подписчик,
+    дочитавший буфер (обычно первый запрос), остальные ждут и читают буфер со своей позиции.
+    Если читающий подписчик отключился, поток продолжает читать следующий.
+    """
+
+    def __init__(self, key: str, make_events):
+        self.key = key
+        self._source = make_events(self.complete)
+        self._events = []
+        self._cond = threading.Condition()
+        # Кто-то из подписчиков сейчас ждет следующее событие из потока к OpenRouter
+        self._reading = False
+        self.finished = False
+        self.subscribers = 1
+        # Полный ответ модели, если поток дошел до события done
+        self.content = None
+
+    def complete(self, content: str) -> None:
+        self.content = content
+
+    def _read_next(self) -> None:
+        """Читает следующее событие из потока к OpenRouter в буфер (вызывается без _cond)"""
+        data, finished = None, False
+        try:
+            data = next(self._source)
+        except StopIteration:
+            finished = True
+        except Exception as e:
+            logger.error(f"Ошибка в общем потоке к OpenRouter: {e}")
+            data, finished = error_event(f'Внутренняя ошибка сервера: {str(e)}', 500), True
+        with self._cond:
+            if data is not None:
+                self._events.append(data)
+            self._reading = False
+            self._cond.notify_all()
+        if finished:
+            self.close()
+
+    def close(self):
+        """Завершает поток: закрывает запрос к OpenRouter и снимает ключ с выполняющихся"""
+        with self._cond:
+            if self.finished:
+                return
+            self.finished = True
+            self._cond.notify_all()
+        self._source.close()
+        with _lock:
+            if _streams.get(self.key) is self:
+                del _streams[self.key]
+
+    def subscribe(self, follower: bool):
+        """Генератор событий для одного подписчика (с начала потока)"""
+        position = 0
+        try:
+            while True:
+                with self._cond:
+                    while position == len(self._events) and not self.finished and self._reading:
+                        self._cond.wait()
+                    batch = self._events[position:]
+                    position = len(self._events)
+                    if not batch:
+                        if self.finished:
+                            return
+                        self._reading = True
+                if not batch:
+                    self._read_next()
+                    continue
+                data = b''.join(batch)
+                if follower:
+                    with _lock:
+                        _stats['stream_bytes_saved'] += len(data)
+                yield data
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+                abandoned = self.subscribers == 0 and not self.finished
+            if abandoned:
+                logger.info("Все клиенты отключились - поток к OpenRouter прерван")
+                self.close()
+
+
+def stream_single_flight(key: str, make_events, on_complete=None):
+    """
+    Генератор SSE событий потока, общего для всех одновременных запросов с одинаковым ключом.
+
+    Args:
+        key: Ключ запроса
+        make_events: Функция от on_complete, возвращающая генератор событий потока к OpenRouter
+        on_complete: Вызывается с полным ответом модели, если поток дошел до события done
+    """
+    with _lock:
+        broadcast = _streams.get(key)
+        follower = False
+        if broadcast is not None:
+            with broadcast._cond:
+                # Если все подписчики уже отключились, поток к OpenRouter закрыт - начинаем новый
+                if broadcast.subscribers > 0:
+                    broadcast.subscribers += 1
+                    follower = True
+        if follower:
+            _stats['stream_deduplicated'] += 1
+        else:
+            broadcast = StreamBroadcast(key, make_events)
+            _streams[key] = broadcast
+            _stats['stream_upstream_calls'] += 1
+
+    if follower:
+        logger.info("Одинаковый потоковый запрос уже выполняется - подключаемся к его потоку")
+
+    yield from broadcast.subscribe(follower)
+    if on_complete is not None and broadcast.content is not None:
+        on_complete(broadcast.content)
+
+
+class AsyncStreamBroadcast:
+    """Буфер событий одного потока к OpenRouter (ASGI путь, все на одном event loop)"""
+
+    def __init__(self):
+        self._events = []
+        self._changed = asyncio.Event()
+        self.finished = False
+        self.subscribers = 1
+        self.producer = None
+        # Полный ответ модели, если поток дошел до события done
+        self.content = None
+
+    def complete(self, content: str) -> None:
+        self.content = content
+
+    def publish(self, data: bytes):
+        self._events.append(data)
+        self._changed.set()
+
+    def close(self):
+        self.finished = True
+        self._changed.set()
+
+    async def subscribe(self, follower: bool):
+        """Асинхронный генератор событий для одного подписчика (с начала потока)"""
+        position = 0
+        try:
+            while True:
+                if position == len(self._events):
+                    if self.finished:
+                        return
+                    self._changed.clear()
+                    await self._changed.wait()
+                    continue
+                batch = self._events[position:]
+                position = len(self._events)
+                data = b''.join(batch)
+                if follower:
+                    with _lock:
+                        _stats['stream_bytes_saved'] += len(data)
+                yield data
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and self.producer is not None and not self.producer.done():
+                logger.info("Все клиенты отключились - поток к OpenRouter прерван")
+                self.producer.cancel()
+
+
+async def async_stream_single_flight(key: str, make_events, on_complete=None):
+    """
+    Асинхронный генератор SSE событий потока, общего для всех одновременных запросов с одинаковым ключом.
+
+    Args:
+        key: Ключ запроса
+        make_events: Функция от on_complete, возвращающая асинхронный генератор событий потока к OpenRouter
+        on_complete: Вызывается с полным ответом модели, если поток дошел до события done
+    """
+    broadcast = _async_streams.get(key)
+    # Если все подписчики уже отключились, производитель отменен - начинаем новый поток
+    follower = broadcast is not None and broadcast.subscribers > 0
+    if follower:
+        broadcast.subscribers += 1
+        logger.info("Одинаковый потоковый запрос уже выполняется - подключаемся к его потоку")
+    else:
+        broadcast = AsyncStreamBroadcast()
+        _async_streams[key] = broadcast
+        broadcast.producer = asyncio.ensure_future(_async_produce(key, broadcast, make_events))
+    with _lock:
+        _stats['stream_deduplicated' if follower else 'stream_upstream_calls'] += 1
+
+    subscription = broadcast.subscribe(follower)
+    try:
+        async for data in subscription:
+            yield data
+    finally:
+        await subscription.aclose()
+    if on_complete is not None and broadcast.content is not None:
+        on_complete(broadcast.content)
+
+
+async def _async_produce(key: str, broadcast: AsyncStreamBroadcast, make_events):
+    events = make_events(broadcast.complete)
+    try:
+        async for data in events:
+            broadcast.publish(data)
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        logger.error(f"Ошибка в общем потоке к OpenRouter: {e}")
+        broadcast.publish(error_event(f'Внутренняя ошибка сервера: {str(e)}', 500))
+    finally:
+        await events.aclose()
+        if _async_streams.get(key) is broadcast:
+            del _async_streams[key]
+        broadcast.close()
+
+
+def get_single_flight_stats() -> dict:
+    """
+    Статистика объединения запросов текущего воркера.
+
+    Returns:
+        dict: {'enabled': bool, 'chat': {...}, 'stream': {...}}
+    """
+    with _lock:
+        stats = dict(_stats)
+        in_flight_chat = len(_calls)
+        in_flight_streams = len(_streams) + len(_async_streams)
+    return {
+        'enabled': SINGLE_FLIGHT_ENABLED,
+        'chat': {
+            'upstream_calls': stats['chat_upstream_calls'],
+            'deduplicated': stats['chat_deduplicated'],
+            'bytes_saved': stats['chat_bytes_saved'],
+            'in_flight': in_flight_chat,
+        },
+        'stream': {
+            'upstream_calls': stats['stream_upstream_calls'],
+            'deduplicated': stats['stream_deduplicated'],
+            'bytes_saved': stats['stream_bytes_saved'],
+            'in_flight': in_flight_streams,
+        },
+    }
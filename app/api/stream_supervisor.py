@@ -0,0 +1,302 @@
+"""
+Таймеры и метрики потоковых ответов.
+
+StreamSupervisor ведет один поток: отправляет keep-alive по таймеру (независимо от того,
+приходят ли байты от OpenRouter), обрывает поток по idle-таймауту, вовремя отправляет
+объединенные токены и собирает метрики (TTFB, TTFT, гистограмма пауз между токенами, зависания).
+
+Чтение upstream не блокирует таймеры:
+- Flask путь: ThreadedChunkReader читает ответ в отдельном потоке, генератор ждет очередь с таймаутом
+- ASGI путь: чтение идет отдельной asyncio задачей (см. async_stream.py)
+"""
+import os
+import queue
+import socket
+import logging
+import threading
+import time
+
+from app.api import metrics
+from app.api.streaming import KEEP_ALIVE_EVENT, SSE_COALESCE_WINDOW_MS, SSE_COALESCE_MAX_BYTES, SSE_RELAY_MODE
+
+logger = logging.getLogger(__name__)
+
+# Интервал keep-alive комментариев, если клиенту ничего не отправлялось (секунд)
+SSE_HEARTBEAT_INTERVAL = float(os.environ.get('SSE_HEARTBEAT_INTERVAL', '8'))
+
+# Обрываем поток, если OpenRouter не присылает ни байта столько секунд
+STREAM_IDLE_TIMEOUT = float(os.environ.get('STREAM_IDLE_TIMEOUT', '120'))
+
+# Пауза между порциями от OpenRouter длиннее порога считается зависанием (секунд)
+STREAM_STALL_THRESHOLD = float(os.environ.get('STREAM_STALL_THRESHOLD', '5'))
+
+# Границы корзин гистограммы пауз между токенами (мс), последняя корзина - всё, что больше
+GAP_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Суммарные счетчики потоков процесса (обновляются один раз по завершении потока)
+_stream_totals = {
+    'streams': 0,
+    'deltas_received': 0,
+    'events_sent': 0,
+    'heartbeats_sent': 0,
+    'stalls': 0,
+    'idle_timeouts': 0,
+    'ttfb_sum': 0.0,
+    'ttfb_count': 0,
+    'ttft_sum': 0.0,
+    'ttft_count': 0,
+}
+_gap_histogram = [0] * (len(GAP_BUCKETS_MS) + 1)
+_stream_totals_lock = threading.Lock()
+
+
+def _gap_bucket(gap_ms: float) -> int:
+    for index, bound in enumerate(GAP_BUCKETS_MS):
+        if gap_ms <= bound:
+            return index
+    return len(GAP_BUCKETS_MS)
+
+
+class ThreadedChunkReader:
+    """
+    Читает итератор байтов upstream в фоновом потоке, чтобы генератор мог ждать данные с дедлайном.
+    Ответ OpenRouter закрывает сам поток чтения: response.close() из другого потока ждал бы,
+    пока зависший read() не вернется (до таймаута чтения), и держал бы поток воркера.
+    """
+
+    def __init__(self, iterable, response=None, max_queue: int = 64):
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._response = response
+        self._thread = threading.Thread(target=self._run, args=(iterable,), name='sse-upstream-reader', daemon=True)
+        self._thread.start()
+
+    def _run(self, iterable):
+        try:
+            for chunk in iterable:
+                if not self._put(('chunk', chunk)):
+                    return
+            self._put(('end', None))
+        except Exception as e:
+            self._put(('error', e))
+        finally:
+            # Дочитанный ответ возвращает соединение в пул, недочитанный - закрывает его
+            if self._response is not None:
+                self._response.close()
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, timeout: float) -> tuple:
+        """
+        Ждет следующую порцию не дольше timeout секунд.
+
+        Returns:
+            tuple: ('chunk', bytes) | ('end', None) | ('error', Exception) | ('timeout', None)
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return ('timeout', None)
+
+    def close(self, abort: bool = False):
+        """
+        Останавливает фоновый поток, не дожидаясь его. abort=True - поток не дочитан (idle-таймаут, ошибка,
+        клиент ушел): сокет ответа обрывается, чтобы зависший read() сразу вернулся и поток закрыл ответ.
+        """
+        self._stop.set()
+        if abort and self._thread.is_alive():
+            _shutdown_socket(self._response)
+
+
+def _shutdown_socket(response) -> None:
+    """Обрывает сокет ответа requests (urllib3): shutdown будит read() в другом потоке и не блокирует"""
+    connection = getattr(getattr(response, 'raw', None), '_connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        # Сокет уже закрыт
+        pass
+
+
+class StreamSupervisor:
+    """
+    Таймеры и метрики одного потока поверх StreamRelay.
+    Все моменты времени - time.monotonic().
+    """
+
+    def __init__(self, relay, started: float = None):
+        now = time.monotonic()
+        self.relay = relay
+        self.started = started if started is not None else now
+        # Супервизор создается после заголовков ответа OpenRouter: время соединения и ожидания ответа
+        self.connect_time = now - self.started
+        # Последняя запись клиенту и последняя порция от OpenRouter
+        self.last_sent = now
+        self.last_upstream = now
+        self.last_token = None
+        self.ttfb = None
+        self.ttft = None
+        self.stalls = 0
+        self.heartbeats_sent = 0
+        self.idle_timed_out = False
+        self.gap_histogram = [0] * (len(GAP_BUCKETS_MS) + 1)
+        self.gap_sum = 0.0
+
+    def timeout(self, now: float = None) -> float:
+        """Сколько секунд можно ждать данные от OpenRouter до ближайшего таймера"""
+        if now is None:
+            now = time.monotonic()
+        deadlines = [self.last_sent + SSE_HEARTBEAT_INTERVAL, self.last_upstream + STREAM_IDLE_TIMEOUT]
+        flush_deadline = self.relay.flush_deadline
+        if flush_deadline is not None:
+            deadlines.append(flush_deadline)
+        return max(0.0, min(deadlines) - now)
+
+    def on_chunk(self, data: bytes, now: float = None) -> bytes:
+        """Обрабатывает порцию байтов от OpenRouter, возвращает события для клиента"""
+        if now is None:
+            now = time.monotonic()
+
+        if self.ttfb is None:
+            self.ttfb = now - self.started
+        elif now - self.last_upstream > STREAM_STALL_THRESHOLD:
+            self.stalls += 1
+        self.last_upstream = now
+
+        deltas_before = self.relay.deltas_received
+        events = self.relay.feed_bytes(data, now)
+        if self.relay.deltas_received > deltas_before:
+            if self.last_token is None:
+                self.ttft = now - self.started
+            else:
+                gap = now - self.last_token
+                self.gap_histogram[_gap_bucket(gap * 1000)] += 1
+                self.gap_sum += gap
+            self.last_token = now
+
+        if events:
+            self.last_sent = now
+        return events
+
+    def on_tick(self, now: float = None) -> bytes:
+        """
+        Вызывается, когда истек таймаут ожидания данных: отправляет накопленные токены и keep-alive,
+        выставляет idle_timed_out, если OpenRouter молчит дольше STREAM_IDLE_TIMEOUT.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        events = self.relay.poll(now)
+        if events:
+            self.last_sent = now
+        elif now - self.last_sent >= SSE_HEARTBEAT_INTERVAL:
+            events = KEEP_ALIVE_EVENT
+            self.heartbeats_sent += 1
+            self.last_sent = now
+
+        if now - self.last_upstream >= STREAM_IDLE_TIMEOUT:
+            self.idle_timed_out = True
+        return events
+
+    def summary(self) -> dict:
+        """Метрики потока"""
+        return {
+            'ttfb_ms': round(self.ttfb * 1000, 1) if self.ttfb is not None else None,
+            'ttft_ms': round(self.ttft * 1000, 1) if self.ttft is not None else None,
+            'duration_ms': round((time.monotonic() - self.started) * 1000, 1),
+            'deltas_received': self.relay.deltas_received,
+            'events_sent': self.relay.events_sent,
+            'heartbeats_sent': self.heartbeats_sent,
+            'stalls': self.stalls,
+            'idle_timed_out': self.idle_timed_out,
+            'gap_histogram': self.gap_histogram,
+        }
+
+
+def record_stream_stats(supervisor: StreamSupervisor) -> None:
+    """Добавляет метрики завершенного потока в суммарную статистику процесса"""
+    summary = supervisor.summary()
+    logger.info(
+        f"Поток завершен: TTFB {summary['ttfb_ms']} мс, TTFT {summary['ttft_ms']} мс, "
+        f"длительность {summary['duration_ms']} мс, delta/событий {summary['deltas_received']}/{summary['events_sent']}, "
+        f"keep-alive {summary['heartbeats_sent']}, зависаний {summary['stalls']}"
+    )
+    with _stream_totals_lock:
+        _stream_totals['streams'] += 1
+        _stream_totals['deltas_received'] += summary['deltas_received']
+        _stream_totals['events_sent'] += summary['events_sent']
+        _stream_totals['heartbeats_sent'] += summary['heartbeats_sent']
+        _stream_totals['stalls'] += summary['stalls']
+        _stream_totals['idle_timeouts'] += 1 if summary['idle_timed_out'] else 0
+        if supervisor.ttfb is not None:
+            _stream_totals['ttfb_sum'] += supervisor.ttfb
+            _stream_totals['ttfb_count'] += 1
+        if supervisor.ttft is not None:
+            _stream_totals['ttft_sum'] += supervisor.ttft
+            _stream_totals['ttft_count'] += 1
+        for index, count in enumerate(supervisor.gap_histogram):
+            _gap_histogram[index] += count
+
+    # Метрики Prometheus: один раз на поток, а не на каждый токен
+    if supervisor.relay.finished:
+        outcome = 'completed'
+    elif supervisor.idle_timed_out:
+        outcome = 'idle_timeout'
+        metrics.inc('aichat_streams_aborted_total', labels=(('reason', 'idle_timeout'),))
+    else:
+        outcome = 'interrupted'
+    metrics.inc('aichat_requests_total', labels=(('endpoint', 'stream'), ('result', outcome)))
+    metrics.observe('aichat_upstream_connect_seconds', supervisor.connect_time)
+    if supervisor.ttft is not None:
+        metrics.observe('aichat_ttft_seconds', supervisor.ttft)
+    metrics.observe('aichat_stream_duration_seconds', time.monotonic() - supervisor.started)
+    metrics.observe_buckets('aichat_inter_token_seconds', supervisor.gap_histogram, supervisor.gap_sum)
+    if supervisor.stalls:
+        metrics.inc('aichat_stream_stalls_total', supervisor.stalls)
+
+
+def get_stream_stats() -> dict:
+    """
+    Статистика потоков текущего воркера.
+
+    Returns:
+        dict: {'streams': int, 'deltas_received': int, 'events_sent': int, 'coalesce_ratio': float,
+               'heartbeats_sent': int, 'stalls': int, 'idle_timeouts': int,
+               'avg_ttfb_ms': float, 'avg_ttft_ms': float,
+               'inter_token_gap_histogram_ms': {'<=10': int, ..., '>5000': int}, 'settings': {...}}
+    """
+    with _stream_totals_lock:
+        totals = dict(_stream_totals)
+        histogram = list(_gap_histogram)
+
+    labels = [f'<={bound}' for bound in GAP_BUCKETS_MS] + [f'>{GAP_BUCKETS_MS[-1]}']
+    return {
+        'streams': totals['streams'],
+        'deltas_received': totals['deltas_received'],
+        'events_sent': totals['events_sent'],
+        'coalesce_ratio': round(totals['deltas_received'] / totals['events_sent'], 2) if totals['events_sent'] else 0.0,
+        'heartbeats_sent': totals['heartbeats_sent'],
+        'stalls': totals['stalls'],
+        'idle_timeouts': totals['idle_timeouts'],
+        'avg_ttfb_ms': round(totals['ttfb_sum'] / totals['ttfb_count'] * 1000, 1) if totals['ttfb_count'] else None,
+        'avg_ttft_ms': round(totals['ttft_sum'] / totals['ttft_count'] * 1000, 1) if totals['ttft_count'] else None,
+        'inter_token_gap_histogram_ms': dict(zip(labels, histogram)),
+        'settings': {
+            'relay_mode': SSE_RELAY_MODE,
+            'coalesce_window_ms': SSE_COALESCE_WINDOW_MS,
+            'coalesce_max_bytes': SSE_COALESCE_MAX_BYTES,
+            'heartbeat_interval': SSE_HEARTBEAT_INTERVAL,
+            'idle_timeout': STREAM_IDLE_TIMEOUT,
+            'stall_threshold': STREAM_STALL_THRESHOLD,
+        }
+    }
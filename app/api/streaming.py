@@ -0,0 +1,303 @@
+"""
+Разбор SSE потока OpenRouter и формирование событий для клиента.
+Используется синхронным (/api/chat/stream во Flask) и асинхронным (ASGI) путями,
+чтобы формат событий token/done/cost был одинаковым.
+
+Режимы разбора (переменная окружения SSE_RELAY_MODE):
+- 'fast' (по умолчанию) - инкрементальный разбор сырых байтов: обычные delta-чанки не проходят
+  через json.loads/json.dumps, JSON-литерал токена копируется в исходящее событие как есть.
+  Полностью разбираются только чанки с model (первый), usage, finish_reason, reasoning
+  и нестандартным content.
+- 'parse' - полный json.loads каждого чанка (прежнее поведение)
+"""
+import os
+import re
+import json
+import time
+import logging
+
+from app.api.cost_calculator import calculate_cost_rub, cost_summary
+
+logger = logging.getLogger(__name__)
+
+# Режим разбора потока OpenRouter: 'fast' или 'parse'
+SSE_RELAY_MODE = os.environ.get('SSE_RELAY_MODE', 'fast')
+
+# Окно объединения токенов в одно событие (мс, 0 - отправлять каждый токен отдельно)
+SSE_COALESCE_WINDOW_MS = float(os.environ.get('SSE_COALESCE_WINDOW_MS', '30'))
+
+# Порог объединения: накоплено столько байт - отправляем, не дожидаясь окна
+SSE_COALESCE_MAX_BYTES = int(os.environ.get('SSE_COALESCE_MAX_BYTES', '1024'))
+
+# Keep-alive комментарий SSE
+KEEP_ALIVE_EVENT = b":\n\n"
+
+# Предкомпилированный энкодер (то же, что json.dumps(..., ensure_ascii=False), без разбора kwargs)
+_encoder = json.JSONEncoder(ensure_ascii=False)
+
+# Шаблон события с токеном: data: {"token": <JSON строка>, "done": false}\n\n
+_TOKEN_EVENT_PREFIX = b'data: {"token": '
+_TOKEN_EVENT_SUFFIX = b', "done": false}\n\n'
+
+# JSON-литерал content в delta (с кавычками, escape-последовательности не раскрываются)
+_CONTENT_LITERAL_RE = re.compile(rb'"content"\s*:\s*("[^"\\]*(?:\\.[^"\\]*)*")')
+
+# Признаки чанков, которые нужно разобрать полностью
+_NEEDS_FULL_PARSE_RE = re.compile(
+    rb'"usage"\s*:\s*\{|"finish_reason"\s*:\s*"|"reasoning(?:_content)?"\s*:\s*"|"content"\s*:\s*\['
+)
+
+
+def sse_event(data: dict) -> bytes:
+    """Форматирует словарь как SSE событие"""
+    return b'data: ' + _encoder.encode(data).encode('utf-8') + b'\n\n'
+
+
+def error_event(error_message: str, status_code: int) -> bytes:
+    """Формирует SSE событие с ошибкой"""
+    return sse_event({
+        'error': error_message,
+        'status_code': status_code
+    })
+
+
+def token_event(token: str) -> bytes:
+    """Формирует SSE событие с токеном"""
+    return _TOKEN_EVENT_PREFIX + _encoder.encode(token).encode('utf-8') + _TOKEN_EVENT_SUFFIX
+
+
+def extract_delta_text(delta: dict) -> str:
+    if not isinstance(delta, dict):
+        return ''
+    parts = []
+    content = delta.get('content')
+    if isinstance(content, str) and content:
+        parts.append(content)
+    elif isinstance(content, list):
+        for part in content:
+            if isinstance(part, dict):
+                text = part.get('text') or part.get('content')
+                if isinstance(text, str) and text:
+                    parts.append(text)
+    for key in ('reasoning', 'reasoning_content'):
+        val = delta.get(key)
+        if isinstance(val, str) and val:
+            parts.append(val)
+    return ''.join(parts)
+
+
+class StreamRelay:
+    """
+    Состояние одного потокового ответа: инкрементально разбирает байты SSE потока OpenRouter
+    и возвращает готовые SSE события для клиента.
+
+    Токены объединяются (coalescing): первый токен уходит сразу, остальные копятся
+    и отправляются одним событием, когда с начала накопления прошло SSE_COALESCE_WINDOW_MS
+    или накоплено SSE_COALESCE_MAX_BYTES байт.
+    """
+
+    def __init__(self, model: str, mode: str = None, coalesce_window_ms: float = None, coalesce_max_bytes: int = None,
+                 request_id: str = None, requested_model: str = None):
+        self.used_model = model
+        # Модель клиента, если запрос ушел к резервной (см. model_router.py), - возвращается в событии done
+        self.requested_model = requested_model
+        # Id запроса к OpenRouter (X-Request-Id), возвращается клиенту в событии done
+        self.request_id = request_id
+        self.finish_reason = None
+        self.usage_data = None
+        # Стоимость ответа (заполняется в final_event)
+        self.cost = None
+        self.finished = False
+        self.fast = (mode or SSE_RELAY_MODE) == 'fast'
+        if coalesce_window_ms is None:
+            coalesce_window_ms = SSE_COALESCE_WINDOW_MS
+        self.coalesce_window = coalesce_window_ms / 1000.0
+        self.coalesce_max_bytes = SSE_COALESCE_MAX_BYTES if coalesce_max_bytes is None else coalesce_max_bytes
+        # Счетчики: сколько delta пришло от OpenRouter и сколько token событий ушло клиенту
+        self.deltas_received = 0
+        self.events_sent = 0
+        self._model_seen = False
+        self._buffer = b''
+        # Все токены в порядке поступления (JSON-литералы с кавычками)
+        self._tokens = []
+        # Токены, ожидающие отправки
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_since = None
+
+    @property
+    def accumulated_content(self) -> str:
+        """Полный текст ответа (JSON-литералы раскрываются одним json.loads при обращении)"""
+        if not self._tokens:
+            return ''
+        return ''.join(json.loads(b'[' + b','.join(self._tokens) + b']'))
+
+    @property
+    def flush_deadline(self):
+        """Момент (time.monotonic), когда накопленные токены нужно отправить, или None"""
+        if self._pending_since is None:
+            return None
+        return self._pending_since + self.coalesce_window
+
+    def feed_bytes(self, data: bytes, now: float = None) -> bytes:
+        """
+        Обрабатывает очередную порцию байтов из потока OpenRouter.
+
+        Args:
+            data: Сырые байты (могут обрываться посреди строки)
+            now: Текущее time.monotonic() (для тестов и бенчмарков)
+
+        Returns:
+            bytes: SSE события, готовые к отправке, одним буфером (b'' если отправлять пока нечего).
+                   После '[DONE]' выставляется self.finished = True и накопленные токены отправляются.
+        """
+        if self.finished:
+            return b''
+
+        if now is None:
+            now = time.monotonic()
+
+        buffer = self._buffer + data if self._buffer else data
+        lines = buffer.split(b'\n')
+        # Последний элемент - незавершенная строка, ждем продолжения
+        self._buffer = lines.pop()
+
+        events = []
+        for line in lines:
+            literal = self._process_line(line)
+            if literal:
+                self._tokens.append(literal)
+                self.deltas_received += 1
+                if (self.events_sent == 0 and not self._pending) or self.coalesce_window <= 0:
+                    # Первый токен отправляем сразу, чтобы не ухудшать time-to-first-token
+                    self.events_sent += 1
+                    events.append(_TOKEN_EVENT_PREFIX + literal + _TOKEN_EVENT_SUFFIX)
+                else:
+                    if self._pending_since is None:
+                        self._pending_since = now
+                    self._pending.append(literal)
+                    self._pending_bytes += len(literal)
+            if self.finished:
+                self._buffer = b''
+                break
+
+        if self._pending and (
+            self.finished
+            or self._pending_bytes >= self.coalesce_max_bytes
+            or now >= self._pending_since + self.coalesce_window
+        ):
+            events.append(self.flush())
+
+        return b''.join(events)
+
+    def poll(self, now: float = None) -> bytes:
+        """Отправляет накопленные токены, если окно объединения истекло (вызывается по таймеру)"""
+        if not self._pending:
+            return b''
+        if now is None:
+            now = time.monotonic()
+        if now >= self._pending_since + self.coalesce_window:
+            return self.flush()
+        return b''
+
+    def flush(self) -> bytes:
+        """Объединяет накопленные токены в одно token событие"""
+        if not self._pending:
+            return b''
+        if len(self._pending) == 1:
+            literal = self._pending[0]
+        else:
+            # Склеиваем JSON-литералы без раскрытия escape-последовательностей
+            literal = b'"' + b''.join(item[1:-1] for item in self._pending) + b'"'
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_since = None
+        self.events_sent += 1
+        return _TOKEN_EVENT_PREFIX + literal + _TOKEN_EVENT_SUFFIX
+
+    def _process_line(self, line: bytes):
+        """Возвращает JSON-литерал токена из строки потока или None"""
+        # Пустые строки, комментарии (keep-alive от OpenRouter) и не-data строки пропускаем
+        if not line.startswith(b'data:'):
+            return None
+
+        data_bytes = line[5:].strip()
+
+        # Проверяем на завершение потока
+        if data_bytes == b'[DONE]':
+            self.finished = True
+            return None
+
+        if not data_bytes:
+            # Пустая data строка, пропускаем
+            return None
+
+        if self.fast and self._model_seen and not _NEEDS_FULL_PARSE_RE.search(data_bytes):
+            matches = _CONTENT_LITERAL_RE.findall(data_bytes)
+            if len(matches) == 1:
+                literal = matches[0]
+                return literal if literal != b'""' else None
+            if not matches and b'"content"' not in data_bytes:
+                # Чанк без текста (например, только role)
+                return None
+
+        return self._process_json(data_bytes)
+
+    def _process_json(self, data_bytes: bytes):
+        try:
+            chunk_data = json.loads(data_bytes)
+        except ValueError as json_error:
+            # Пропускаем некорректные JSON строки (не прерываем генератор)
+            logger.debug(f"Пропущен некорректный JSON: {data_bytes[:50]}... Ошибка: {json_error}")
+            return None
+
+        if not isinstance(chunk_data, dict):
+            return None
+
+        # Извлекаем модель из первого чанка
+        if 'model' in chunk_data:
+            self.used_model = chunk_data['model']
+            self._model_seen = True
+
+        # Извлекаем usage данные (приходят в последнем чанке)
+        if 'usage' in chunk_data:
+            self.usage_data = chunk_data['usage']
+
+        # Извлекаем содержимое токена
+        if 'choices' in chunk_data and len(chunk_data['choices']) > 0:
+            choice = chunk_data['choices'][0]
+
+            # Получаем finish_reason (если есть)
+            if 'finish_reason' in choice:
+                self.finish_reason = choice['finish_reason']
+
+            token_content = extract_delta_text(choice.get('delta', {}))
+            if token_content:
+                return _encoder.encode(token_content).encode('utf-8')
+
+        return None
+
+    def final_event(self) -> bytes:
+        """
+        Формирует финальное SSE событие с метаданными и стоимостью.
+        Может обращаться к сети за тарифами, поэтому в async коде вызывается через to_thread.
+        """
+        final_data = {
+            'token': '',
+            'done': True,
+            'model': self.used_model,
+            'finish_reason': self.finish_reason
+        }
+        if self.request_id:
+            final_data['request_id'] = self.request_id
+        if self.requested_model:
+            final_data['requested_model'] = self.requested_model
+
+        # Добавляем информацию о стоимости, если доступна (в лог она попадает через трассу запроса)
+        if self.usage_data:
+            cost_info = calculate_cost_rub({'usage': self.usage_data, 'model': self.used_model}, self.used_model)
+            if cost_info:
+                self.cost = cost_summary(cost_info)
+                final_data['cost'] = self.cost
+
+        return sse_event(final_data)
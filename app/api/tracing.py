@@ -0,0 +1,256 @@
+"""
+Трассировка запросов /api/chat и /api/chat/stream: время фаз, request id и выборочный JSON-лог.
+
+- Trace размечает фазы запроса (валидация, история, соединение с OpenRouter, первый байт, поток, стоимость):
+  mark() записывает время с предыдущей отметки, это одно чтение perf_counter
+- Request id берется из заголовка X-Request-Id клиента (или генерируется), передается в OpenRouter
+  и возвращается клиенту в заголовке X-Request-Id и в событии done потока
+- Завершенный запрос пишется одной JSON строкой в лог app.trace: доля TRACE_SAMPLE_RATE успешных запросов
+  и все запросы с ошибкой. Время фаз всех запросов идет в метрику aichat_phase_seconds
+- Логирование буферизовано: записи кладутся в очередь (QueueHandler), в stderr их пишет отдельный поток
+  (QueueListener), поэтому генератор потока не ждет вывода. JSON собирается тоже в потоке записи.
+  При переполнении очереди записи отбрасываются, а не блокируют запрос
+"""
+import os
+import re
+import sys
+import json
+import time
+import queue
+import random
+import logging
+import functools
+import threading
+import logging.handlers
+
+from flask import g, request, make_response
+
+from app.api import metrics
+
+logger = logging.getLogger(__name__)
+
+# Доля успешных запросов, которые пишутся в лог трассировки (запросы с ошибкой пишутся всегда)
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.05'))
+
+# Буферизованный вывод логов через отдельный поток (0 - писать синхронно)
+LOG_ASYNC = os.environ.get('LOG_ASYNC', '1') == '1'
+
+# Максимум записей лога в очереди; при переполнении новые записи отбрасываются
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+
+REQUEST_ID_HEADER = 'X-Request-Id'
+TRACE_LOGGER = 'app.trace'
+
+_REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+
+_trace_logger = logging.getLogger(TRACE_LOGGER)
+_trace_logger.propagate = False
+
+_lock = threading.Lock()
+_listener = None
+
+_stats = {
+    'traces': 0,
+    'logged': 0,
+    'dropped': 0,
+}
+
+
+class Trace:
+    """Трасса одного запроса (ведет ее поток или задача, обрабатывающие запрос)"""
+
+    __slots__ = ('request_id', 'endpoint', 'sampled', 'started', 'last', 'spans', 'attrs', 'status', 'finished')
+
+    def __init__(self, endpoint: str, request_id: str = None):
+        self.request_id = request_id if request_id and _REQUEST_ID_PATTERN.match(request_id) else os.urandom(8).hex()
+        self.endpoint = endpoint
+        self.sampled = random.random() < TRACE_SAMPLE_RATE
+        self.started = self.last = time.perf_counter()
+        # [(фаза, секунды)] в порядке выполнения
+        self.spans = []
+        self.attrs = {}
+        self.status = 'ok'
+        self.finished = False
+
+    def mark(self, phase: str) -> None:
+        """Завершает фазу: время с предыдущей отметки (или с начала запроса)"""
+        now = time.perf_counter()
+        self.spans.append((phase, now - self.last))
+        self.last = now
+
+    def set(self, **attrs) -> None:
+        """Добавляет поля в запись трассы (модель, токены, стоимость и т.д.)"""
+        self.attrs.update(attrs)
+
+    def fail(self, status: str) -> None:
+        """Отмечает результат запроса (первая ошибка сохраняется)"""
+        if self.status == 'ok':
+            self.status = status
+
+    def finish(self) -> None:
+        """Завершает трассу: метрики фаз и (выборочно) JSON запись в лог. Повторный вызов ничего не делает"""
+        if self.finished:
+            return
+        self.finished = True
+        duration = time.perf_counter() - self.started
+        labels = (('endpoint', self.endpoint),)
+        for phase, seconds in self.spans:
+            metrics.observe('aichat_phase_seconds', seconds, labels + (('phase', phase),))
+        with _lock:
+            _stats['traces'] += 1
+        if not self.sampled and self.status == 'ok':
+            return
+        # Сериализация в JSON - в потоке записи логов (см. _JsonFormatter)
+        _trace_logger.info({
+            'ts': time.time(),
+            'request_id': self.request_id,
+            'endpoint': self.endpoint,
+            'status': self.status,
+            'duration_ms': round(duration * 1000, 1),
+            'spans': {phase: round(seconds * 1000, 1) for phase, seconds in self.spans},
+            **self.attrs,
+        })
+        with _lock:
+            _stats['logged'] += 1
+
+
+def traced(endpoint: str):
+    """
+    Декоратор Flask view: создает Trace (доступна как g.trace), добавляет заголовок X-Request-Id.
+    Для потокового ответа трасса завершается, когда сервер закрывает ответ (поток дочитан или клиент ушел).
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            trace = Trace(endpoint, request.headers.get(REQUEST_ID_HEADER))
+            g.trace = trace
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                trace.fail('error')
+                trace.finish()
+                raise
+            response.headers[REQUEST_ID_HEADER] = trace.request_id
+            if response.status_code >= 400:
+                trace.fail(f'http_{response.status_code}')
+            if response.is_streamed:
+                response.call_on_close(trace.finish)
+            else:
+                trace.finish()
+            return response
+        return wrapper
+    return decorator
+
+
+class _JsonFormatter(logging.Formatter):
+    """Запись трассы (dict) -> одна JSON строка"""
+
+    def format(self, record):
+        if isinstance(record.msg, dict):
+            return json.dumps(record.msg, ensure_ascii=False, default=str)
+        return super().format(record)
+
+
+class _BufferedHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не блокирует и не падает при переполнении очереди"""
+
+    def prepare(self, record):
+        if isinstance(record.msg, dict):
+            # Трассу форматирует поток записи; dict после finish() уже не изменяется
+            return record
+        return super().prepare(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _stats['dropped'] += 1
+
+
+class _Dispatcher(logging.Handler):
+    """Поток записи: трассы - в JSON обработчик, остальные записи - в прежние обработчики root"""
+
+    def __init__(self, handlers: list, trace_handler: logging.Handler):
+        super().__init__()
+        self.handlers = handlers
+        self.trace_handler = trace_handler
+
+    def handle(self, record):
+        if record.name == TRACE_LOGGER:
+            self.trace_handler.handle(record)
+            return True
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+        return True
+
+    def emit(self, record):
+        self.handle(record)
+
+
+def _make_trace_handler() -> logging.Handler:
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(_JsonFormatter())
+    return handler
+
+
+# До запуска потока записи (например, в мастере gunicorn) трассы пишутся синхронно
+_trace_logger.addHandler(_make_trace_handler())
+_trace_logger.setLevel(logging.INFO)
+
+
+def start_log_listener() -> bool:
+    """
+    Переключает логи процесса на буферизованную запись отдельным потоком (один раз на процесс, после fork).
+
+    Returns:
+        bool: True, если поток записи запущен этим вызовом
+    """
+    global _listener
+    if not LOG_ASYNC:
+        return False
+    with _lock:
+        if _listener is not None:
+            return False
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        root = logging.getLogger()
+        root_handlers = root.handlers[:] or [logging.lastResort]
+        trace_handlers = _trace_logger.handlers[:]
+        buffered = _BufferedHandler(log_queue)
+        root.handlers = [buffered]
+        _trace_logger.handlers = [buffered]
+        _listener = logging.handlers.QueueListener(log_queue, _Dispatcher(root_handlers, trace_handlers[0]))
+        _listener.start()
+    return True
+
+
+def stop_log_listener() -> None:
+    """Дописывает записи из очереди и останавливает поток записи (при выходе воркера)"""
+    global _listener
+    with _lock:
+        listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+        # Записи после остановки пишутся синхронно прежними обработчиками
+        dispatcher = listener.handlers[0]
+        logging.getLogger().handlers = dispatcher.handlers
+        _trace_logger.handlers = [dispatcher.trace_handler]
+
+
+def get_tracing_stats() -> dict:
+    """
+    Статистика трассировки текущего воркера.
+
+    Returns:
+        dict: {'traces': int, 'logged': int, 'dropped': int, 'sample_rate': float,
+               'async_logging': bool, 'queue_size': int}
+    """
+    with _lock:
+        stats = dict(_stats)
+        listener = _listener
+    stats.update({
+        'sample_rate': TRACE_SAMPLE_RATE,
+        'async_logging': listener is not None,
+        'queue_size': listener.queue.qsize() if listener is not None else 0,
+    })
+    return stats
@@ -0,0 +1,246 @@
+"""
+Общие настройки и HTTP клиенты для обращения к OpenRouter API.
+
+Все запросы к OpenRouter (chat, streaming, тарифы) идут через общие для процесса клиенты
+с пулом keep-alive соединений, чтобы не платить за TCP + TLS handshake на каждое сообщение:
+- get_upstream_session() - синхронный requests.Session (Flask)
+- get_async_client() - асинхронный httpx.AsyncClient (ASGI), опционально HTTP/2
+"""
+import os
+import json
+import logging
+import threading
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Базовый URL OpenRouter API (можно переопределить, например, для локального fake-сервера)
+OPENROUTER_BASE_URL = os.environ.get('OPENROUTER_BASE_URL', 'https://openrouter.ai/api/v1').rstrip('/')
+
+# URL для chat completions
+OPENROUTER_API_URL = f"{OPENROUTER_BASE_URL}/chat/completions"
+
+# URL для получения списка моделей и их тарифов
+MODELS_API_URL = f"{OPENROUTER_BASE_URL}/models"
+
+# Количество пулов по хостам, которые хранит requests.Session
+UPSTREAM_POOL_CONNECTIONS = int(os.environ.get('UPSTREAM_POOL_CONNECTIONS', '10'))
+
+# Максимум keep-alive соединений к одному хосту (per-host limit)
+UPSTREAM_POOL_MAXSIZE = int(os.environ.get('UPSTREAM_POOL_MAXSIZE', '32'))
+
+# Ждать свободное соединение вместо открытия сверх лимита
+UPSTREAM_POOL_BLOCK = os.environ.get('UPSTREAM_POOL_BLOCK', '0') == '1'
+
+# Максимум одновременных соединений к OpenRouter у async клиента
+ASYNC_UPSTREAM_MAX_CONNECTIONS = int(os.environ.get('ASYNC_UPSTREAM_MAX_CONNECTIONS', '1000'))
+
+# Таймаут чтения async клиента (секунд)
+ASYNC_UPSTREAM_TIMEOUT = float(os.environ.get('ASYNC_UPSTREAM_TIMEOUT', '120'))
+
+# Таймаут подключения к OpenRouter (секунд): недоступный хост не держит воркер весь таймаут чтения
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', '10'))
+
+# Сколько секунд держать простаивающее keep-alive соединение у async клиента
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get('UPSTREAM_KEEPALIVE_EXPIRY', '60'))
+
+# HTTP/2 для async клиента (нужен пакет h2: pip install httpx[http2])
+UPSTREAM_HTTP2 = os.environ.get('UPSTREAM_HTTP2', '0') == '1'
+
+# Общие клиенты процесса
+_session = None
+_session_lock = threading.Lock()
+_async_client = None
+
+# Ответы upstream по хостам и версиям HTTP (считаются хуками клиентов)
+_stats_lock = threading.Lock()
+_sync_requests = {}
+_async_requests = {}
+
+
+def _count_response(counters: dict, url: str, http_version: str) -> None:
+    parts = urlsplit(url)
+    key = (f"{parts.scheme}://{parts.netloc}", http_version)
+    with _stats_lock:
+        counters[key] = counters.get(key, 0) + 1
+
+
+def _on_sync_response(response, *args, **kwargs):
+    # requests (urllib3) работает только по HTTP/1.1
+    _count_response(_sync_requests, response.url, 'HTTP/1.1')
+
+
+async def _on_async_response(response: httpx.Response) -> None:
+    _count_response(_async_requests, str(response.request.url), response.http_version)
+
+
+def get_upstream_session() -> requests.Session:
+    """
+    Возвращает общий для процесса requests.Session с пулом keep-alive соединений.
+    Session потокобезопасен для наших запросов (без cookies и изменения состояния).
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=UPSTREAM_POOL_CONNECTIONS,
+                    pool_maxsize=UPSTREAM_POOL_MAXSIZE,
+                    pool_block=UPSTREAM_POOL_BLOCK
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.hooks['response'].append(_on_sync_response)
+                _session = session
+    return _session
+
+
+def close_upstream_session() -> None:
+    """Закрывает соединения общего requests.Session (следующий запрос создаст новый пул)"""
+    global _session
+    with _session_lock:
+        session, _session = _session, None
+    if session is not None:
+        session.close()
+
+
+def _reset_after_fork() -> None:
+    # Дочерний процесс (воркер gunicorn после preload) не должен читать из сокетов родителя
+    global _session, _session_lock, _async_client, _stats_lock
+    _session = None
+    _session_lock = threading.Lock()
+    _async_client = None
+    _stats_lock = threading.Lock()
+    _sync_requests.clear()
+    _async_requests.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Возвращает общий для процесса async HTTP клиент к OpenRouter (создается лениво внутри event loop)"""
+    global _async_client
+    if _async_client is None:
+        http2 = UPSTREAM_HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("UPSTREAM_HTTP2=1, но пакет h2 не установлен - используется HTTP/1.1")
+                http2 = False
+
+        _async_client = httpx.AsyncClient(
+            http2=http2,
+            timeout=httpx.Timeout(ASYNC_UPSTREAM_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=ASYNC_UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=ASYNC_UPSTREAM_MAX_CONNECTIONS,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY
+            ),
+            event_hooks={'response': [_on_async_response]}
+        )
+    return _async_client
+
+
+async def close_async_client():
+    """Закрывает общий async клиент (вызывается при остановке ASGI приложения)"""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def _hosts(counters: dict) -> list:
+    """[{'host': str, 'requests': int, 'http_versions': {версия: int}}] по счетчикам ответов"""
+    hosts = {}
+    with _stats_lock:
+        items = list(counters.items())
+    for (host, http_version), count in items:
+        entry = hosts.setdefault(host, {'host': host, 'requests': 0, 'http_versions': {}})
+        entry['requests'] += count
+        entry['http_versions'][http_version] = count
+    return list(hosts.values())
+
+
+def get_pool_stats() -> dict:
+    """
+    Настройки пулов соединений к upstream и ответы по хостам (считаются публичными хуками клиентов:
+    Session.hooks у requests, event_hooks у httpx).
+
+    Returns:
+        dict: {
+            'sync': {'pool_maxsize': int, ..., 'hosts': [{'host': str, 'requests': int, 'http_versions': {...}}]},
+            'async': {'enabled': bool, 'http2': bool, ..., 'hosts': [...]}
+        }
+    """
+    sync_stats = {
+        'pool_connections': UPSTREAM_POOL_CONNECTIONS,
+        'pool_maxsize': UPSTREAM_POOL_MAXSIZE,
+        'pool_block': UPSTREAM_POOL_BLOCK,
+        'hosts': _hosts(_sync_requests)
+    }
+    async_stats = {
+        'enabled': _async_client is not None,
+        'http2': UPSTREAM_HTTP2,
+        'max_connections': ASYNC_UPSTREAM_MAX_CONNECTIONS,
+        'keepalive_expiry': UPSTREAM_KEEPALIVE_EXPIRY,
+        'hosts': _hosts(_async_requests)
+    }
+    return {'sync': sync_stats, 'async': async_stats}
+
+
+def build_upstream_headers(api_key: str, http_referer: str = None, request_id: str = None) -> dict:
+    """
+    Формирует заголовки запроса к OpenRouter
+
+    Args:
+        api_key: API ключ OpenRouter
+        http_referer: HTTP Referer (опционально)
+        request_id: Id запроса для сопоставления логов (опционально)
+
+    Returns:
+        dict: Заголовки запроса
+    """
+    headers = {
+        'Authorization': f'Bearer {api_key}',
+        'Content-Type': 'application/json'
+    }
+
+    if http_referer:
+        headers['HTTP-Referer'] = http_referer
+
+    if request_id:
+        headers['X-Request-Id'] = request_id
+
+    return headers
+
+
+def extract_upstream_error(status_code: int, content_type: str, body) -> str:
+    """
+    Извлекает текст ошибки из ответа OpenRouter
+
+    Args:
+        status_code: HTTP статус ответа
+        content_type: Значение заголовка Content-Type
+        body: Тело ответа (bytes или str)
+
+    Returns:
+        str: Сообщение об ошибке для клиента
+    """
+    default_message = f'Ошибка при запросе к OpenRouter (HTTP {status_code})'
+    try:
+        if not (content_type or '').startswith('application/json'):
+            return default_message
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', errors='ignore')
+        error_data = json.loads(body) if body else {}
+        return error_data.get('error', {}).get('message', default_message)
+    except Exception:
+        return default_message
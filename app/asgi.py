@@ -0,0 +1,50 @@
+"""
+ASGI точка входа приложения.
+
+POST /api/chat/stream обслуживается асинхронно (app.api.async_stream),
+все остальные запросы передаются во Flask приложение через a2wsgi (параллельно, в пуле потоков).
+
+Запуск:
+    gunicorn app.asgi:app --bind 0.0.0.0:5000 -k uvicorn.workers.UvicornWorker
+    uvicorn app.asgi:app --port 5000  # локально
+"""
+import os
+import logging
+
+from a2wsgi import WSGIMiddleware
+
+from app.main import app as flask_app
+from app.api.async_stream import handle_chat_stream
+from app.api.upstream import close_async_client
+
+logger = logging.getLogger(__name__)
+
+# Потоков для запросов к Flask (/api/chat ждет OpenRouter до 120 сек), как GUNICORN_THREADS у gthread
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', '32'))
+
+# Запросы к Flask выполняются параллельно в пуле потоков (Flask потокобезопасен)
+_wsgi_app = WSGIMiddleware(flask_app, workers=ASGI_WSGI_THREADS)
+
+
+async def _lifespan(receive, send):
+    """Обработка событий запуска/остановки ASGI сервера"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_async_client()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+
+    if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == '/api/chat/stream':
+        await handle_chat_stream(scope, receive, send)
+        return
+
+    await _wsgi_app(scope, receive, send)
@@ -1,161 +1,305 @@
 """
-Утилита для загрузки системного промпта из файла или переменной окружения
+Реестр системных промптов: загрузка из файлов или переменной окружения и перезагрузка при изменении файлов.
+
+- Все варианты промпта (стиль И.А. x уровень детальности) собираются один раз в неизменяемый снимок
+  (PromptSnapshot), запросы только берут готовую строку по ключу (use_ia_style, verbosity)
+- Строки интернированы, для каждого варианта заранее посчитаны токены и хэш содержимого:
+  оценка токенов и ключ кэша ответов не обрабатывают ~13 КБ промпта на каждый запрос
+- Фоновый поток раз в PROMPT_RELOAD_INTERVAL секунд проверяет mtime и размер файлов промптов;
+  при изменении новый снимок собирается целиком и подменяет старый одной операцией,
+  поэтому запрос никогда не видит наполовину обновленные варианты
 """
 import os
+import sys
+import time
+import hashlib
 import logging
+import threading
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
-# Кэш для промпта в памяти
-_cached_prompt = None
-_cached_additional_prompt = None
+# Как часто проверять изменения файлов промптов (секунды, 0 - не проверять)
+PROMPT_RELOAD_INTERVAL = float(os.environ.get('PROMPT_RELOAD_INTERVAL', '2'))
 
+# app/config/prompt_loader.py -> app/config/system_prompt.txt, app/config/style_ia_prompt.txt
+_CONFIG_DIR = Path(__file__).parent
+SYSTEM_PROMPT_FILE = _CONFIG_DIR / 'system_prompt.txt'
+IA_PROMPT_FILE = _CONFIG_DIR / 'style_ia_prompt.txt'
 
-def get_system_prompt() -> str:
+_VERBOSITY_INSTRUCTIONS = {
+    'low': (
+        'УРОВЕНЬ ДЕТАЛЬНОСТИ: краткий.\n'
+        'Максимальная лаконичность. Только суть, без вводных и развёрнутых обоснований.'
+    ),
+    'medium': (
+        'УРОВЕНЬ ДЕТАЛЬНОСТИ: средний.\n'
+        'Стандартный объём: контекст, основная часть, заключение.'
+    ),
+    'high': (
+        'УРОВЕНЬ ДЕТАЛЬНОСТИ: развёрнутый.\n'
+        'Полное раскрытие всех тезисов с подробными обоснованиями.'
+    ),
+}
+
+# Допустимые уровни детальности
+VERBOSITY_LEVELS = tuple(_VERBOSITY_INSTRUCTIONS)
+
+
+class PromptVariant:
+    """Готовый вариант системного промпта: интернированный текст, оценка токенов и хэш содержимого"""
+
+    __slots__ = ('text', 'tokens', 'hash')
+
+    def __init__(self, text: str, tokens: int):
+        self.text = sys.intern(text)
+        self.tokens = tokens
+        self.hash = hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class PromptSnapshot:
+    """Неизменяемый снимок промптов: после сборки только читается"""
+
+    __slots__ = ('system_prompt', 'ia_prompt', 'source', 'variants', 'by_text', 'signature', 'version', 'loaded_at')
+
+    def __init__(self, system_prompt: str, ia_prompt: str, source: str, signature: tuple, version: int):
+        self.system_prompt = sys.intern(system_prompt)
+        self.ia_prompt = sys.intern(ia_prompt)
+        self.source = source
+        self.signature = signature
+        self.version = version
+        self.loaded_at = time.time()
+
+        from app.api.cost_calculator import estimate_token_count
+
+        # (use_ia_style, verbosity) -> PromptVariant; одинаковые тексты делят один объект
+        self.variants = {}
+        self.by_text = {}
+        for use_ia_style in (False, True):
+            for verbosity in (None,) + VERBOSITY_LEVELS:
+                text = _combine(self.system_prompt, self.ia_prompt if use_ia_style else '', verbosity)
+                variant = self.by_text.get(text)
+                if variant is None:
+                    variant = PromptVariant(text, estimate_token_count(text))
+                    self.by_text[variant.text] = variant
+                self.variants[(use_ia_style, verbosity)] = variant
+
+
+_snapshot = None
+_lock = threading.Lock()
+_watcher_started = False
+
+_stats = {
+    'reloads': 0,
+    'checks': 0,
+    'errors': 0,
+}
+
+
+def _combine(system_prompt: str, ia_prompt: str, verbosity: str) -> str:
+    parts = [system_prompt, ia_prompt]
+    if verbosity:
+        parts.append(_VERBOSITY_INSTRUCTIONS[verbosity])
+    return '\n\n'.join(p for p in parts if p)
+
+
+def _file_signature() -> tuple:
+    """(mtime_ns, size) файлов промптов; None для отсутствующего файла"""
+    signature = []
+    for path in (SYSTEM_PROMPT_FILE, IA_PROMPT_FILE):
+        try:
+            stat = path.stat()
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def _read_prompt_file(path: Path, title: str) -> str:
+    """Читает файл промпта; пустая строка, если файла нет, он пуст или не читается (под _lock)"""
+    try:
+        if path.exists() and path.is_file():
+            with open(path, 'r', encoding='utf-8') as f:
+                prompt_content = f.read().strip()
+            if prompt_content:
+                logger.info(f"Загружен {title} из файла: {path}")
+                return prompt_content
+            logger.warning(f"Файл промпта пуст: {path}")
+        else:
+            logger.warning(f"Файл промпта не найден: {path}")
+    except Exception as e:
+        logger.error(f"Ошибка при чтении файла промпта {path}: {e}")
+        _stats['errors'] += 1
+    return ''
+
+
+def _build_snapshot(signature: tuple, version: int) -> PromptSnapshot:
     """
-    Загружает системный промпт из файла или переменной окружения.
-    
-    Приоритет:
+    Собирает снимок промптов (под _lock).
+
+    Приоритет основного промпта:
     1. Переменная окружения SYSTEM_PROMPT (если установлена)
     2. Файл app/config/system_prompt.txt
     3. Пустая строка (fallback)
-    
-    Returns:
-        str: Системный промпт или пустая строка
     """
-    global _cached_prompt
-    
-    # Проверяем переменную окружения (имеет наивысший приоритет)
     env_prompt = os.environ.get('SYSTEM_PROMPT')
     if env_prompt:
         logger.info("Загружен системный промпт из переменной окружения SYSTEM_PROMPT")
-        _cached_prompt = env_prompt
-        return _cached_prompt
-    
-    # Если промпт уже закэширован, возвращаем его
-    if _cached_prompt is not None:
-        return _cached_prompt
-    
-    # Определяем путь к файлу промпта
-    # app/config/prompt_loader.py -> app/config/ -> app/config/system_prompt.txt
-    current_file = Path(__file__)
-    prompt_file = current_file.parent / 'system_prompt.txt'
-    
-    try:
-        # Читаем промпт из файла
-        if prompt_file.exists() and prompt_file.is_file():
-            with open(prompt_file, 'r', encoding='utf-8') as f:
-                prompt_content = f.read().strip()
-                
-            if prompt_content:
-                logger.info(f"Загружен системный промпт из файла: {prompt_file}")
-                _cached_prompt = prompt_content
-                return _cached_prompt
-            else:
-                logger.warning(f"Файл промпта пуст: {prompt_file}")
-        else:
-            logger.warning(f"Файл промпта не найден: {prompt_file}")
-    
-    except Exception as e:
-        logger.error(f"Ошибка при чтении файла промпта: {e}")
-    
-    # Fallback: возвращаем пустую строку
-    logger.info("Системный промпт не загружен, используется пустая строка")
-    _cached_prompt = ""
-    return _cached_prompt
+        system_prompt, source = env_prompt, 'env'
+    else:
+        system_prompt = _read_prompt_file(SYSTEM_PROMPT_FILE, 'системный промпт')
+        source = 'file' if system_prompt else 'empty'
+        if not system_prompt:
+            logger.info("Системный промпт не загружен, используется пустая строка")
+    ia_prompt = _read_prompt_file(IA_PROMPT_FILE, "дополнительный промпт 'Стиль И.А.'")
+    return PromptSnapshot(system_prompt, ia_prompt, source, signature, version)
 
 
-def get_additional_ia_prompt() -> str:
+def get_prompt_snapshot() -> PromptSnapshot:
+    """Текущий снимок промптов (при первом обращении загружается)"""
+    snapshot = _snapshot
+    if snapshot is None:
+        reload_prompts()
+        snapshot = _snapshot
+    return snapshot
+
+
+def reload_prompts(force: bool = False) -> bool:
     """
-    Загружает дополнительный промпт "Стиль И.А." из файла.
-    
-    Приоритет:
-    1. Файл app/config/style_ia_prompt.txt
-    2. Пустая строка (fallback)
-    
+    Перечитывает промпты, если файлы изменились (или force=True), и атомарно подменяет снимок.
+
     Returns:
-        str: Дополнительный промпт или пустая строка
+        bool: True, если снимок обновлен
     """
-    global _cached_additional_prompt
-    
-    # Если промпт уже закэширован, возвращаем его
-    if _cached_additional_prompt is not None:
-        return _cached_additional_prompt
-    
-    # Определяем путь к файлу дополнительного промпта
-    current_file = Path(__file__)
-    prompt_file = current_file.parent / 'style_ia_prompt.txt'
-    
-    try:
-        # Читаем промпт из файла
-        if prompt_file.exists() and prompt_file.is_file():
-            with open(prompt_file, 'r', encoding='utf-8') as f:
-                prompt_content = f.read().strip()
-                
-            if prompt_content:
-                logger.info(f"Загружен дополнительный промпт 'Стиль И.А.' из файла: {prompt_file}")
-                _cached_additional_prompt = prompt_content
-                return _cached_additional_prompt
-            else:
-                logger.info(f"Файл дополнительного промпта пуст: {prompt_file}")
-        else:
-            logger.info(f"Файл дополнительного промпта не найден: {prompt_file}")
-    
-    except Exception as e:
-        logger.error(f"Ошибка при чтении файла дополнительного промпта: {e}")
-    
-    # Fallback: возвращаем пустую строку
-    _cached_additional_prompt = ""
-    return _cached_additional_prompt
+    global _snapshot
+    signature = _file_signature()
+    with _lock:
+        _stats['checks'] += 1
+        current = _snapshot
+        if current is not None and not force and current.signature == signature:
+            return False
+        # Сборка под блокировкой: параллельные запросы не собирают одинаковый снимок несколько раз
+        snapshot = _build_snapshot(signature, current.version + 1 if current is not None else 1)
+        _snapshot = snapshot
+        if current is not None:
+            _stats['reloads'] += 1
+    if current is not None:
+        logger.info(f"Системные промпты перезагружены (версия {snapshot.version})")
+    return True
 
 
-_VERBOSITY_INSTRUCTIONS = {
-    'low': (
-        'УРОВЕНЬ ДЕТАЛЬНОСТИ: краткий.\n'
-        'Максимальная лаконичность. Только суть, без вводных и развёрнутых обоснований.'
-    ),
-    'medium': (
-        'УРОВЕНЬ ДЕТАЛЬНОСТИ: средний.\n'
-        'Стандартный объём: контекст, основная часть, заключение.'
-    ),
-    'high': (
-        'УРОВЕНЬ ДЕТАЛЬНОСТИ: развёрнутый.\n'
-        'Полное раскрытие всех тезисов с подробными обоснованиями.'
-    ),
-}
+def _watch_loop() -> None:
+    while True:
+        time.sleep(PROMPT_RELOAD_INTERVAL)
+        try:
+            reload_prompts()
+        except Exception as e:
+            logger.warning(f"Не удалось перезагрузить системные промпты: {e}")
+
+
+def start_prompt_watcher() -> int:
+    """
+    Загружает промпты и запускает фоновую проверку изменений файлов (один раз на процесс).
+
+    Returns:
+        int: Количество различных вариантов промпта
+    """
+    global _watcher_started
+    snapshot = get_prompt_snapshot()
+    with _lock:
+        start = PROMPT_RELOAD_INTERVAL > 0 and not _watcher_started
+        _watcher_started = _watcher_started or start
+    if start:
+        threading.Thread(target=_watch_loop, name='prompt-watcher', daemon=True).start()
+    return len(snapshot.by_text)
+
+
+def get_prompt_variant(use_ia_style: bool = False, verbosity: str = None) -> PromptVariant:
+    """
+    Готовый вариант системного промпта с учетом настроек.
+
+    Args:
+        use_ia_style: Если True, после основного промпта идет дополнительный промпт "Стиль И.А."
+        verbosity: Уровень детальности ('low', 'medium', 'high' или None; неизвестный уровень игнорируется)
+    """
+    if verbosity not in _VERBOSITY_INSTRUCTIONS:
+        verbosity = None
+    return get_prompt_snapshot().variants[(bool(use_ia_style), verbosity)]
+
+
+def find_prompt_variant(text: str):
+    """Вариант промпта с таким текстом или None (для кэшей, которым нужны токены или хэш промпта)"""
+    snapshot = _snapshot
+    if snapshot is None or not isinstance(text, str):
+        return None
+    return snapshot.by_text.get(text)
+
+
+def get_system_prompt() -> str:
+    """
+    Основной системный промпт (SYSTEM_PROMPT или app/config/system_prompt.txt).
+
+    Returns:
+        str: Системный промпт или пустая строка
+    """
+    return get_prompt_snapshot().system_prompt
+
+
+def get_additional_ia_prompt() -> str:
+    """
+    Дополнительный промпт "Стиль И.А." из app/config/style_ia_prompt.txt.
+
+    Returns:
+        str: Дополнительный промпт или пустая строка
+    """
+    return get_prompt_snapshot().ia_prompt
 
 
 def get_combined_system_prompt(use_ia_style: bool = False, verbosity: str = None) -> str:
     """
     Возвращает объединенный системный промпт с учетом настроек.
-    
+
     Args:
         use_ia_style: Если True, добавляет дополнительный промпт после основного
         verbosity: Уровень детальности ('low', 'medium', 'high' или None)
-    
+
     Returns:
         str: Объединенный системный промпт
     """
-    parts = [get_system_prompt()]
-    
-    if use_ia_style:
-        additional_prompt = get_additional_ia_prompt()
-        if additional_prompt:
-            parts.append(additional_prompt)
-    
-    if verbosity and verbosity in _VERBOSITY_INSTRUCTIONS:
-        parts.append(_VERBOSITY_INSTRUCTIONS[verbosity])
-    
-    return '\n\n'.join(p for p in parts if p)
+    return get_prompt_variant(use_ia_style, verbosity).text
 
 
 def clear_cache():
     """
-    Очищает кэш промптов. Полезно для тестирования или при изменении промпта во время выполнения.
+    Перечитывает промпты сразу, не дожидаясь проверки файлов (например, после смены SYSTEM_PROMPT в тестах).
     """
-    global _cached_prompt, _cached_additional_prompt
-    _cached_prompt = None
-    _cached_additional_prompt = None
+    reload_prompts(force=True)
     logger.info("Кэш системных промптов очищен")
 
+
+def get_prompt_stats() -> dict:
+    """
+    Статистика реестра промптов текущего воркера.
+
+    Returns:
+        dict: {'version': int, 'source': 'env'|'file'|'empty', 'variants': int, 'loaded_at': float,
+               'reloads': int, 'checks': int, 'errors': int, 'reload_interval': float, 'prompts': {...}}
+    """
+    snapshot = get_prompt_snapshot()
+    with _lock:
+        stats = dict(_stats)
+    stats.update({
+        'version': snapshot.version,
+        'source': snapshot.source,
+        'variants': len(snapshot.by_text),
+        'loaded_at': snapshot.loaded_at,
+        'reload_interval': PROMPT_RELOAD_INTERVAL,
+        'prompts': {
+            f"{'ia' if use_ia_style else 'base'}:{verbosity or 'default'}": {
+                'tokens': variant.tokens,
+                'hash': variant.hash,
+            }
+            for (use_ia_style, verbosity), variant in snapshot.variants.items()
+        },
+    })
+    return stats
@@ -14,11 +14,17 @@ _project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if _project_root not in sys.path:
     sys.path.insert(0, _project_root)
 
-from flask import Flask, send_from_directory, request, jsonify
+from flask import Flask, request, jsonify
 from flask_cors import CORS
 from dotenv import load_dotenv
 from app.api.routes import api_bp
 from app.api.cost_calculator import warm_pricing_cache
+from app.api.metrics import start_metrics_flusher, clear_metrics_dir
+from app.api.tracing import start_log_listener
+from app.api.pricing_registry import load_snapshot
+from app.api.upstream import close_upstream_session
+from app.config.prompt_loader import get_prompt_snapshot, start_prompt_watcher
+from app.static_assets import init_static_assets, serve_static
 
 # Загружаем переменные окружения из .env файла (для локальной разработки)
 env_path = os.path.join(_project_root, '.env')
@@ -37,9 +43,15 @@ app = Flask(__name__,
             static_folder=os.path.join(basedir, 'static'),
             template_folder=os.path.join(basedir, 'templates'))
 
+# Кириллица в JSON ответах - UTF-8, а не \uXXXX: ответ /api/chat в 2.5 раза меньше еще до сжатия
+app.json.ensure_ascii = False
+
 # Настройка CORS
 CORS(app)
 
+# Файлы фронтенда загружаются в память один раз (под gunicorn с preload - в мастере, до fork)
+init_static_assets(app.static_folder, os.path.join(app.template_folder, 'index.html'))
+
 # Отключаем кэширование статики в debug режиме
 if app.debug:
     app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
@@ -56,58 +68,58 @@ if app.debug:
 # Регистрация API blueprint
 app.register_blueprint(api_bp, url_prefix='/api')
 
-def _start_pricing_cache_warmup():
+def start_background_tasks():
+    """Фоновые задачи процесса: загрузка и обновление тарифов, проверка изменений файлов промптов, запись метрик и логов"""
     def _run():
         try:
             warm_pricing_cache()
         except Exception as exc:
             logging.getLogger(__name__).warning("Pricing cache warmup failed: %s", exc)
+        try:
+            start_prompt_watcher()
+        except Exception as exc:
+            logging.getLogger(__name__).warning("Prompt registry warmup failed: %s", exc)
+    start_metrics_flusher()
+    start_log_listener()
     threading.Thread(target=_run, name="pricing-cache-warmup", daemon=True).start()
 
-_start_pricing_cache_warmup()
 
+def preload_shared_state():
+    """
+    Загружает снимок тарифов и системные промпты в мастер-процессе gunicorn (preload_app):
+    воркеры получают их после fork без повторной загрузки. Потоки здесь не запускаются.
+    """
+    try:
+        load_snapshot()
+    except Exception as exc:
+        logging.getLogger(__name__).warning("Pricing snapshot preload failed: %s", exc)
+    get_prompt_snapshot()
+    # Соединения мастера не должны достаться воркерам
+    close_upstream_session()
 
 
-def _add_no_cache_headers(response, path=''):
-    """Добавляет заголовки no-cache для index.html и entry-point assets (JS/CSS)"""
-    if not path or path == 'index.html' or path.endswith('.html'):
-        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate, max-age=0'
-        response.headers['Pragma'] = 'no-cache'
-        response.headers['Expires'] = '0'
-    elif path.startswith('assets/') and (path.endswith('.js') or path.endswith('.css')):
-        response.headers['Cache-Control'] = 'no-cache, must-revalidate, max-age=0'
-    return response
+# Под gunicorn (gunicorn.conf.py) задачи запускаются в каждом воркере после fork
+if os.environ.get('APP_BACKGROUND_TASKS', '1') == '1':
+    start_background_tasks()
+
 
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def serve_spa(path):
-    """Отдает index.html для всех путей кроме /api/* (SPA роутинг)"""
+    """Отдает файлы фронтенда из памяти и index.html для всех путей кроме /api/* (SPA роутинг)"""
     if path.startswith('api/'):
         return jsonify({'error': 'Not found'}), 404
     
-    # Отдаем статические файлы если они существуют
-    if path:
-        static_path = os.path.join(app.static_folder, path)
-        if os.path.exists(static_path) and os.path.isfile(static_path):
-            try:
-                response = send_from_directory(app.static_folder, path)
-                return _add_no_cache_headers(response, path)
-            except Exception:
-                pass
-    
-    # Проверяем есть ли собранный index.html в static
-    static_index = os.path.join(app.static_folder, 'index.html')
-    if os.path.exists(static_index):
-        response = send_from_directory(app.static_folder, 'index.html')
-        return _add_no_cache_headers(response, 'index.html')
-    
-    # Иначе отдаем шаблон index.html для SPA
-    response = send_from_directory(app.template_folder, 'index.html')
-    return _add_no_cache_headers(response, 'index.html')
+    response = serve_static(path)
+    if response is None:
+        return jsonify({'error': 'Not found'}), 404
+    return response
 
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
+    # Метрики прошлых запусков не должны попасть в итоги (под gunicorn это делает on_starting)
+    clear_metrics_dir()
     app.run(host='0.0.0.0', port=port, debug=True)
 
@@ -0,0 +1,322 @@
+"""
+Раздача собранного фронтенда (app/static) из памяти.
+
+- Манифест app/static строится один раз при старте (в мастере gunicorn при preload): содержимое файлов,
+  тип, ETag и сжатые варианты лежат в памяти, запрос не обращается к диску
+- Файлы Vite с хэшем содержимого в имени (assets/index-BKOqZPSY.js) отдаются с
+  `Cache-Control: public, max-age=31536000, immutable`: браузер не перепроверяет их при каждой загрузке.
+  index.html и остальные файлы - `no-cache` с ETag (проверка занимает один 304 ответ)
+- Сжатые варианты: .br/.gz рядом с файлом (создает build_frontend.sh); если .gz нет, он создается
+  при построении манифеста. Вариант выбирается по Accept-Encoding (br, затем gzip)
+- Пути, которых нет в манифесте (маршруты SPA), получают index.html из памяти. Если index.html на диске
+  изменился (фронтенд пересобран без перезапуска), манифест перестраивается
+"""
+import os
+import re
+import gzip
+import time
+import hashlib
+import logging
+import mimetypes
+import threading
+
+from flask import Response, request, send_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Сжимать файлы больше порога (байт), если рядом нет готового .gz/.br
+STATIC_COMPRESS_MIN_SIZE = int(os.environ.get('STATIC_COMPRESS_MIN_SIZE', '1024'))
+
+# Не держать в памяти файлы больше порога (байт): они отдаются с диска
+STATIC_MEMORY_MAX_FILE = int(os.environ.get('STATIC_MEMORY_MAX_FILE', str(8 * 1024 * 1024)))
+
+# Как часто (не чаще, секунды) проверять, не пересобран ли фронтенд, при запросе отсутствующего файла
+STATIC_RECHECK_INTERVAL = float(os.environ.get('STATIC_RECHECK_INTERVAL', '2'))
+
+# Кэширование файлов без хэша в имени (секунды, 0 - всегда проверять ETag)
+STATIC_MAX_AGE = int(os.environ.get('STATIC_MAX_AGE', '0'))
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Имя файла Vite с хэшем содержимого: index-BKOqZPSY.js, vendor-a1B2c3D4.css
+_HASHED_NAME = re.compile(r'-[A-Za-z0-9_-]{8,}\.[A-Za-z0-9]+$')
+
+_COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+# Расширение файла -> Content-Encoding (в порядке предпочтения)
+_ENCODINGS = (('.br', 'br'), ('.gz', 'gzip'))
+
+
+class StaticAsset:
+    """Файл фронтенда в памяти: содержимое, ETag и сжатые варианты"""
+
+    __slots__ = ('path', 'file_path', 'content_type', 'body', 'etag', 'encoded', 'cache_control', 'size')
+
+    def __init__(self, path: str, file_path: str, body: bytes, content_type: str, cache_control: str):
+        self.path = path
+        self.file_path = file_path
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.size = os.path.getsize(file_path) if body is None else len(body)
+        # None - файл слишком большой, отдается с диска
+        self.body = body
+        digest = hashlib.blake2b(body, digest_size=8).hexdigest() if body is not None else (
+            f'{int(os.path.getmtime(file_path))}-{self.size}'
+        )
+        self.etag = digest
+        # Content-Encoding -> сжатое содержимое
+        self.encoded = {}
+
+
+class StaticManifest:
+    """Неизменяемый манифест app/static: после построения только читается"""
+
+    __slots__ = ('assets', 'index', 'index_signature', 'built_at', 'total_bytes')
+
+    def __init__(self, assets: dict, index: StaticAsset, index_signature: tuple):
+        self.assets = assets
+        self.index = index
+        self.index_signature = index_signature
+        self.built_at = time.time()
+        self.total_bytes = sum(
+            (asset.size if asset.body is not None else 0) + sum(len(body) for body in asset.encoded.values())
+            for asset in assets.values()
+        )
+
+
+_static_folder = None
+_fallback_index = None
+_manifest = None
+_last_check = 0.0
+_lock = threading.Lock()
+
+_stats = {
+    'requests': 0,
+    'not_modified': 0,
+    'br': 0,
+    'gzip': 0,
+    'identity': 0,
+    'spa_fallback': 0,
+    'rebuilds': 0,
+}
+
+
+def _cache_control(path: str) -> str:
+    if path.startswith('assets/') and _HASHED_NAME.search(path):
+        return IMMUTABLE_CACHE_CONTROL
+    if STATIC_MAX_AGE > 0 and not path.endswith('.html'):
+        return f'public, max-age={STATIC_MAX_AGE}'
+    return 'no-cache'
+
+
+def _content_type(path: str) -> str:
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if content_type.startswith('text/') or content_type == 'application/javascript':
+        content_type += '; charset=utf-8'
+    return content_type
+
+
+def _read_file(file_path: str) -> bytes:
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+
+def _load_asset(path: str, file_path: str) -> StaticAsset:
+    size = os.path.getsize(file_path)
+    body = _read_file(file_path) if size <= STATIC_MEMORY_MAX_FILE else None
+    asset = StaticAsset(path, file_path, body, _content_type(path), _cache_control(path))
+    if body is None:
+        return asset
+
+    # Готовые варианты от build_frontend.sh
+    for suffix, encoding in _ENCODINGS:
+        if os.path.isfile(file_path + suffix):
+            asset.encoded[encoding] = _read_file(file_path + suffix)
+
+    # Сжимаем сами, если сборка их не создала
+    if len(body) >= STATIC_COMPRESS_MIN_SIZE and asset.content_type.startswith(_COMPRESSIBLE_TYPES):
+        if 'gzip' not in asset.encoded:
+            asset.encoded['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+        if 'br' not in asset.encoded and brotli is not None:
+            asset.encoded['br'] = brotli.compress(body)
+    # Вариант, который не меньше оригинала, не нужен
+    asset.encoded = {encoding: data for encoding, data in asset.encoded.items() if len(data) < len(body)}
+    return asset
+
+
+def _index_signature() -> tuple:
+    try:
+        stat = os.stat(os.path.join(_static_folder, 'index.html'))
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+
+
+def build_manifest() -> StaticManifest:
+    """Строит манифест app/static заново и подменяет текущий"""
+    global _manifest, _last_check
+    started = time.perf_counter()
+    assets = {}
+    for root, _, files in os.walk(_static_folder):
+        for name in files:
+            if name.endswith(('.br', '.gz')) and os.path.isfile(os.path.join(root, name[:-3])):
+                continue
+            file_path = os.path.join(root, name)
+            path = os.path.relpath(file_path, _static_folder).replace(os.sep, '/')
+            try:
+                assets[path] = _load_asset(path, file_path)
+            except OSError as e:
+                logger.warning(f"Не удалось загрузить статический файл {file_path}: {e}")
+
+    index = assets.get('index.html')
+    if index is None and _fallback_index and os.path.isfile(_fallback_index):
+        # Фронтенд не собран - отдаем шаблон index.html
+        index = _load_asset('index.html', _fallback_index)
+
+    manifest = StaticManifest(assets, index, _index_signature())
+    with _lock:
+        if _manifest is not None:
+            _stats['rebuilds'] += 1
+        _manifest = manifest
+        _last_check = time.monotonic()
+    logger.info(
+        f"Манифест статики: {len(assets)} файлов, {manifest.total_bytes / 1024:.0f} КБ в памяти, "
+        f"{(time.perf_counter() - started) * 1000:.0f} мс"
+    )
+    return manifest
+
+
+def init_static_assets(static_folder: str, fallback_index: str = None) -> StaticManifest:
+    """Задает каталог статики (и шаблон index.html, если фронтенд не собран) и строит манифест"""
+    global _static_folder, _fallback_index
+    _static_folder = static_folder
+    _fallback_index = fallback_index
+    return build_manifest()
+
+
+def _reload_if_rebuilt(manifest: StaticManifest) -> StaticManifest:
+    """При промахе (не чаще раза в STATIC_RECHECK_INTERVAL) проверяет, не пересобран ли фронтенд"""
+    global _last_check
+    now = time.monotonic()
+    with _lock:
+        check = now - _last_check >= STATIC_RECHECK_INTERVAL
+        if check:
+            _last_check = now
+    if check and _index_signature() != manifest.index_signature:
+        logger.info("index.html изменился - манифест статики перестраивается")
+        return build_manifest()
+    return manifest
+
+
+def accepted_encodings(header: str) -> set:
+    """Кодировки из заголовка Accept-Encoding (кроме явно запрещенных q=0)"""
+    accepted = set()
+    for part in header.split(','):
+        name, _, params = part.strip().partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q=') and params[2:] in ('0', '0.0', '0.00', '0.000'):
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+def _not_modified(asset: StaticAsset) -> bool:
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        # ETag варианта - "<хэш>-br" / "<хэш>-gzip"
+        if tag.strip('"').split('-', 1)[0] == asset.etag:
+            return True
+    return False
+
+
+def _asset_response(asset: StaticAsset) -> Response:
+    if asset.body is None:
+        response = send_file(asset.file_path, mimetype=asset.content_type, conditional=True, etag=asset.etag)
+        response.headers['Cache-Control'] = asset.cache_control
+        return response
+
+    headers = {'Cache-Control': asset.cache_control}
+    if asset.encoded:
+        headers['Vary'] = 'Accept-Encoding'
+
+    if _not_modified(asset):
+        with _lock:
+            _stats['not_modified'] += 1
+        response = Response(status=304, headers=headers)
+        response.set_etag(asset.etag)
+        return response
+
+    body, encoding = asset.body, None
+    if asset.encoded:
+        accepted = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+        for candidate in ('br', 'gzip'):
+            if candidate in accepted and candidate in asset.encoded:
+                body, encoding = asset.encoded[candidate], candidate
+                break
+
+    with _lock:
+        _stats[encoding or 'identity'] += 1
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    response = Response(body, headers=headers, content_type=asset.content_type)
+    response.set_etag(f'{asset.etag}-{encoding}' if encoding else asset.etag)
+    return response
+
+
+def serve_static(path: str):
+    """
+    Ответ на GET /<path> фронтенда: файл из манифеста или index.html (маршрутизация SPA).
+
+    Returns:
+        Response или None, если нет ни файла, ни index.html
+    """
+    with _lock:
+        _stats['requests'] += 1
+    manifest = _manifest or build_manifest()
+    asset = manifest.assets.get(path) if path else None
+    if asset is None:
+        manifest = _reload_if_rebuilt(manifest)
+        asset = manifest.assets.get(path) if path else None
+    if asset is None:
+        asset = manifest.index
+        if asset is None:
+            return None
+        with _lock:
+            _stats['spa_fallback'] += 1
+    return _asset_response(asset)
+
+
+def get_static_stats() -> dict:
+    """
+    Статистика раздачи статики текущего воркера.
+
+    Returns:
+        dict: {'files': int, 'memory_bytes': int, 'compressed_files': int, 'immutable_files': int,
+               'built_at': float, 'requests': int, 'not_modified': int, 'br': int, 'gzip': int,
+               'identity': int, 'spa_fallback': int, 'rebuilds': int, 'brotli_available': bool}
+    """
+    manifest = _manifest
+    with _lock:
+        stats = dict(_stats)
+    assets = manifest.assets.values() if manifest is not None else ()
+    stats.update({
+        'files': len(manifest.assets) if manifest is not None else 0,
+        'memory_bytes': manifest.total_bytes if manifest is not None else 0,
+        'compressed_files': sum(1 for asset in assets if asset.encoded),
+        'immutable_files': sum(1 for asset in assets if asset.cache_control == IMMUTABLE_CACHE_CONTROL),
+        'built_at': manifest.built_at if manifest is not None else None,
+        'brotli_available': brotli is not None,
+    })
+    return stats
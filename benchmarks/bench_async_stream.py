@@ -0,0 +1,142 @@
+"""
+Нагрузочный бенчмарк /api/chat/stream: сколько одновременных SSE потоков держит один воркер
+и сколько памяти уходит на поток.
+
+Поднимает локальный fake OpenRouter и приложение с одним воркером:
+- asgi: gunicorn app.asgi:app -k uvicorn.workers.UvicornWorker (асинхронный путь)
+- wsgi: gunicorn app.main:app --worker-class sync (старый путь, для сравнения)
+
+Запуск:
+    python benchmarks/bench_async_stream.py --server asgi --streams 300
+    python benchmarks/bench_async_stream.py --server wsgi --streams 20 --timeout 30
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_utils import (  # noqa: E402
+    free_port, start_fake_openrouter, app_env, start_app, stop_process,
+    process_tree_rss_kb, percentile
+)
+
+
+class StreamStats:
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+        self.completed = 0
+        self.failed = 0
+        self.ttft = []
+        self.durations = []
+        self.token_events = 0
+
+
+async def run_stream(client: httpx.AsyncClient, url: str, stats: StreamStats, timeout: float):
+    payload = {'message': 'Привет! Расскажи что-нибудь.', 'model': 'fake/model', 'use_system_prompt': False}
+    started = time.perf_counter()
+    opened = False
+    try:
+        async with asyncio.timeout(timeout):
+            async with client.stream('POST', url, json=payload) as response:
+                if response.status_code != 200:
+                    stats.failed += 1
+                    return
+                async for line in response.aiter_lines():
+                    if not line.startswith('data: '):
+                        continue
+                    event = json.loads(line[6:])
+                    if 'error' in event:
+                        stats.failed += 1
+                        return
+                    if not opened:
+                        opened = True
+                        stats.ttft.append(time.perf_counter() - started)
+                        stats.active += 1
+                        stats.max_active = max(stats.max_active, stats.active)
+                    if event.get('done'):
+                        stats.completed += 1
+                        stats.durations.append(time.perf_counter() - started)
+                        return
+                    stats.token_events += 1
+        stats.failed += 1
+    except (httpx.HTTPError, TimeoutError):
+        stats.failed += 1
+    finally:
+        if opened:
+            stats.active -= 1
+
+
+async def sample_rss(pid: int, samples: list, stop: asyncio.Event):
+    while not stop.is_set():
+        samples.append(process_tree_rss_kb(pid))
+        await asyncio.sleep(0.1)
+
+
+async def run_load(app_port: int, app_pid: int, streams: int, timeout: float) -> tuple:
+    url = f'http://127.0.0.1:{app_port}/api/chat/stream'
+    stats = StreamStats()
+    rss_samples = []
+    stop = asyncio.Event()
+    limits = httpx.Limits(max_connections=streams, max_keepalive_connections=streams)
+    async with httpx.AsyncClient(limits=limits, timeout=None) as client:
+        sampler = asyncio.create_task(sample_rss(app_pid, rss_samples, stop))
+        started = time.perf_counter()
+        await asyncio.gather(*(run_stream(client, url, stats, timeout) for _ in range(streams)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await sampler
+    return stats, rss_samples, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк одновременных SSE потоков на один воркер')
+    parser.add_argument('--server', choices=['asgi', 'wsgi'], default='asgi')
+    parser.add_argument('--streams', type=int, default=300, help='Количество одновременных потоков')
+    parser.add_argument('--tokens', type=int, default=200, help='Токенов в каждом ответе')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='Пауза между токенами upstream (сек)')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Таймаут одного потока (сек)')
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    app_port = free_port()
+    upstream = start_fake_openrouter(upstream_port, args.tokens, args.token_delay)
+    app_proc = None
+    try:
+        if args.server == 'asgi':
+            cmd = ['gunicorn', 'app.asgi:app', '--bind', f'127.0.0.1:{app_port}', '-w', '1',
+                   '-k', 'uvicorn.workers.UvicornWorker', '--timeout', '300']
+        else:
+            cmd = ['gunicorn', 'app.main:app', '--bind', f'127.0.0.1:{app_port}', '-w', '1',
+                   '--worker-class', 'sync', '--timeout', '300']
+        app_proc = start_app(cmd, app_port, app_env(upstream_port))
+        time.sleep(1.0)
+        baseline_kb = process_tree_rss_kb(app_proc.pid)
+
+        stats, rss_samples, elapsed = asyncio.run(run_load(app_port, app_proc.pid, args.streams, args.timeout))
+        peak_kb = max(rss_samples) if rss_samples else baseline_kb
+        per_stream_kb = (peak_kb - baseline_kb) / stats.max_active if stats.max_active else 0.0
+
+        print()
+        print("=" * 60)
+        print(f"Сервер: {args.server} (1 воркер)")
+        print(f"Потоков запущено: {args.streams}, завершено: {stats.completed}, ошибок/таймаутов: {stats.failed}")
+        print(f"Макс. одновременно открытых потоков на воркер: {stats.max_active}")
+        print(f"Время прогона: {elapsed:.2f} сек, token событий доставлено: {stats.token_events} ({stats.token_events / elapsed:.0f} соб/сек)")
+        print(f"TTFT p50/p95/p99: {percentile(stats.ttft, 50) * 1000:.0f} / "
+              f"{percentile(stats.ttft, 95) * 1000:.0f} / {percentile(stats.ttft, 99) * 1000:.0f} мс")
+        print(f"RSS: базовый {baseline_kb / 1024:.1f} МБ, пик {peak_kb / 1024:.1f} МБ")
+        print(f"Память на поток: {per_stream_kb:.1f} КБ")
+        print("=" * 60)
+    finally:
+        stop_process(app_proc)
+        stop_process(upstream)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+Бенчмарк сжатия ответов API на типичных русскоязычных ответах: байты на проводе и CPU.
+
+Ответы собираются из предложений app/config/system_prompt.txt (деловой русский текст с markdown).
+Сравнивает:
+- JSON ответа /api/chat: \\uXXXX экранирование (прежний jsonify) и UTF-8, gzip разных уровней и brotli
+  (если установлен пакет brotli), время сжатия одного ответа
+- SSE поток: события с токенами без сжатия, StreamCompressor (выталкивание после каждого события)
+  и сжатие всего потока целиком (нижняя граница), время на событие
+
+Запуск:
+    python benchmarks/bench_compression.py
+    python benchmarks/bench_compression.py --sizes 2000,8000,32000 --tokens-per-event 1,4,16
+"""
+import argparse
+import gzip
+import json
+import os
+import re
+import sys
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+from app.api.compression import StreamCompressor, brotli  # noqa: E402
+from app.api.streaming import token_event, sse_event  # noqa: E402
+
+_FALLBACK_TEXT = (
+    'Уважаемый Иван Петрович! Направляю Вам на согласование проект регламента эксплуатации системы '
+    'контроля и управления доступом. Прошу рассмотреть документ до конца недели и сообщить о замечаниях. '
+    '**Основные изменения:** уточнен порядок выдачи пропусков, добавлены требования к журналу событий. '
+)
+
+
+def load_sentences() -> list:
+    path = os.path.join(PROJECT_ROOT, 'app', 'config', 'system_prompt.txt')
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    except OSError:
+        text = _FALLBACK_TEXT
+    sentences = [s.strip() for s in re.split(r'(?<=[.!?:])\s+', text) if len(s.strip()) > 20]
+    return sentences or [_FALLBACK_TEXT]
+
+
+def build_answer(sentences: list, size: int) -> str:
+    """Ответ длиной около size символов: абзацы и списки, как в ответах модели"""
+    parts = []
+    length = 0
+    i = 0
+    while length < size:
+        sentence = sentences[i % len(sentences)]
+        prefix = '- ' if i % 5 == 3 else ''
+        suffix = '\n\n' if i % 4 == 3 else ' '
+        parts.append(prefix + sentence + suffix)
+        length += len(sentence) + len(prefix) + len(suffix)
+        i += 1
+    return ''.join(parts)[:size]
+
+
+def tokenize(text: str) -> list:
+    """Токены размером с токены модели (слово с пробелом или знак препинания)"""
+    return re.findall(r'\s*\S+', text)
+
+
+def timed(func, repeat: int) -> tuple:
+    """(результат, CPU мкс на вызов)"""
+    started = time.process_time()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.process_time() - started) / repeat * 1e6
+
+
+def bench_json(answer: str, repeat: int) -> list:
+    rows = []
+    payload = {'content': answer, 'model': 'anthropic/claude-sonnet-4.5', 'finish_reason': 'stop',
+               'cost': {'total_cost_rub': 1.23, 'prompt_tokens': 3500, 'completion_tokens': 900, 'total_tokens': 4400}}
+    for label, ensure_ascii in (('escaped', True), ('utf-8', False)):
+        body = json.dumps(payload, ensure_ascii=ensure_ascii).encode('utf-8')
+        rows.append((label, 'identity', len(body), len(body), 0.0))
+        for level in (1, 6, 9):
+            data, cpu_us = timed(lambda: gzip.compress(body, compresslevel=level, mtime=0), repeat)
+            rows.append((label, f'gzip-{level}', len(body), len(data), cpu_us))
+        if brotli is not None:
+            for quality in (4, 5, 11):
+                data, cpu_us = timed(lambda: brotli.compress(body, quality=quality), max(1, repeat // (10 if quality == 11 else 1)))
+                rows.append((label, f'br-{quality}', len(body), len(data), cpu_us))
+    return rows
+
+
+def build_events(answer: str, tokens_per_event: int) -> list:
+    tokens = tokenize(answer)
+    events = [token_event(''.join(tokens[i:i + tokens_per_event])) for i in range(0, len(tokens), tokens_per_event)]
+    events.append(sse_event({'token': '', 'done': True, 'model': 'anthropic/claude-sonnet-4.5', 'finish_reason': 'stop',
+                             'cost': {'total_cost_rub': 1.23, 'prompt_tokens': 3500, 'completion_tokens': 900}}))
+    return events
+
+
+def bench_sse(events: list, encoding: str, repeat: int) -> tuple:
+    def run():
+        compressor = StreamCompressor(encoding)
+        for event in events:
+            compressor.compress(event)
+        compressor.finish()
+        return compressor
+    compressor, cpu_us = timed(run, repeat)
+    return compressor.raw_bytes, compressor.wire_bytes, cpu_us / len(events)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сжатие ответов API: байты на проводе и CPU')
+    parser.add_argument('--sizes', default='1000,4000,16000,64000', help='Длины ответов (символов)')
+    parser.add_argument('--tokens-per-event', default='1,4,16', help='Токенов в одном SSE событии')
+    parser.add_argument('--repeat', type=int, default=50, help='Повторов для замера CPU')
+    args = parser.parse_args()
+
+    sentences = load_sentences()
+    sizes = [int(s) for s in args.sizes.split(',')]
+    encodings = ['gzip'] + (['br'] if brotli is not None else [])
+
+    print("=" * 78)
+    print("JSON ответ /api/chat (escaped - \\uXXXX как прежний jsonify, utf-8 - ensure_ascii=False)")
+    print(f"{'символов':>9} {'JSON':>8} {'сжатие':>9} {'байт':>9} {'провод':>9} {'доля':>7} {'CPU мкс':>9}")
+    for size in sizes:
+        answer = build_answer(sentences, size)
+        for label, method, raw, wire, cpu_us in bench_json(answer, args.repeat):
+            print(f"{size:>9} {label:>8} {method:>9} {raw:>9} {wire:>9} {wire / raw:>7.2f} {cpu_us:>9.0f}")
+
+    print()
+    print("SSE поток /api/chat/stream: StreamCompressor (выталкивание после каждого события)")
+    print(f"{'символов':>9} {'ток/соб':>7} {'событий':>8} {'сжатие':>7} {'байт':>9} {'провод':>9} "
+          f"{'доля':>7} {'целиком':>8} {'мкс/соб':>8}")
+    for size in sizes:
+        answer = build_answer(sentences, size)
+        for tokens_per_event in (int(t) for t in args.tokens_per_event.split(',')):
+            events = build_events(answer, tokens_per_event)
+            whole = len(gzip.compress(b''.join(events), compresslevel=6, mtime=0))
+            for encoding in encodings:
+                raw, wire, cpu_us = bench_sse(events, encoding, max(1, args.repeat // 5))
+                print(f"{size:>9} {tokens_per_event:>7} {len(events):>8} {encoding:>7} {raw:>9} {wire:>9} "
+                      f"{wire / raw:>7.2f} {whole / raw:>8.2f} {cpu_us:>8.1f}")
+    print("(доля - провод/байт; целиком - gzip всего потока одним куском, нижняя граница для сжатия по событиям)")
+    if brotli is None:
+        print("brotli не установлен (pip install brotli) - замерен только gzip")
+    print("=" * 78)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Бенчмарк профилей gunicorn.conf.py: сколько длинных SSE потоков держат воркеры и ждут ли
+в очереди короткие запросы (статика, /api/*), пока потоки открыты.
+
+Поднимает локальный fake OpenRouter и `gunicorn -c gunicorn.conf.py` с выбранным профилем,
+открывает --streams одновременных потоков и во время них замеряет задержку коротких запросов.
+С --drain после открытия потоков мастеру отправляется SIGTERM: все начатые потоки должны
+дойти до события done (graceful shutdown).
+
+Запуск:
+    python benchmarks/bench_server_profile.py --profile gthread --streams 50
+    python benchmarks/bench_server_profile.py --profile sync --streams 4 --timeout 60
+    python benchmarks/bench_server_profile.py --profile gthread --streams 20 --drain
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_utils import (  # noqa: E402
+    free_port, start_fake_openrouter, app_env, start_app, stop_process, process_tree_rss_kb, percentile
+)
+from bench_async_stream import StreamStats, run_stream  # noqa: E402
+
+# Короткие запросы, которые не должны ждать освобождения воркера
+PROBE_PATHS = ('/', '/api/system-prompt')
+
+
+async def probe_light_requests(client: httpx.AsyncClient, base_url: str, latencies: list, errors: list,
+                               stop: asyncio.Event, interval: float):
+    while not stop.is_set():
+        for path in PROBE_PATHS:
+            started = time.perf_counter()
+            try:
+                response = await client.get(base_url + path, timeout=30)
+                if response.status_code == 200:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors.append(response.status_code)
+            except httpx.HTTPError as e:
+                errors.append(type(e).__name__)
+        await asyncio.sleep(interval)
+
+
+async def run_load(app_port: int, app_proc, streams: int, timeout: float, drain: bool, interval: float):
+    base_url = f'http://127.0.0.1:{app_port}'
+    stats = StreamStats()
+    probe_latencies = []
+    probe_errors = []
+    rss_peak = 0
+    stop = asyncio.Event()
+    limits = httpx.Limits(max_connections=streams + 10, max_keepalive_connections=streams + 10)
+    async with httpx.AsyncClient(limits=limits, timeout=None) as client:
+        prober = asyncio.create_task(probe_light_requests(client, base_url, probe_latencies, probe_errors, stop, interval))
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(run_stream(client, base_url + '/api/chat/stream', stats, timeout))
+                 for _ in range(streams)]
+
+        drained = False
+        while not all(task.done() for task in tasks):
+            rss_peak = max(rss_peak, process_tree_rss_kb(app_proc.pid))
+            if drain and not drained and stats.active + stats.completed >= streams:
+                # Все потоки начаты - останавливаем сервер и смотрим, дойдут ли они до конца
+                app_proc.send_signal(signal.SIGTERM)
+                drained = True
+                stop.set()
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await prober
+    return stats, probe_latencies, probe_errors, rss_peak, elapsed, drained
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк профилей gunicorn для длинных SSE потоков')
+    parser.add_argument('--profile', choices=['gthread', 'gevent', 'asgi', 'sync'], default='gthread')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--streams', type=int, default=50, help='Количество одновременных потоков')
+    parser.add_argument('--tokens', type=int, default=200, help='Токенов в каждом ответе')
+    parser.add_argument('--token-delay', type=float, default=0.03, help='Пауза между токенами upstream (сек)')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Таймаут одного потока (сек)')
+    parser.add_argument('--probe-interval', type=float, default=0.1, help='Пауза между короткими запросами (сек)')
+    parser.add_argument('--drain', action='store_true', help='SIGTERM мастеру после открытия всех потоков')
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    app_port = free_port()
+    upstream = start_fake_openrouter(upstream_port, args.tokens, args.token_delay)
+    app_proc = None
+    try:
+        cmd = ['gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{app_port}']
+        env = app_env(upstream_port, GUNICORN_PROFILE=args.profile, GUNICORN_WORKERS=args.workers,
+                      PRICING_SNAPSHOT_PATH='', RESPONSE_CACHE_ENABLED='0', SINGLE_FLIGHT_ENABLED='0')
+        app_proc = start_app(cmd, app_port, env)
+        time.sleep(1.0)
+        baseline_kb = process_tree_rss_kb(app_proc.pid)
+
+        stats, probe_latencies, probe_errors, rss_peak, elapsed, drained = asyncio.run(
+            run_load(app_port, app_proc, args.streams, args.timeout, args.drain, args.probe_interval)
+        )
+
+        print()
+        print("=" * 60)
+        print(f"Профиль: {args.profile}, воркеров: {args.workers}")
+        print(f"Потоков запущено: {args.streams}, завершено: {stats.completed}, ошибок/таймаутов: {stats.failed}")
+        print(f"Макс. одновременно открытых потоков: {stats.max_active}")
+        print(f"Время прогона: {elapsed:.2f} сек")
+        print(f"TTFT p50/p95/p99: {percentile(stats.ttft, 50) * 1000:.0f} / "
+              f"{percentile(stats.ttft, 95) * 1000:.0f} / {percentile(stats.ttft, 99) * 1000:.0f} мс")
+        print(f"Короткие запросы во время потоков: {len(probe_latencies)} ок, {len(probe_errors)} ошибок, "
+              f"p50/p95/max {percentile(probe_latencies, 50) * 1000:.0f} / "
+              f"{percentile(probe_latencies, 95) * 1000:.0f} / {max(probe_latencies, default=0) * 1000:.0f} мс")
+        print(f"RSS: базовый {baseline_kb / 1024:.1f} МБ, пик {rss_peak / 1024:.1f} МБ")
+        if drained:
+            print(f"Graceful shutdown: после SIGTERM завершено {stats.completed} из {args.streams} потоков")
+        print("=" * 60)
+    finally:
+        stop_process(app_proc)
+        stop_process(upstream)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Микробенчмарк разбора SSE потока OpenRouter: токенов в секунду на ядро (process CPU time).
+
+Сравнивает:
+- legacy: прежний цикл chat_stream() - decode строки, json.loads чанка, _extract_delta_text,
+  json.dumps события на каждый токен, отдельная запись на каждый токен
+- parse: StreamRelay в режиме 'parse' (полный json.loads, но инкрементальный разбор байтов)
+- fast: StreamRelay в режиме 'fast' (zero-reparse релей JSON-литералов)
+
+Запуск:
+    python benchmarks/bench_sse_relay.py --tokens 200000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+from app.api.streaming import StreamRelay, extract_delta_text  # noqa: E402
+
+_WORDS = ['Привет', ',', ' это', ' "цитата"', ' ответ', ' модели', '\n', ' The', ' quick', ' fox', ' с\\n', ' 😀']
+
+
+def build_upstream_stream(tokens: int, network_chunk: int) -> list:
+    """Генерирует поток OpenRouter в виде списка сетевых порций байтов"""
+    lines = [b': OPENROUTER PROCESSING\n\n']
+    for i in range(tokens):
+        chunk = {
+            'id': 'gen-1', 'provider': 'Google', 'model': 'google/gemini-2.5-flash',
+            'object': 'chat.completion.chunk', 'created': 1760000000,
+            'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': _WORDS[i % len(_WORDS)]},
+                         'finish_reason': None, 'native_finish_reason': None, 'logprobs': None}]
+        }
+        lines.append(b'data: ' + json.dumps(chunk, ensure_ascii=False).encode('utf-8') + b'\n\n')
+    final = {
+        'id': 'gen-1', 'model': 'google/gemini-2.5-flash',
+        'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 100, 'completion_tokens': tokens, 'total_tokens': 100 + tokens}
+    }
+    lines.append(b'data: ' + json.dumps(final).encode('utf-8') + b'\n\n')
+    lines.append(b'data: [DONE]\n\n')
+    raw = b''.join(lines)
+    return [raw[i:i + network_chunk] for i in range(0, len(raw), network_chunk)]
+
+
+def iter_lines(chunks):
+    """Аналог requests.Response.iter_lines()"""
+    pending = b''
+    for chunk in chunks:
+        pending += chunk
+        lines = pending.splitlines()
+        pending = lines.pop() if lines and pending and not pending.endswith((b'\n', b'\r')) else b''
+        yield from lines
+    if pending:
+        yield pending
+
+
+def run_legacy(chunks) -> tuple:
+    """Прежний цикл из chat_stream(): одно событие (запись) на токен"""
+    writes = 0
+    tokens = []
+    for line in iter_lines(chunks):
+        if not line:
+            continue
+        line_str = line.decode('utf-8', errors='ignore')
+        if line_str.startswith(':') or not line_str.startswith('data: '):
+            continue
+        data_str = line_str[6:].strip()
+        if data_str == '[DONE]':
+            break
+        if not data_str:
+            continue
+        try:
+            chunk_data = json.loads(data_str)
+        except json.JSONDecodeError:
+            continue
+        if 'choices' in chunk_data and len(chunk_data['choices']) > 0:
+            token_content = extract_delta_text(chunk_data['choices'][0].get('delta', {}))
+            if token_content:
+                tokens.append(token_content)
+                event = f"data: {json.dumps({'token': token_content, 'done': False}, ensure_ascii=False)}\n\n"
+                event.encode('utf-8')
+                writes += 1
+    return tokens, writes
+
+
+def run_relay(chunks, mode: str) -> tuple:
+    relay = StreamRelay('google/gemini-2.5-flash', mode=mode)
+    writes = 0
+    for chunk in chunks:
+        events = relay.feed_bytes(chunk)
+        if events:
+            writes += 1
+        if relay.finished:
+            break
+    return relay, writes
+
+
+def measure(label: str, func, tokens: int, repeat: int):
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.process_time()
+        result = func()
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<8} {tokens / best:12,.0f} токенов/сек/ядро   записей: {result[1]:>8}   CPU: {best * 1000:8.1f} мс")
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Микробенчмарк разбора SSE потока')
+    parser.add_argument('--tokens', type=int, default=200000)
+    parser.add_argument('--network-chunk', type=int, default=4096, help='Размер сетевой порции байтов')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    chunks = build_upstream_stream(args.tokens, args.network_chunk)
+
+    print()
+    print("=" * 60)
+    legacy_time, legacy_result = measure('legacy', lambda: run_legacy(chunks), args.tokens, args.repeat)
+    parse_time, parse_result = measure('parse', lambda: run_relay(chunks, 'parse'), args.tokens, args.repeat)
+    fast_time, fast_result = measure('fast', lambda: run_relay(chunks, 'fast'), args.tokens, args.repeat)
+    print("-" * 60)
+    print(f"Ускорение fast vs legacy: {legacy_time / fast_time:.1f}x, parse vs legacy: {legacy_time / parse_time:.1f}x")
+    legacy_text = ''.join(legacy_result[0])
+    same = legacy_text == parse_result[0].accumulated_content == fast_result[0].accumulated_content
+    print(f"Текст ответа совпадает во всех режимах: {'да' if same else 'НЕТ'}")
+    print("=" * 60)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Микробенчмарк оценки токенов: прежний посимвольный подсчет кириллицы против
+estimate_token_count() из app.api.cost_calculator (подсчет по байтам UTF-8).
+
+Проверяет, что оценки совпадают, а если задан файл токенизатора (--vocab, tokenizer.json
+формата HuggingFace, нужен пакет tokenizers) - показывает погрешность эвристики относительно
+реального количества токенов.
+
+Запуск:
+    python benchmarks/bench_token_estimator.py --messages 2000
+    python benchmarks/bench_token_estimator.py --vocab /path/to/tokenizer.json
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+from app.api import cost_calculator  # noqa: E402
+from app.api.cost_calculator import CHARS_PER_TOKEN_RU, CHARS_PER_TOKEN_EN, heuristic_token_count  # noqa: E402
+
+_RU_WORDS = ['привет', 'модель', 'ответ', 'запрос', 'стоимость', 'история', 'сообщение', 'токен',
+             'пожалуйста', 'объясни', 'почему', 'как', 'это', 'работает', 'в', 'и', 'на']
+_EN_WORDS = ['hello', 'model', 'answer', 'request', 'cost', 'history', 'message', 'token',
+             'please', 'explain', 'why', 'how', 'this', 'works', 'in', 'and', 'on']
+
+
+def legacy_token_count(text: str) -> int:
+    """Прежняя реализация estimate_token_count() (цикл по символам)"""
+    if not text:
+        return 0
+    cyrillic_count = sum(1 for char in text if 'Ѐ' <= char <= 'ӿ')
+    total_chars = len(text)
+    if total_chars == 0:
+        return 0
+    if cyrillic_count / total_chars > 0.3:
+        chars_per_token = CHARS_PER_TOKEN_RU
+    else:
+        chars_per_token = CHARS_PER_TOKEN_EN
+    estimated_tokens = int(text.count(' ') + 1)
+    estimated_by_chars = int(total_chars / chars_per_token)
+    return max(estimated_tokens, estimated_by_chars)
+
+
+def build_history(messages: int, seed: int = 1) -> list:
+    """Сообщения разной длины: русские, английские и смешанные"""
+    rng = random.Random(seed)
+    texts = []
+    for i in range(messages):
+        kind = i % 3
+        words = rng.randint(5, 400)
+        if kind == 0:
+            pool = _RU_WORDS
+        elif kind == 1:
+            pool = _EN_WORDS
+        else:
+            pool = _RU_WORDS + _EN_WORDS + ['`code()`', '42', '\n']
+        texts.append(' '.join(rng.choice(pool) for _ in range(words)))
+    return texts
+
+
+def measure(label: str, func, texts: list, repeat: int) -> tuple:
+    best = None
+    counts = None
+    total_chars = sum(len(text) for text in texts)
+    for _ in range(repeat):
+        started = time.perf_counter()
+        counts = [func(text) for text in texts]
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<12} {total_chars / best / 1e6:8.1f} млн символов/сек   время: {best * 1000:8.2f} мс")
+    return best, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Микробенчмарк оценки токенов')
+    parser.add_argument('--messages', type=int, default=2000, help='Сообщений в истории')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--vocab', default='', help='tokenizer.json для сравнения с реальным токенизатором')
+    args = parser.parse_args()
+
+    texts = build_history(args.messages)
+    print()
+    print("=" * 60)
+    print(f"Сообщений: {len(texts)}, символов: {sum(len(text) for text in texts):,}")
+    legacy_time, legacy_counts = measure('legacy', legacy_token_count, texts, args.repeat)
+    fast_time, fast_counts = measure('heuristic', heuristic_token_count, texts, args.repeat)
+    print("-" * 60)
+    print(f"Ускорение: {legacy_time / fast_time:.1f}x")
+    print(f"Оценки совпадают с прежними: {'да' if legacy_counts == fast_counts else 'НЕТ'}")
+
+    if args.vocab:
+        cost_calculator.TOKENIZER_VOCAB_FILE = args.vocab
+        tokenizer = cost_calculator._load_tokenizer()
+        if tokenizer is None:
+            print("Токенизатор не загружен (нет пакета tokenizers или файла) - сравнение пропущено")
+        else:
+            _, real_counts = measure('tokenizer', cost_calculator.estimate_token_count, texts, 1)
+            errors = [abs(h - r) / r for h, r in zip(fast_counts, real_counts) if r]
+            under = sum(1 for h, r in zip(fast_counts, real_counts) if h < r)
+            print(f"Погрешность эвристики: средняя {sum(errors) / len(errors) * 100:.1f}%, "
+                  f"занижение в {under} из {len(real_counts)} сообщений")
+    print("=" * 60)
+
+
+if __name__ == '__main__':
+    main()
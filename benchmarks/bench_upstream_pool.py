@@ -0,0 +1,84 @@
+"""
+Бенчмарк time-to-first-token: новый requests.post на каждый запрос (TCP + TLS handshake каждый раз)
+против общего пула keep-alive соединений из app.api.upstream.
+
+Поднимает локальный fake OpenRouter по HTTPS с самоподписанным сертификатом.
+
+Запуск:
+    python benchmarks/bench_upstream_pool.py --requests 200
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_utils import PROJECT_ROOT, free_port, make_self_signed_cert, start_fake_openrouter, stop_process, percentile  # noqa: E402
+
+sys.path.insert(0, PROJECT_ROOT)
+from app.api.upstream import get_upstream_session, get_pool_stats  # noqa: E402
+
+PAYLOAD = {
+    'model': 'fake/model',
+    'messages': [{'role': 'user', 'content': 'Привет'}],
+    'stream': True
+}
+
+
+def measure_ttft(post, url: str, cert: str) -> float:
+    """Время от отправки запроса до первой data строки с токеном (сек)"""
+    started = time.perf_counter()
+    response = post(url, json=PAYLOAD, stream=True, timeout=30, verify=cert)
+    ttft = None
+    try:
+        for line in response.iter_lines():
+            if ttft is None and line.startswith(b'data: {'):
+                ttft = time.perf_counter() - started
+    finally:
+        response.close()
+    return ttft
+
+
+def run(label: str, post, url: str, cert: str, count: int) -> list:
+    # Прогрев (импорт, DNS, JIT кэшей ssl)
+    measure_ttft(post, url, cert)
+    samples = [measure_ttft(post, url, cert) for _ in range(count)]
+    print(f"{label:<32} p50 {percentile(samples, 50) * 1000:6.2f} мс   "
+          f"p95 {percentile(samples, 95) * 1000:6.2f} мс   среднее {sum(samples) / len(samples) * 1000:6.2f} мс")
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TTFT: новое соединение vs пул keep-alive')
+    parser.add_argument('--requests', type=int, default=200, help='Количество последовательных запросов')
+    parser.add_argument('--tokens', type=int, default=5, help='Токенов в ответе fake OpenRouter')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = make_self_signed_cert(tmp)
+        port = free_port()
+        upstream = start_fake_openrouter(port, args.tokens, 0.0, ['--tls-cert', cert, '--tls-key', key])
+        url = f'https://127.0.0.1:{port}/chat/completions'
+        try:
+            print()
+            print("=" * 60)
+            fresh = run('requests.post (новое соединение)', requests.post, url, cert, args.requests)
+            pooled = run('upstream session (keep-alive)', get_upstream_session().post, url, cert, args.requests)
+            print("-" * 60)
+            saved = percentile(fresh, 50) - percentile(pooled, 50)
+            print(f"Экономия TTFT (p50): {saved * 1000:.2f} мс на запрос "
+                  f"({percentile(fresh, 50) / max(percentile(pooled, 50), 1e-9):.1f}x)")
+            hosts = get_pool_stats()['sync']['hosts']
+            for host in hosts:
+                print(f"Пул {host['host']}: запросов {host['requests']} ({host['http_versions']})")
+            print("Примечание: на localhost RTT ~0, к openrouter.ai handshake добавляет ещё 2-3 RTT.")
+            print("=" * 60)
+        finally:
+            stop_process(upstream)
+
+
+if __name__ == '__main__':
+    main()
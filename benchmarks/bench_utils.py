@@ -0,0 +1,137 @@
+"""
+Общие утилиты для бенчмарков: запуск fake OpenRouter и приложения в подпроцессах, замер памяти.
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import requests
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    """Возвращает свободный TCP порт на localhost"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 20.0):
+    """Ждет, пока на localhost:port начнут принимать соединения"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Порт {port} не открылся за {timeout} сек")
+
+
+def start_fake_openrouter(port: int, tokens: int, token_delay: float, extra_args: list = None) -> subprocess.Popen:
+    """Запускает benchmarks/fake_openrouter.py в подпроцессе"""
+    cmd = [
+        sys.executable, os.path.join(PROJECT_ROOT, 'benchmarks', 'fake_openrouter.py'),
+        '--port', str(port), '--tokens', str(tokens), '--token-delay', str(token_delay)
+    ] + (extra_args or [])
+    proc = subprocess.Popen(cmd, cwd=PROJECT_ROOT)
+    wait_for_port(port)
+    return proc
+
+
+def make_self_signed_cert(directory: str) -> tuple:
+    """Создает самоподписанный сертификат для 127.0.0.1 через openssl. Возвращает (cert, key)"""
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert,
+        '-days', '1', '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1'
+    ], check=True, capture_output=True)
+    return cert, key
+
+
+def app_env(upstream_port: int, **overrides) -> dict:
+    """Окружение для приложения, направленного на fake OpenRouter"""
+    env = dict(os.environ)
+    env.update({
+        'OPENROUTER_BASE_URL': f'http://127.0.0.1:{upstream_port}',
+        'OPENROUTER_API_KEY': 'fake-key',
+        'PYTHONPATH': PROJECT_ROOT,
+    })
+    env.update({k: str(v) for k, v in overrides.items()})
+    return env
+
+
+def start_app(cmd: list, port: int, env: dict) -> subprocess.Popen:
+    """Запускает приложение (uvicorn/gunicorn) и ждет готовности /api/system-prompt"""
+    proc = subprocess.Popen(cmd, cwd=PROJECT_ROOT, env=env)
+    wait_for_port(port, timeout=30)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/api/system-prompt', timeout=2).status_code == 200:
+                return proc
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Приложение не ответило на /api/system-prompt")
+
+
+def stop_process(proc: subprocess.Popen):
+    if proc and proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def _children(pid: int) -> list:
+    result = []
+    task_dir = f'/proc/{pid}/task'
+    try:
+        for tid in os.listdir(task_dir):
+            with open(f'{task_dir}/{tid}/children') as f:
+                result.extend(int(c) for c in f.read().split())
+    except OSError:
+        pass
+    return result
+
+
+def process_tree_rss_kb(pid: int) -> int:
+    """Суммарный RSS процесса и всех его потомков в КБ (Linux /proc)"""
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        total += process_rss_kb(current)
+        stack.extend(_children(current))
+    return total
+
+
+def process_rss_kb(pid: int) -> int:
+    """RSS одного процесса в КБ (0, если процесс завершился)"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def worker_pids(master_pid: int) -> list:
+    """PID воркеров gunicorn (прямые потомки мастер-процесса)"""
+    return _children(master_pid)
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
@@ -0,0 +1,318 @@
+"""
+Локальный fake-сервер OpenRouter для бенчмарков (без сети и API ключа).
+
+Имитирует:
+- POST /chat/completions (stream и без stream) с настраиваемой скоростью токенов, задержкой,
+  зависаниями посреди потока, ошибками (HTTP статус или событие error посреди потока) и блоком usage
+  (prompt_tokens по размеру запроса, completion_tokens с учетом max_tokens, cached_tokens при cache_control)
+- сбои для проверки повторов, выключателя и хеджирования (resilience.py): обрыв соединения без ответа,
+  медленный первый токен у части запросов, модели, которые всегда отвечают ошибкой
+- GET /models (тарифы для расчета стоимости, с ETag: на If-None-Match отвечает 304)
+
+Запуск:
+    python benchmarks/fake_openrouter.py --port 8900 --tokens 200 --token-delay 0.01
+    python benchmarks/fake_openrouter.py --first-token-delay 0.5 --stall-every 50 --stall-duration 3 \
+        --error-rate 0.02 --stream-error-rate 0.01 --extra-models 300
+    python benchmarks/fake_openrouter.py --error-rate 0.3 --error-status 502 --drop-rate 0.1 \
+        --slow-rate 0.2 --slow-delay 5 --fail-models fake/broken
+
+HTTPS (для замеров TLS handshake):
+    python benchmarks/fake_openrouter.py --tls-cert cert.pem --tls-key key.pem
+
+Приложение направляется на fake-сервер переменной окружения:
+    OPENROUTER_BASE_URL=http://127.0.0.1:8900
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import ssl
+import time
+
+# Слова, из которых собирается ответ (смесь русского и английского)
+_WORDS = [
+    'Привет', ',', ' это', ' тестовый', ' ответ', ' модели', ' для', ' нагрузочного',
+    ' теста', '.', ' The', ' quick', ' brown', ' fox', ' jumps', ' over', ' the', ' lazy', ' dog', '.'
+]
+
+# Модели, которые отдает /models
+FAKE_MODELS = [
+    'fake/model',
+    'google/gemini-2.5-flash',
+    'anthropic/claude-sonnet-4.5',
+    'openai/gpt-4o-mini',
+    'deepseek/deepseek-chat',
+]
+
+
+class FakeConfig:
+    def __init__(self, tokens: int = 200, token_delay: float = 0.01, first_token_delay: float = 0.0,
+                 token_jitter: float = 0.0, stall_every: int = 0, stall_duration: float = 0.0,
+                 error_rate: float = 0.0, error_status: int = 500, stream_error_rate: float = 0.0,
+                 extra_models: int = 0, seed: int = None, drop_rate: float = 0.0, slow_rate: float = 0.0,
+                 slow_delay: float = 0.0, fail_models: tuple = ()):
+        self.tokens = tokens
+        self.token_delay = token_delay
+        self.first_token_delay = first_token_delay
+        # Разброс паузы между токенами: доля от token_delay (0.5 - от 0.5x до 1.5x)
+        self.token_jitter = token_jitter
+        # Зависание на stall_duration секунд после каждых stall_every токенов (0 - без зависаний)
+        self.stall_every = stall_every
+        self.stall_duration = stall_duration
+        # Доля запросов, на которые сразу отвечаем ошибкой error_status
+        self.error_rate = error_rate
+        self.error_status = error_status
+        # Доля потоков, которые обрываются событием error на середине
+        self.stream_error_rate = stream_error_rate
+        # Доля запросов, на которые соединение закрывается без ответа
+        self.drop_rate = drop_rate
+        # Доля запросов с дополнительной паузой slow_delay до первого токена
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        # Модели, которые всегда отвечают ошибкой error_status (для выключателя)
+        self.fail_models = frozenset(fail_models)
+        self.extra_models = extra_models
+        self.random = random.Random(seed)
+        self.models_body = _models_body(extra_models)
+
+    def token_pause(self) -> float:
+        if not self.token_jitter:
+            return self.token_delay
+        return self.token_delay * (1 + self.token_jitter * (2 * self.random.random() - 1))
+
+
+def _models_body(extra_models: int = 0) -> bytes:
+    data = []
+    for model_id in FAKE_MODELS + [f'fake/model-{i}' for i in range(extra_models)]:
+        data.append({
+            'id': model_id,
+            'canonical_slug': model_id,
+            'context_length': 128000,
+            'pricing': {
+                'prompt': '0.000001', 'completion': '0.000002', 'request': '0',
+                'input_cache_read': '0.0000001', 'input_cache_write': '0.00000125'
+            }
+        })
+    return json.dumps({'data': data}).encode('utf-8')
+
+
+def _chunk(model: str, delta: dict, finish_reason=None, usage=None) -> bytes:
+    chunk = {
+        'id': 'gen-fake',
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+    }
+    if usage:
+        chunk['usage'] = usage
+    return b'data: ' + json.dumps(chunk, ensure_ascii=False).encode('utf-8') + b'\n\n'
+
+
+def _completion_tokens(payload: dict, config: FakeConfig) -> int:
+    max_tokens = payload.get('max_tokens')
+    return min(config.tokens, max_tokens) if isinstance(max_tokens, int) and max_tokens > 0 else config.tokens
+
+
+def _usage(payload: dict, completion_tokens: int) -> dict:
+    """
+    usage ответа: prompt_tokens по размеру сообщений (~3 символа на токен);
+    если в запросе есть cache_control, 80% промпта считается прочитанным из кэша
+    """
+    chars = 0
+    cache_control = False
+    for message in payload.get('messages') or []:
+        content = message.get('content')
+        if isinstance(content, list):
+            chars += sum(len(part.get('text') or '') for part in content)
+            cache_control = cache_control or any('cache_control' in part for part in content)
+        elif isinstance(content, str):
+            chars += len(content)
+    prompt_tokens = max(chars // 3, 1)
+    usage = {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens
+    }
+    if cache_control:
+        usage['prompt_tokens_details'] = {'cached_tokens': prompt_tokens * 4 // 5}
+    return usage
+
+
+async def _write_chunked(writer, data: bytes):
+    writer.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+    await writer.drain()
+
+
+async def _stream_completion(writer, config: FakeConfig, model: str, payload: dict, delay: float):
+    writer.write(
+        b'HTTP/1.1 200 OK\r\n'
+        b'Content-Type: text/event-stream\r\n'
+        b'Transfer-Encoding: chunked\r\n'
+        b'\r\n'
+    )
+    await _write_chunked(writer, b': OPENROUTER PROCESSING\n\n')
+    if delay:
+        await asyncio.sleep(delay)
+
+    tokens = _completion_tokens(payload, config)
+    # Поток, который оборвется ошибкой (как OpenRouter при сбое провайдера посреди ответа)
+    fail_at = tokens // 2 if config.random.random() < config.stream_error_rate else None
+    for i in range(tokens):
+        if i == fail_at:
+            error = {'error': {'code': 502, 'message': 'Fake provider error mid-stream'},
+                     'choices': [{'index': 0, 'delta': {'content': ''}, 'finish_reason': 'error'}]}
+            await _write_chunked(writer, b'data: ' + json.dumps(error).encode('utf-8') + b'\n\n')
+            break
+        await _write_chunked(writer, _chunk(model, {'role': 'assistant', 'content': _WORDS[i % len(_WORDS)]}))
+        if config.stall_every and i and i % config.stall_every == 0:
+            await asyncio.sleep(config.stall_duration)
+        elif config.token_delay:
+            await asyncio.sleep(config.token_pause())
+    else:
+        await _write_chunked(writer, _chunk(model, {}, finish_reason='stop', usage=_usage(payload, tokens)))
+    await _write_chunked(writer, b'data: [DONE]\n\n')
+    writer.write(b'0\r\n\r\n')
+    await writer.drain()
+
+
+async def _send_json(writer, status: int, body: bytes, extra_headers: str = ''):
+    reason = {
+        200: 'OK', 304: 'Not Modified', 404: 'Not Found', 429: 'Too Many Requests',
+        500: 'Internal Server Error', 502: 'Bad Gateway', 503: 'Service Unavailable'
+    }.get(status, 'Error')
+    writer.write(
+        f'HTTP/1.1 {status} {reason}\r\n'
+        f'Content-Type: application/json\r\n'
+        f'Content-Length: {len(body)}\r\n'
+        f'{extra_headers}'
+        f'\r\n'.encode('ascii') + body
+    )
+    await writer.drain()
+
+
+async def _handle_connection(reader, writer, config: FakeConfig):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+
+            body = b''
+            if headers.get('content-length'):
+                body = await reader.readexactly(int(headers['content-length']))
+
+            path = path.split('?', 1)[0].rstrip('/')
+            if method == 'GET' and path.endswith('/models'):
+                models_body = config.models_body
+                etag = '"' + hashlib.sha256(models_body).hexdigest()[:16] + '"'
+                if headers.get('if-none-match') == etag:
+                    await _send_json(writer, 304, b'', f'ETag: {etag}\r\n')
+                else:
+                    await _send_json(writer, 200, models_body, f'ETag: {etag}\r\n')
+            elif method == 'POST' and path.endswith('/chat/completions'):
+                payload = json.loads(body or b'{}')
+                model = payload.get('model') or 'fake/model'
+                if config.random.random() < config.drop_rate:
+                    # Обрыв соединения без ответа (сбой сети или балансировщика)
+                    break
+                delay = config.first_token_delay
+                if config.random.random() < config.slow_rate:
+                    delay += config.slow_delay
+                if model in config.fail_models or config.random.random() < config.error_rate:
+                    if delay:
+                        await asyncio.sleep(delay)
+                    error = {'error': {'code': config.error_status, 'message': 'Fake upstream error'}}
+                    extra = 'Retry-After: 1\r\n' if config.error_status == 429 else ''
+                    await _send_json(writer, config.error_status, json.dumps(error).encode('utf-8'), extra)
+                elif payload.get('stream'):
+                    await _stream_completion(writer, config, model, payload, delay)
+                else:
+                    tokens = _completion_tokens(payload, config)
+                    if delay:
+                        await asyncio.sleep(delay)
+                    if config.token_delay:
+                        await asyncio.sleep(config.token_delay * tokens)
+                    content = ''.join(_WORDS[i % len(_WORDS)] for i in range(tokens))
+                    response = {
+                        'id': 'gen-fake',
+                        'model': model,
+                        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                        'usage': _usage(payload, tokens)
+                    }
+                    await _send_json(writer, 200, json.dumps(response, ensure_ascii=False).encode('utf-8'))
+            else:
+                await _send_json(writer, 404, b'{"error": {"message": "Not found"}}')
+
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int, config: FakeConfig, ssl_context: ssl.SSLContext = None):
+    server = await asyncio.start_server(
+        lambda r, w: _handle_connection(r, w, config), host, port, backlog=4096, ssl=ssl_context
+    )
+    scheme = 'https' if ssl_context else 'http'
+    print(f"[fake-openrouter] слушает {scheme}://{host}:{port} (tokens={config.tokens}, delay={config.token_delay}s)", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Локальный fake-сервер OpenRouter')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--tokens', type=int, default=200, help='Количество токенов в ответе')
+    parser.add_argument('--token-delay', type=float, default=0.01, help='Пауза между токенами (сек)')
+    parser.add_argument('--first-token-delay', type=float, default=0.0, help='Пауза до первого токена (сек)')
+    parser.add_argument('--token-jitter', type=float, default=0.0, help='Разброс паузы между токенами (доля, 0..1)')
+    parser.add_argument('--stall-every', type=int, default=0, help='Зависание после каждых N токенов (0 - нет)')
+    parser.add_argument('--stall-duration', type=float, default=0.0, help='Длительность зависания (сек)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля запросов с ошибкой HTTP (0..1)')
+    parser.add_argument('--error-status', type=int, default=500, help='HTTP статус ошибки (500, 429, 502, ...)')
+    parser.add_argument('--stream-error-rate', type=float, default=0.0, help='Доля потоков с ошибкой посреди ответа')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Доля запросов с обрывом соединения без ответа')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='Доля запросов с медленным первым токеном')
+    parser.add_argument('--slow-delay', type=float, default=5.0, help='Дополнительная пауза до первого токена (сек)')
+    parser.add_argument('--fail-models', default='', help='Модели через запятую, которые всегда отвечают ошибкой')
+    parser.add_argument('--extra-models', type=int, default=0, help='Дополнительных моделей в /models')
+    parser.add_argument('--seed', type=int, help='Seed для воспроизводимых ошибок и разброса')
+    parser.add_argument('--tls-cert', help='PEM сертификат для HTTPS (вместе с --tls-key)')
+    parser.add_argument('--tls-key', help='PEM ключ для HTTPS')
+    args = parser.parse_args()
+
+    ssl_context = None
+    if args.tls_cert and args.tls_key:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(args.tls_cert, args.tls_key)
+
+    config = FakeConfig(
+        args.tokens, args.token_delay, args.first_token_delay,
+        token_jitter=args.token_jitter, stall_every=args.stall_every, stall_duration=args.stall_duration,
+        error_rate=args.error_rate, error_status=args.error_status, stream_error_rate=args.stream_error_rate,
+        extra_models=args.extra_models, seed=args.seed, drop_rate=args.drop_rate,
+        slow_rate=args.slow_rate, slow_delay=args.slow_delay,
+        fail_models=tuple(m.strip() for m in args.fail_models.split(',') if m.strip())
+    )
+    try:
+        asyncio.run(serve(args.host, args.port, config, ssl_context))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
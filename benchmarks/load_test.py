@@ -0,0 +1,311 @@
+"""
+Сквозной нагрузочный тест без сети и API ключа: fake OpenRouter + приложение под gunicorn.conf.py.
+
+Виртуальные пользователи (--concurrency) в цикле отправляют запросы к /api/chat/stream, /api/chat
+и /api/estimate-cost в заданной пропорции (--mix) и продолжают диалог (история растет до --history-turns
+ходов, затем диалог начинается заново). Сообщения уникальны, поэтому кэш ответов и single-flight
+не схлопывают запросы.
+
+Отчет по каждому endpoint: запросов, ошибок (по видам), задержка p50/p95/p99 (для потоков - TTFT),
+токенов/сек; RSS каждого воркера (пик). --json сохраняет отчет, пороги --max-error-rate и
+--max-p95-ttft-ms завершают тест с кодом 1 - так регрессии ловятся без реального OpenRouter.
+
+Запуск:
+    python benchmarks/load_test.py --concurrency 50 --duration 30
+    python benchmarks/load_test.py --profile asgi --mix stream=80,chat=10,estimate=10 --workers 2
+    python benchmarks/load_test.py --fake-args "--error-rate 0.02 --stall-every 40 --stall-duration 2"
+    python benchmarks/load_test.py --url http://127.0.0.1:5000 --pid <pid мастера gunicorn>
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import sys
+import time
+from collections import Counter
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_utils import (  # noqa: E402
+    free_port, start_fake_openrouter, app_env, start_app, stop_process,
+    process_rss_kb, worker_pids, percentile
+)
+
+ENDPOINTS = {
+    'stream': '/api/chat/stream',
+    'chat': '/api/chat',
+    'estimate': '/api/estimate-cost',
+}
+
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = Counter()
+        # Для потоков - время до первого токена, для остальных - время ответа
+        self.latencies = []
+        self.durations = []
+        self.completion_tokens = 0
+        # Токенов/сек отдельных потоков (от первого токена до done)
+        self.stream_rates = []
+
+    def report(self, elapsed: float) -> dict:
+        return {
+            'requests': self.requests,
+            'errors': sum(self.errors.values()),
+            'error_kinds': dict(self.errors),
+            'error_rate': round(sum(self.errors.values()) / self.requests, 4) if self.requests else 0.0,
+            'p50_ms': round(percentile(self.latencies, 50) * 1000, 1),
+            'p95_ms': round(percentile(self.latencies, 95) * 1000, 1),
+            'p99_ms': round(percentile(self.latencies, 99) * 1000, 1),
+            'completion_tokens': self.completion_tokens,
+            'tokens_per_sec': round(self.completion_tokens / elapsed, 1) if elapsed else 0.0,
+            'stream_tokens_per_sec_p50': round(percentile(self.stream_rates, 50), 1),
+        }
+
+
+def parse_mix(mix: str) -> list:
+    weights = []
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise SystemExit(f"Неизвестный endpoint в --mix: {name} (доступны: {', '.join(ENDPOINTS)})")
+        weights.append((name, float(weight or 1)))
+    return weights
+
+
+async def do_stream(client: httpx.AsyncClient, url: str, body: dict, stats: EndpointStats, timeout: float):
+    started = time.perf_counter()
+    first_token = None
+    parts = []
+    try:
+        async with asyncio.timeout(timeout):
+            async with client.stream('POST', url, json=body) as response:
+                if response.status_code != 200:
+                    stats.errors[f'http_{response.status_code}'] += 1
+                    return None
+                async for line in response.aiter_lines():
+                    if not line.startswith('data: '):
+                        continue
+                    event = json.loads(line[6:])
+                    if event.get('error'):
+                        stats.errors['stream_error'] += 1
+                        return None
+                    if event.get('token'):
+                        if first_token is None:
+                            first_token = time.perf_counter()
+                            stats.latencies.append(first_token - started)
+                        parts.append(event['token'])
+                    if event.get('done'):
+                        finished = time.perf_counter()
+                        stats.durations.append(finished - started)
+                        tokens = (event.get('cost') or {}).get('completion_tokens') or 0
+                        stats.completion_tokens += tokens
+                        if first_token is not None and finished > first_token and tokens:
+                            stats.stream_rates.append(tokens / (finished - first_token))
+                        return ''.join(parts)
+        stats.errors['no_done'] += 1
+    except TimeoutError:
+        stats.errors['timeout'] += 1
+    except (httpx.HTTPError, ValueError) as e:
+        stats.errors[type(e).__name__] += 1
+    return None
+
+
+async def do_chat(client: httpx.AsyncClient, url: str, body: dict, stats: EndpointStats, timeout: float):
+    started = time.perf_counter()
+    try:
+        response = await client.post(url, json=body, timeout=timeout)
+    except httpx.TimeoutException:
+        stats.errors['timeout'] += 1
+        return None
+    except httpx.HTTPError as e:
+        stats.errors[type(e).__name__] += 1
+        return None
+    elapsed = time.perf_counter() - started
+    if response.status_code != 200:
+        stats.errors[f'http_{response.status_code}'] += 1
+        return None
+    stats.latencies.append(elapsed)
+    stats.durations.append(elapsed)
+    data = response.json()
+    stats.completion_tokens += (data.get('cost') or {}).get('completion_tokens') or 0
+    return data.get('content', '')
+
+
+async def do_estimate(client: httpx.AsyncClient, url: str, body: dict, stats: EndpointStats, timeout: float):
+    started = time.perf_counter()
+    try:
+        response = await client.post(url, json=body, timeout=timeout)
+    except httpx.HTTPError as e:
+        stats.errors[type(e).__name__] += 1
+        return None
+    elapsed = time.perf_counter() - started
+    if response.status_code != 200:
+        stats.errors[f'http_{response.status_code}'] += 1
+        return None
+    stats.latencies.append(elapsed)
+    stats.durations.append(elapsed)
+    return None
+
+
+_HANDLERS = {'stream': do_stream, 'chat': do_chat, 'estimate': do_estimate}
+
+
+async def virtual_user(user_id: int, client: httpx.AsyncClient, base_url: str, args, weights: list,
+                       stats: dict, deadline: float, counter: list):
+    rng = random.Random(user_id)
+    names = [name for name, _ in weights]
+    probabilities = [weight for _, weight in weights]
+    history = []
+    while time.perf_counter() < deadline and (not args.requests or counter[0] < args.requests):
+        counter[0] += 1
+        name = rng.choices(names, probabilities)[0]
+        message = f"Пользователь {user_id}, запрос {counter[0]}: расскажи про нагрузочное тестирование."
+        body = {
+            'message': message,
+            'model': args.model,
+            'history': history,
+            'max_tokens': args.max_tokens,
+            'use_ia_style': rng.random() < 0.5,
+        }
+        stats[name].requests += 1
+        answer = await _HANDLERS[name](client, base_url + ENDPOINTS[name], body, stats[name], args.timeout)
+        if answer is not None:
+            history = history + [{'role': 'user', 'content': message}, {'role': 'assistant', 'content': answer}]
+            if len(history) > args.history_turns * 2:
+                history = []
+
+
+async def sample_worker_rss(master_pid: int, peaks: dict, stop: asyncio.Event):
+    while not stop.is_set():
+        for pid in worker_pids(master_pid):
+            peaks[pid] = max(peaks.get(pid, 0), process_rss_kb(pid))
+        await asyncio.sleep(0.5)
+
+
+async def run_load(base_url: str, master_pid: int, args, weights: list) -> tuple:
+    stats = {name: EndpointStats() for name in ENDPOINTS}
+    rss_peaks = {}
+    stop = asyncio.Event()
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=None) as client:
+        sampler = asyncio.create_task(sample_worker_rss(master_pid, rss_peaks, stop)) if master_pid else None
+        started = time.perf_counter()
+        deadline = started + args.duration
+        counter = [0]
+        await asyncio.gather(*(
+            virtual_user(i, client, base_url, args, weights, stats, deadline, counter)
+            for i in range(args.concurrency)
+        ))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        if sampler:
+            await sampler
+    return stats, rss_peaks, elapsed
+
+
+def print_report(report: dict):
+    print()
+    print("=" * 78)
+    print(f"Профиль: {report['profile']}, воркеров: {report['workers']}, пользователей: {report['concurrency']}, "
+          f"время: {report['elapsed_sec']} сек")
+    print(f"{'endpoint':<10}{'запросов':>9}{'ошибок':>8}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}"
+          f"{'ток/сек':>10}{'ток/сек/поток':>15}")
+    for name, row in report['endpoints'].items():
+        if not row['requests']:
+            continue
+        print(f"{name:<10}{row['requests']:>9}{row['errors']:>8}{row['p50_ms']:>9.0f}{row['p95_ms']:>9.0f}"
+              f"{row['p99_ms']:>9.0f}{row['tokens_per_sec']:>10.0f}{row['stream_tokens_per_sec_p50']:>15.0f}")
+        if row['error_kinds']:
+            print(f"{'':<10}ошибки: {row['error_kinds']}")
+    print("(для stream задержка - TTFT, время до первого токена)")
+    for pid, rss_mb in report['worker_rss_mb'].items():
+        print(f"RSS воркера {pid}: пик {rss_mb} МБ")
+    print("=" * 78)
+
+
+def check_thresholds(report: dict, args) -> list:
+    failures = []
+    for name, row in report['endpoints'].items():
+        if row['requests'] and args.max_error_rate is not None and row['error_rate'] > args.max_error_rate:
+            failures.append(f"{name}: доля ошибок {row['error_rate']} > {args.max_error_rate}")
+    stream = report['endpoints']['stream']
+    if stream['requests'] and args.max_p95_ttft_ms is not None and stream['p95_ms'] > args.max_p95_ttft_ms:
+        failures.append(f"stream: p95 TTFT {stream['p95_ms']} мс > {args.max_p95_ttft_ms} мс")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сквозной нагрузочный тест приложения на fake OpenRouter')
+    parser.add_argument('--profile', choices=['gthread', 'gevent', 'asgi', 'sync'], default='gthread')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=20, help='Одновременных пользователей')
+    parser.add_argument('--duration', type=float, default=20.0, help='Длительность (сек)')
+    parser.add_argument('--requests', type=int, default=0, help='Остановиться после N запросов (0 - по времени)')
+    parser.add_argument('--mix', default='stream=70,chat=15,estimate=15', help='Доли endpoint: stream,chat,estimate')
+    parser.add_argument('--model', default='fake/model')
+    parser.add_argument('--max-tokens', type=int, default=200)
+    parser.add_argument('--history-turns', type=int, default=5, help='Ходов в диалоге до начала нового')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Таймаут одного запроса (сек)')
+    parser.add_argument('--tokens', type=int, default=200, help='Токенов в ответе fake OpenRouter')
+    parser.add_argument('--token-delay', type=float, default=0.01, help='Пауза между токенами upstream (сек)')
+    parser.add_argument('--fake-args', default='', help='Дополнительные аргументы fake_openrouter.py')
+    parser.add_argument('--url', help='Уже запущенное приложение (fake и gunicorn не запускаются)')
+    parser.add_argument('--pid', type=int, help='PID мастера gunicorn для замера RSS при --url')
+    parser.add_argument('--json', help='Сохранить отчет в JSON файл')
+    parser.add_argument('--max-error-rate', type=float, help='Порог доли ошибок любого endpoint')
+    parser.add_argument('--max-p95-ttft-ms', type=float, help='Порог p95 TTFT потоков (мс)')
+    args = parser.parse_args()
+    weights = parse_mix(args.mix)
+
+    upstream = None
+    app_proc = None
+    failures = []
+    try:
+        if args.url:
+            base_url = args.url.rstrip('/')
+            master_pid = args.pid
+        else:
+            upstream_port = free_port()
+            app_port = free_port()
+            upstream = start_fake_openrouter(upstream_port, args.tokens, args.token_delay, shlex.split(args.fake_args))
+            env = app_env(upstream_port, GUNICORN_PROFILE=args.profile, GUNICORN_WORKERS=args.workers,
+                          PRICING_SNAPSHOT_PATH='', GUNICORN_LOG_LEVEL='warning')
+            app_proc = start_app(['gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{app_port}'],
+                                 app_port, env)
+            base_url = f'http://127.0.0.1:{app_port}'
+            master_pid = app_proc.pid
+            time.sleep(1.0)
+
+        stats, rss_peaks, elapsed = asyncio.run(run_load(base_url, master_pid, args, weights))
+        report = {
+            'profile': args.profile if not args.url else args.url,
+            'workers': len(rss_peaks) or args.workers,
+            'concurrency': args.concurrency,
+            'elapsed_sec': round(elapsed, 2),
+            'mix': args.mix,
+            'endpoints': {name: endpoint_stats.report(elapsed) for name, endpoint_stats in stats.items()},
+            'worker_rss_mb': {pid: round(kb / 1024, 1) for pid, kb in sorted(rss_peaks.items())},
+        }
+        print_report(report)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+
+        failures = check_thresholds(report, args)
+        for failure in failures:
+            print(f"ПОРОГ ПРЕВЫШЕН: {failure}")
+    finally:
+        stop_process(app_proc)
+        stop_process(upstream)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -55,6 +55,21 @@ npm ci --legacy-peer-deps 2>/dev/null || npm install
 echo "🔨 Собираем фронтенд..."
 npm run build
 
+# Сжатые копии для раздачи без сжатия на лету (app/static_assets.py отдает их по Accept-Encoding)
+if [ -d "../app/static" ]; then
+    echo "🗜️ Создаем .gz/.br копии статики..."
+    find ../app/static -type f \( -name '*.js' -o -name '*.css' -o -name '*.html' -o -name '*.svg' -o -name '*.json' \) \
+        -size +1k | while read -r file; do
+        gzip -9 -k -f -n "$file"
+        if command -v brotli &> /dev/null; then
+            brotli -q 11 -k -f "$file"
+        fi
+    done
+    if ! command -v brotli &> /dev/null; then
+        echo "⚠️ brotli не установлен - созданы только .gz копии"
+    fi
+fi
+
 # Проверяем результат
 if [ -d "../app/static" ]; then
     echo "✅ Сборка фронтенда завершена успешно!"
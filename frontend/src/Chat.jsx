@@ -13,6 +13,8 @@ function Chat({ selectedModel, settings }) {
   const abortControllerRef = useRef(null)
   const readerRef = useRef(null)
   const estimateTimeoutRef = useRef(null)
+  // Диалог на сервере: id, версия и сколько сообщений истории сервер уже знает
+  const conversationRef = useRef({ id: null, version: null, length: 0 })
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' })
@@ -53,6 +55,16 @@ function Chat({ selectedModel, settings }) {
       }))
   }, [messages])
 
+  // Поля диалога для запроса: если сервер знает всю историю, отправляем только id и версию
+  const conversationFields = (history) => {
+    const conversation = conversationRef.current
+    if (conversation.id && conversation.length === history.length) {
+      return { conversation_id: conversation.id, conversation_version: conversation.version }
+    }
+    // Пустой массив тоже отправляем: он сбрасывает историю диалога на сервере
+    return { conversation_id: conversation.id, history }
+  }
+
   // Функция оценки стоимости
   const estimateCost = useCallback(async (messageText) => {
     if (!messageText.trim() || isLoading) {
@@ -69,8 +81,9 @@ function Chat({ selectedModel, settings }) {
       const requestPayload = {
         message: messageText,
         model: selectedModel,
-        history: history.length > 0 ? history : undefined,
+        ...conversationFields(history),
         max_tokens: settings.max_tokens || undefined,
+        verbosity: settings.verbosity,
         use_system_prompt: settings.use_system_prompt !== false,
         use_ia_style: settings.use_ia_style === true
       }
@@ -86,6 +99,10 @@ function Chat({ selectedModel, settings }) {
       if (response.ok) {
         const data = await response.json()
         setCostEstimate(data)
+      } else if (response.status === 409) {
+        // История на сервере устарела - следующий запрос отправит ее целиком
+        conversationRef.current = { ...conversationRef.current, length: -1 }
+        setCostEstimate(null)
       } else {
         // Если ошибка - просто не показываем оценку
         setCostEstimate(null)
@@ -96,7 +113,7 @@ function Chat({ selectedModel, settings }) {
     } finally {
       setIsEstimating(false)
     }
-  }, [isLoading, selectedModel, settings.max_tokens, settings.use_system_prompt, settings.use_ia_style, getChatHistory])
+  }, [isLoading, selectedModel, settings.max_tokens, settings.verbosity, settings.use_system_prompt, settings.use_ia_style, getChatHistory])
 
   // Debounce для оценки стоимости при вводе текста
   useEffect(() => {
@@ -148,7 +165,7 @@ function Chat({ selectedModel, settings }) {
         return () => clearTimeout(timeoutId)
       }
     }
-  }, [selectedModel, settings.max_tokens, settings.use_system_prompt, input, isLoading, estimateCost])
+  }, [selectedModel, settings.max_tokens, settings.verbosity, settings.use_system_prompt, input, isLoading, estimateCost])
 
   const handleStreamingSend = async (userMessage) => {
     // Создаем placeholder сообщение ассистента
@@ -186,10 +203,8 @@ function Chat({ selectedModel, settings }) {
         use_ia_style: settings.use_ia_style === true
       }
       
-      // Передаем историю только если она не пустая
-      if (historyWithoutLastUser.length > 0) {
-        requestPayload.history = historyWithoutLastUser
-      }
+      // История уходит только если сервер ее не знает (новый диалог или пересинхронизация)
+      Object.assign(requestPayload, conversationFields(historyWithoutLastUser))
       
       // Передаем max_tokens только если он установлен (не null и > 0)
       if (settings.max_tokens !== null && settings.max_tokens > 0) {
@@ -198,15 +213,24 @@ function Chat({ selectedModel, settings }) {
       
       // Отправляем запрос к streaming endpoint
       let response
+      const sendRequest = () => fetch('/api/chat/stream', {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json'
+        },
+        body: JSON.stringify(requestPayload),
+        signal: abortControllerRef.current.signal
+      })
       try {
-        response = await fetch('/api/chat/stream', {
-          method: 'POST',
-          headers: {
-            'Content-Type': 'application/json'
-          },
-          body: JSON.stringify(requestPayload),
-          signal: abortControllerRef.current.signal
-        })
+        response = await sendRequest()
+        if (response.status === 409) {
+          // Сервер не знает актуальную историю диалога - отправляем ее целиком
+          Object.assign(requestPayload, {
+            conversation_version: undefined,
+            history: historyWithoutLastUser
+          })
+          response = await sendRequest()
+        }
       } catch (fetchError) {
         // Обработка сетевых ошибок (network error, CORS, timeout и т.д.)
         if (fetchError instanceof TypeError && fetchError.message.includes('fetch')) {
@@ -239,6 +263,10 @@ function Chat({ selectedModel, settings }) {
         throw new Error('Пустой ответ от сервера')
       }
 
+      const conversationId = response.headers.get('X-Conversation-Id')
+      // Версию после записи хода сервер выдает заранее
+      const conversationVersion = response.headers.get('X-Conversation-Next-Version')
+
       // Получаем ReadableStream
       const reader = response.body.getReader()
       readerRef.current = reader
@@ -247,8 +275,10 @@ function Chat({ selectedModel, settings }) {
       let buffer = ''
       let accumulatedContent = ''
       let finalModel = selectedModel
+      let requestedModel = null
       let finishReason = null
       let costInfo = null
+      let streamDone = false
 
       try {
         while (true) {
@@ -300,7 +330,9 @@ function Chat({ selectedModel, settings }) {
                 
                 // Если поток завершен
                 if (eventData.done) {
+                  streamDone = true
                   finalModel = eventData.model || selectedModel
+                  requestedModel = eventData.requested_model
                   finishReason = eventData.finish_reason
                   costInfo = eventData.cost
                   break
@@ -351,6 +383,15 @@ function Chat({ selectedModel, settings }) {
         }
       }
 
+      // Сервер записал ход в диалог: история стала длиннее на вопрос и ответ
+      if (streamDone && conversationId) {
+        conversationRef.current = {
+          id: conversationId,
+          version: conversationVersion,
+          length: historyWithoutLastUser.length + 2
+        }
+      }
+
       // Финальное обновление сообщения с метаданными (убираем флаг isStreaming)
       setMessages(prev => {
         const newMessages = [...prev]
@@ -361,6 +402,7 @@ function Chat({ selectedModel, settings }) {
               ...newMessages[i],
               content: accumulatedContent,
               model: finalModel,
+              requested_model: requestedModel,
               finish_reason: finishReason,
               cost: costInfo,
               isStreaming: undefined // Убираем флаг
@@ -460,6 +502,7 @@ function Chat({ selectedModel, settings }) {
   }
 
   const handleNewChat = () => {
+    conversationRef.current = { id: null, version: null, length: 0 }
     setMessages([])
     setCostEstimate(null)
   }
@@ -121,6 +121,9 @@ function Message({ message, isLastAssistant, onRetry }) {
         {message.model && !isUser && !message.isStreaming && (
           <div className="message-model">
             {message.model}
+            {message.requested_model && (
+              <span className="message-fallback"> (вместо {message.requested_model})</span>
+            )}
             {message.cost && (
               <span className="message-cost"> • {message.cost.total_cost_rub.toFixed(2)} руб.</span>
             )}
@@ -0,0 +1,121 @@
+"""
+Конфигурация gunicorn для production: запуск `gunicorn -c gunicorn.conf.py`.
+
+Профили (GUNICORN_PROFILE):
+- gthread (по умолчанию): Flask в пуле потоков, один SSE поток занимает один поток воркера,
+  статика и /api/* обслуживаются параллельно с длинными потоками
+- gevent: кооперативные воркеры (нужен `pip install gevent`), тысячи соединений на воркер
+- asgi: app.asgi:app с uvicorn воркерами, /api/chat/stream на asyncio
+- sync: прежний режим (один запрос на воркер), только для сравнения
+
+Воркеров по умолчанию 2-4, если есть общее хранилище диалогов (CONVERSATION_STORE_PATH или /data),
+иначе один воркер с 64 потоками: диалоги в памяти процесса не видны другим воркерам.
+
+Приложение, снимок тарифов и системные промпты загружаются один раз в мастер-процессе (preload),
+воркеры получают их после fork готовыми; фоновые задачи (обновление тарифов, проверка файлов промптов)
+запускаются в каждом воркере после его инициализации.
+"""
+import os
+import logging
+
+GUNICORN_PROFILE = os.environ.get('GUNICORN_PROFILE', 'gthread')
+
+if GUNICORN_PROFILE == 'gevent':
+    try:
+        # До загрузки приложения (preload): иначе потоки и сокеты модулей приложения не будут кооперативными
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        logging.getLogger('gunicorn.error').warning(
+            "GUNICORN_PROFILE=gevent, но пакет gevent не установлен - используется gthread"
+        )
+        GUNICORN_PROFILE = 'gthread'
+
+_WORKER_CLASSES = {
+    'gthread': 'gthread',
+    'gevent': 'gevent',
+    'asgi': 'uvicorn.workers.UvicornWorker',
+    'sync': 'sync',
+}
+
+wsgi_app = 'app.asgi:app' if GUNICORN_PROFILE == 'asgi' else 'app.main:app'
+worker_class = _WORKER_CLASSES.get(GUNICORN_PROFILE, 'gthread')
+
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', '5000')}")
+
+# Общее хранилище диалогов (как CONVERSATION_STORE_PATH в app/api/conversation_store.py)
+_SHARED_CONVERSATIONS = bool(os.environ.get(
+    'CONVERSATION_STORE_PATH',
+    '/data/conversations.sqlite3' if os.path.isdir('/data') else ''
+))
+
+# Процессов: каждый держит свои кэши (ответы, токены), поэтому немного. Диалоги в памяти процесса
+# другим воркерам не видны: без общего хранилища по умолчанию один воркер с большим пулом потоков
+# (явно заданные несколько воркеров без хранилища выключают режим диалога, см. AICHAT_WORKERS ниже)
+workers = int(os.environ.get('GUNICORN_WORKERS', os.environ.get(
+    'WEB_CONCURRENCY', str(max(2, min(os.cpu_count() or 1, 4))) if _SHARED_CONVERSATIONS else '1'
+)))
+
+# gthread: одновременных запросов (в том числе открытых SSE потоков) на воркер
+# (sync с threads > 1 gunicorn сам переключает на gthread)
+threads = int(os.environ.get(
+    'GUNICORN_THREADS', '1' if GUNICORN_PROFILE == 'sync' else ('32' if workers > 1 else '64')
+))
+
+# gevent/asgi: одновременных соединений на воркер
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '1000'))
+
+# Для gthread/gevent/asgi это проверка, что воркер жив, а не лимит длительности запроса;
+# sync воркер убивается по таймауту посреди запроса, поэтому ему нужен запас на длинные потоки
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '300' if GUNICORN_PROFILE == 'sync' else '60'))
+
+# Сколько ждать завершения открытых потоков при остановке/перезапуске воркера:
+# больше таймаута потока к OpenRouter (120 сек), чтобы начатые ответы дошли до клиента
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', '130'))
+
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', '5'))
+
+# Перезапуск воркера после N запросов (с разбросом, чтобы воркеры не перезапускались одновременно):
+# ограничивает рост памяти; открытые потоки дослуживаются (graceful_timeout)
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', '2000'))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', '200'))
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+# Фоновые задачи не запускаются при импорте app.main (в мастере они бы не пережили fork),
+# их запускает post_worker_init в каждом воркере.
+# AICHAT_WORKERS: без общего хранилища диалогов при нескольких воркерах режим диалога выключается
+raw_env = ['APP_BACKGROUND_TASKS=0', f'AICHAT_WORKERS={workers}']
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+
+def on_starting(server):
+    """Мастер: загружает общее состояние до запуска воркеров (приложение уже импортировано при preload)"""
+    from app.api.metrics import clear_metrics_dir
+    # Итоги /api/metrics считаются с запуска сервера: файлы прошлых запусков удаляются
+    clear_metrics_dir()
+    if preload_app:
+        from app.main import preload_shared_state
+        preload_shared_state()
+    server.log.info(
+        f"Профиль {GUNICORN_PROFILE}: {workers} воркеров ({worker_class}), "
+        f"threads={threads}, graceful_timeout={graceful_timeout}, max_requests={max_requests}"
+    )
+
+
+def post_worker_init(worker):
+    """Воркер: запускает фоновые задачи процесса"""
+    from app.main import start_background_tasks
+    start_background_tasks()
+
+
+def worker_exit(server, worker):
+    """Воркер: перед выходом записывает метрики и буфер логов, чтобы они не потерялись при перезапуске"""
+    from app.api.metrics import flush_metrics
+    from app.api.tracing import stop_log_listener
+    flush_metrics()
+    stop_log_listener()
+
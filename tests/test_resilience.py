@@ -0,0 +1,200 @@
+"""
+Устойчивость запросов к OpenRouter (app/api/resilience.py) на fake OpenRouter:
+выключатель модели, пробная попытка (half_open), повторы до первого токена и хеджирование.
+
+Приложение и fake-сервер запускаются в подпроцессах, как в бенчмарках (benchmarks/bench_utils.py),
+настройки устойчивости передаются переменными окружения. Гонки, которые трудно воспроизвести
+через HTTP (поздний ответ при открытом выключателе), проверяются вызовами resilience напрямую.
+
+Запуск:
+    python -m pytest -q tests
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from bench_utils import app_env, free_port, start_app, start_fake_openrouter, stop_process  # noqa: E402
+
+from app.api import resilience  # noqa: E402
+
+STATS_TOKEN = 'test-stats-token'
+
+CIRCUIT_OPEN_MESSAGE = 'Модель временно недоступна (много ошибок подряд). Повторите позже или выберите другую модель'
+
+_APP_COMMANDS = {
+    'wsgi': ['gunicorn', 'app.main:app', '-w', '1', '-k', 'gthread', '--threads', '8'],
+    'asgi': ['gunicorn', 'app.asgi:app', '-w', '1', '-k', 'uvicorn.workers.UvicornWorker'],
+}
+
+
+class Server:
+    """fake OpenRouter и приложение, направленное на него"""
+
+    def __init__(self, kind: str, fake_args: list, **env):
+        self.upstream_port = free_port()
+        self.upstream = start_fake_openrouter(self.upstream_port, 20, 0.0, fake_args)
+        self.port = free_port()
+        self.metrics_dir = tempfile.TemporaryDirectory()
+        env = app_env(
+            self.upstream_port, PRICING_SNAPSHOT_PATH='', CONVERSATION_STORE_PATH='', LOG_ASYNC='0',
+            TRACE_SAMPLE_RATE='0', METRICS_DIR=self.metrics_dir.name, STATS_TOKEN=STATS_TOKEN, **env
+        )
+        cmd = _APP_COMMANDS[kind] + ['--bind', f'127.0.0.1:{self.port}']
+        try:
+            self.app = start_app(cmd, self.port, env)
+        except Exception:
+            stop_process(self.upstream)
+            raise
+        self.client = httpx.Client(base_url=f'http://127.0.0.1:{self.port}', timeout=30)
+
+    def stream(self, model: str) -> tuple:
+        """POST /api/chat/stream: (события, секунды до конца потока)"""
+        started = time.perf_counter()
+        events = []
+        with self.client.stream('POST', '/api/chat/stream', json={'message': 'привет', 'model': model}) as r:
+            assert r.status_code == 200
+            for line in r.iter_lines():
+                if line.startswith('data: '):
+                    events.append(json.loads(line[6:]))
+        return events, time.perf_counter() - started
+
+    def resilience_stats(self) -> dict:
+        r = self.client.get('/api/debug/stats?section=resilience', headers={'Authorization': f'Bearer {STATS_TOKEN}'})
+        return r.json()['resilience']
+
+    def close(self):
+        self.client.close()
+        stop_process(self.app)
+        stop_process(self.upstream)
+        self.metrics_dir.cleanup()
+
+
+@pytest.fixture
+def server_factory():
+    servers = []
+
+    def make(kind: str, fake_args: list, **env) -> Server:
+        server = Server(kind, fake_args, **env)
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.close()
+
+
+def _error(events: list):
+    return next((event for event in events if event.get('error')), None)
+
+
+def _done(events: list) -> bool:
+    return any(event.get('done') for event in events)
+
+
+@pytest.mark.parametrize('kind', ['wsgi', 'asgi'])
+def test_circuit_opens_and_fails_fast(server_factory, kind):
+    server = server_factory(
+        kind, ['--fail-models', 'fake/broken', '--first-token-delay', '0.3'],
+        UPSTREAM_RETRIES='0', CIRCUIT_FAILURE_THRESHOLD='3', CIRCUIT_OPEN_SECONDS='1'
+    )
+
+    # Неудачи до порога доходят до OpenRouter
+    for _ in range(3):
+        events, _ = server.stream('fake/broken')
+        assert _error(events)['status_code'] == 500
+
+    # Выключатель открыт: 503 без обращения к OpenRouter
+    events, seconds = server.stream('fake/broken')
+    assert _error(events) == {'error': CIRCUIT_OPEN_MESSAGE, 'status_code': 503}
+    assert seconds < 0.25
+    r = server.client.post('/api/chat', json={'message': 'привет', 'model': 'fake/broken'})
+    assert r.status_code == 503 and r.json()['error'] == CIRCUIT_OPEN_MESSAGE
+
+    # Другие модели выключатель не затрагивает
+    events, _ = server.stream('fake/model')
+    assert _done(events) and not _error(events)
+
+    stats = server.resilience_stats()
+    assert stats['circuit_opened'] == 1
+    assert stats['circuit_rejected'] == 2
+    assert stats['attempts'] == 4
+
+
+def test_half_open_probe_reopens_circuit(server_factory):
+    server = server_factory(
+        'wsgi', ['--fail-models', 'fake/broken'],
+        UPSTREAM_RETRIES='0', CIRCUIT_FAILURE_THRESHOLD='2', CIRCUIT_OPEN_SECONDS='0.5'
+    )
+    for _ in range(2):
+        server.stream('fake/broken')
+    assert _error(server.stream('fake/broken')[0])['status_code'] == 503
+
+    # Через CIRCUIT_OPEN_SECONDS проходит одна пробная попытка; ее неудача снова открывает выключатель
+    time.sleep(0.6)
+    assert _error(server.stream('fake/broken')[0])['status_code'] == 500
+    assert _error(server.stream('fake/broken')[0])['status_code'] == 503
+
+    stats = server.resilience_stats()
+    assert stats['circuit_opened'] == 2
+    assert stats['circuits']['fake/broken']['state'] == 'open'
+
+
+def test_late_success_keeps_circuit_open(monkeypatch):
+    monkeypatch.setattr(resilience, 'CIRCUIT_FAILURE_THRESHOLD', 2)
+    monkeypatch.setattr(resilience, 'CIRCUIT_OPEN_SECONDS', 0.3)
+    monkeypatch.setattr(resilience, '_breakers', {})
+    model = 'fake/late'
+    for _ in range(2):
+        resilience.record_result(model, False)
+    assert resilience.circuit_state(model) == 'open'
+
+    # Запрос, отправленный до открытия, ответил успешно позже: выключатель остается открытым
+    resilience.record_result(model, True)
+    assert resilience.circuit_state(model) == 'open'
+    assert not resilience.circuit_allows(model)
+
+    # Закрывает его только успешная пробная попытка
+    time.sleep(0.35)
+    assert resilience.circuit_allows(model)
+    resilience.record_result(model, True)
+    assert resilience.circuit_state(model) == 'closed'
+
+
+@pytest.mark.parametrize('kind', ['wsgi', 'asgi'])
+def test_retries_hide_upstream_errors(server_factory, kind):
+    server = server_factory(
+        kind, ['--error-rate', '0.3', '--error-status', '502', '--seed', '7'],
+        UPSTREAM_RETRIES='6', UPSTREAM_RETRY_BASE_DELAY='0.01', CIRCUIT_FAILURE_THRESHOLD='0'
+    )
+    for _ in range(10):
+        events, _ = server.stream('fake/model')
+        assert _done(events) and not _error(events)
+
+    stats = server.resilience_stats()
+    assert stats['retries'] > 0
+    assert stats['retries_exhausted'] == 0
+    assert stats['attempts'] == 10 + stats['retries']
+
+
+@pytest.mark.parametrize('kind', ['wsgi', 'asgi'])
+def test_hedge_wins_over_slow_first_token(server_factory, kind):
+    server = server_factory(
+        kind, ['--slow-rate', '0.5', '--slow-delay', '3', '--seed', '3'],
+        UPSTREAM_RETRIES='0', UPSTREAM_HEDGE_AFTER='0.2'
+    )
+    durations = []
+    for _ in range(8):
+        events, seconds = server.stream('fake/model')
+        assert _done(events) and not _error(events)
+        durations.append(seconds)
+
+    stats = server.resilience_stats()
+    assert stats['hedges_won'] > 0
+    # Дольше slow-delay идет только поток, у которого медленными оказались обе попытки (хедж проиграл)
+    assert sum(seconds >= 3 for seconds in durations) <= stats['hedges'] - stats['hedges_won']